@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Writes records spread over many distinct files through
+`filecache.CachedRotatingFileHandler`, as a server with one target file per
+tenant would.
+
+Records go to the files at random, with a few files much busier than the
+rest, and the rate, the cache's counters and the largest number of file
+descriptors the process had open are reported.
+
+    python benchmarks/file_cache.py [files] [records] [max_open]
+
+"""
+
+import logging
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from logserv import filecache  # noqa: E402
+
+
+def open_fds():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return -1
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 500000
+    max_open = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    print("%d files, %d records, max_open %d, RLIMIT_NOFILE %d" % (
+        files, n, max_open, soft))
+    cache = filecache.FileCache(max_open)
+
+    class Handler(filecache.CachedRotatingFileHandler):
+        file_cache = cache
+
+    record = logging.makeLogRecord({
+        'name': 'app.requests', 'msg': 'handled request in %.1fms',
+        'args': (12.5,), 'levelname': 'INFO', 'levelno': 20})
+    rng = random.Random(0)
+    # A fifth of the records go to the busiest 1% of the files
+    hot = max(1, files // 100)
+    targets = [rng.randrange(hot) if rng.random() < 0.2
+               else rng.randrange(files) for _ in range(n)]
+    tmp = tempfile.mkdtemp()
+    try:
+        for i in range(files // 1000 + 1):
+            os.mkdir(os.path.join(tmp, str(i)))
+        handlers = [Handler(os.path.join(tmp, str(i // 1000), '%d.log' % i),
+                            maxBytes=1024 * 1024, backupCount=1,
+                            encoding='utf-8', delay=True)
+                    for i in range(files)]
+        most_fds = open_fds()
+        start = time.perf_counter()
+        for i, target in enumerate(targets):
+            handlers[target].emit(record)
+            if i % 10000 == 0:
+                most_fds = max(most_fds, open_fds())
+        elapsed = time.perf_counter() - start
+        most_fds = max(most_fds, open_fds())
+        report = cache.report()
+        for handler in handlers:
+            handler.close()
+        print("%9.0f records/s" % (n / elapsed))
+        print("hits %(hits)d, misses %(misses)d, evictions %(evictions)d, "
+              "open %(open)d" % report)
+        print("at most %d file descriptors open" % most_fds)
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Reports the memory held per idle connection by the server.
+
+Each connection is a socket pair whose server end is wrapped in a
+`LoggingChannel`. Two figures are reported: a freshly accepted channel, and
+a channel that has completed the handshake and sits waiting for records
+(its handler is created with `delay=True`, so no file is opened).
+
+    python benchmarks/idle_memory.py [connections]
+
+"""
+
+import gc
+import json
+import os
+import socket
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from logserv import server  # noqa: E402
+
+
+def measure(n, handshake, tmpdir):
+    pairs = [socket.socketpair() for _ in range(n)]
+    socket_map = {}
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    channels = [server.LoggingChannel(ours, socket_map) for ours, _ in pairs]
+    if handshake:
+        params = json.dumps({'--level': 0, 'delay': True,
+                             'filename': os.path.join(tmpdir, 'idle.log')})
+        for (_, theirs), channel in zip(pairs, channels):
+            for msg in ('HELLO 1.0\n', 'IDENTIFY %s\n' % params, 'LOG\n'):
+                theirs.sendall(msg.encode('UTF-8'))
+                channel.handle_read()
+            channel.handle_write()
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    used = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    for channel in channels:
+        channel.close()
+    for ours, theirs in pairs:
+        ours.close()
+        theirs.close()
+    return used / n
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with tempfile.TemporaryDirectory() as tmpdir:
+        print("connections: %d" % n)
+        print("bytes per idle connection (accepted):    %8.0f" %
+              measure(n, False, tmpdir))
+        print("bytes per idle connection (handshaken):  %8.0f" %
+              measure(n, True, tmpdir))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Compares the cost of formatting records for output.
+
+Three ways of turning a record into a line are timed: the stock
+`logging.Formatter` with a text format, `json.dumps` over a dict of the
+same fields, and `formatters.JSONFormatter`.
+
+    python benchmarks/json_output.py [records]
+
+"""
+
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from logserv import formatters  # noqa: E402
+
+FIELDS = ('created', 'levelname', 'name', 'funcName', 'lineno', 'message')
+
+
+def dumps_format(record):
+    return json.dumps({
+        'created': record.created, 'levelname': record.levelname,
+        'name': record.name, 'funcName': record.funcName,
+        'lineno': record.lineno, 'message': record.getMessage()})
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    record = logging.makeLogRecord({
+        'name': 'app.requests', 'msg': 'handled %s in %.1fms',
+        'args': ('/api/v1/items?page=2', 12.5), 'levelname': 'INFO',
+        'levelno': 20, 'funcName': 'handle', 'lineno': 42,
+        'created': time.time()})
+    text = logging.Formatter(
+        '%(created)f %(levelname)s %(name)s %(funcName)s:%(lineno)d '
+        '%(message)s')
+    candidates = [
+        ('Formatter (text)', text.format),
+        ('json.dumps', dumps_format),
+        ('JSONFormatter', formatters.JSONFormatter(FIELDS).format),
+    ]
+    for name, fmt in candidates:
+        start = time.perf_counter()
+        for _ in range(n):
+            fmt(record)
+        elapsed = time.perf_counter() - start
+        print("%-18s %9.0f records/s" % (name, n / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Compares the stock `RotatingFileHandler` with
+`segments.PreallocatedFileHandler`.
+
+Each handler writes the same records into rotated segments in a temporary
+directory (or the one given, to measure a particular filesystem), and the
+time taken and the number of extents of the last full segment (from
+`filefrag`, when available) are reported.
+
+    python benchmarks/segment_writer.py [records] [directory]
+
+"""
+
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from logging.handlers import RotatingFileHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from logserv import segments  # noqa: E402
+
+MAX_BYTES = 16 * 1024 * 1024
+
+
+def extents(path):
+    try:
+        out = subprocess.run(['filefrag', path], capture_output=True,
+                             text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return '?'
+    # "<path>: <n> extents found"
+    return out.rsplit(':', 1)[1].split()[0]
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    parent = sys.argv[2] if len(sys.argv) > 2 else None
+    records = [logging.makeLogRecord({
+        'name': 'app.requests', 'msg': 'handled request %d in %.1fms',
+        'args': (i, 12.5), 'levelname': 'INFO', 'levelno': 20})
+        for i in range(1000)]
+    formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s '
+                                  '%(message)s')
+    candidates = [
+        ('RotatingFileHandler', RotatingFileHandler),
+        ('PreallocatedFileHandler', segments.PreallocatedFileHandler),
+    ]
+    for name, cls in candidates:
+        tmp = tempfile.mkdtemp(dir=parent)
+        try:
+            path = os.path.join(tmp, 'bench.log')
+            handler = cls(path, maxBytes=MAX_BYTES, backupCount=3,
+                          encoding='utf-8')
+            handler.setFormatter(formatter)
+            start = time.perf_counter()
+            for i in range(n):
+                handler.emit(records[i % 1000])
+            handler.close()
+            elapsed = time.perf_counter() - start
+            segment = path + '.1' if os.path.exists(path + '.1') else path
+            print("%-24s %9.0f records/s  %s extents" % (
+                name, n / elapsed, extents(segment)))
+        finally:
+            shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
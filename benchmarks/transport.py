@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+Compares record throughput over the local transports.
+
+For each transport a server runs in a background thread with a handler
+that only counts records, and a client in the main thread logs a fixed
+number of records through it. The time is measured from the first
+`emit` until the server has received the last record.
+
+    python benchmarks/transport.py [records]
+
+"""
+
+import asyncore
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from logserv import client, server  # noqa: E402
+
+
+class CountingHandler(logging.Handler):
+
+    """Counts records, signalling `done` once `target` have arrived."""
+
+    latest = None
+
+    def __init__(self, target, **kwargs):
+        super().__init__()
+        self.count = 0
+        self.target = target
+        self.started = threading.Event()
+        self.done = threading.Event()
+        CountingHandler.latest = self
+
+    def emit(self, record):
+        self.count += 1
+        self.started.set()
+        if self.count == self.target:
+            self.done.set()
+
+
+class CountingChannel(server.LoggingChannel):
+    handler_class = CountingHandler
+
+
+class CountingSeqPacketChannel(server.SeqPacketChannel):
+    handler_class = CountingHandler
+
+
+TRANSPORTS = [
+    ('stream', server.LogServer, CountingChannel, client.UnixClient),
+    ('seqpacket', server.SeqPacketServer, CountingSeqPacketChannel,
+     client.SeqPacketClient),
+]
+
+
+def run(server_class, channel_class, client_class, path, n):
+    socket_map = {}
+    Server = type('Server', (server_class,), {
+        'logging_map': socket_map,
+        'channel_class': channel_class,
+        'socket_family': socket.AF_UNIX,
+    })
+    srv = Server(path)
+    stop = threading.Event()
+
+    def serve():
+        while not stop.is_set():
+            asyncore.loop(timeout=0.05, map=socket_map, count=1)
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+
+    handler = client_class(path, target=n + 1)
+    record = logging.makeLogRecord({'msg': 'benchmark record %d',
+                                    'args': (42,), 'name': 'bench'})
+    # Connect and shake hands outside the timing
+    handler.emit(record)
+    while CountingHandler.latest is None or \
+            not CountingHandler.latest.started.wait(0.01):
+        pass
+    counter = CountingHandler.latest
+
+    start = time.perf_counter()
+    for _ in range(n):
+        handler.emit(record)
+    counter.done.wait(60)
+    elapsed = time.perf_counter() - start
+
+    handler.close()
+    stop.set()
+    thread.join()
+    srv.close()
+    asyncore.close_all(socket_map)
+    CountingHandler.latest = None
+    return elapsed
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, *args in TRANSPORTS:
+            path = os.path.join(tmpdir, name + '.sock')
+            elapsed = run(*args, path, n)
+            print("%-10s %8d records in %6.3fs: %9.0f records/s" %
+                  (name, n, elapsed, n / elapsed))
+
+
+if __name__ == "__main__":
+    main()
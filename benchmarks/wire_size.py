@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Compares the size and decoding cost of records on the wire.
+
+The same records are encoded by a plain forwarder, one numbering repeated
+names ('--field-dictionary') and one also referring to repeated
+tracebacks ('--exc-cache'). A third of the records carry a traceback.
+
+    python benchmarks/wire_size.py [records]
+
+"""
+
+import logging
+import os
+import sys
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from logserv import client, server  # noqa: E402
+
+
+def fail(depth):
+    if depth:
+        fail(depth - 1)
+    raise RuntimeError("database unavailable")
+
+
+def make_records(n):
+    try:
+        fail(20)
+    except RuntimeError:
+        exc_info = sys.exc_info()
+    return [logging.LogRecord('app.requests', logging.ERROR, __file__, 42,
+                              'request %d failed', (i,),
+                              exc_info if i % 3 == 0 else None, 'handle')
+            for i in range(n)]
+
+
+def encoder(field_dictionary_size=0, exc_cache_size=0):
+    forwarder = client.SocketForwarder('localhost', 0)
+    forwarder.field_dictionary_size = field_dictionary_size
+    forwarder.exc_cache_size = exc_cache_size
+    # Shake hands with a server that agrees to everything
+    forwarder.sock = mock.MagicMock()
+    forwarder.recv_line = mock.MagicMock(
+        side_effect=['HELLO 1.0\n', 'OK\n', 'OK\n'])
+    forwarder.doHandshake()
+    return forwarder
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    records = make_records(n)
+    candidates = [
+        ('plain', {}, {}),
+        ('field dictionary', {'field_dictionary_size': 256},
+         {'--field-dictionary': 256}),
+        ('+ exc cache', {'field_dictionary_size': 256, 'exc_cache_size': 64},
+         {'--field-dictionary': 256, '--exc-cache': 64}),
+    ]
+    for name, options, params in candidates:
+        forwarder = encoder(**options)
+        frames = [forwarder.makePickle(r)[4:] for r in records]
+        channel = server.LoggingChannel(mock.MagicMock(), {})
+        channel.configure_exc_cache(params.get('--exc-cache'))
+        channel.configure_field_ids(params.get('--field-dictionary'))
+        start = time.perf_counter()
+        for frame in frames:
+            record = channel.decode_record(frame)
+            if channel.exc_cache is not None:
+                channel.resolve_exc(record)
+            if channel.field_ids is not None:
+                channel.resolve_fields(record)
+        elapsed = time.perf_counter() - start
+        print("%-18s %7.0f bytes/record %9.0f records/s decoded" % (
+            name, sum(map(len, frames)) / n, n / elapsed))
+
+
+if __name__ == "__main__":
+    main()
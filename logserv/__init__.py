@@ -28,6 +28,39 @@ on the same pickle-based protocol used in SocketHandler:
 
   * <params> must contain the key '--level'
   * <params>['--level'] must be an acceptable argument for `setLevel`.
+  * <params> may contain the key '--format', whose value is a dict of
+    formatter parameters as in the FORMAT message below.
+  * <params> may contain the key '--sinks', a list of sink specs, each a
+    dict with its own '--level', an optional '--format', and the parameters
+    of its handler. Records at or above a sink's level are written to it.
+    Sinks are shared between all the clients naming the same one (see
+    `logserv.sinks`). When '--sinks' is given, the remaining keys of
+    <params> may be left out; FORMAT messages are then rejected.
+  * <params> may contain the key '--relay', used by `logserv.relay` to
+    forward the records of many clients over one connection. Its value is
+    a dict whose 'compress' key is null or "zlib". All other keys are then
+    ignored, and the client declares sinks with ROUTE messages instead.
+  * <params> may instead contain the key '--multiplex' (with a dict of
+    options, currently none), used by `client.Multiplexer` to carry several
+    handlers' records over one connection. The client declares each of its
+    streams with a ROUTE message whose <id> is below 64, and the
+    pickle-data of each log-record is preceded by a big-endian 8-byte
+    bitmap of the streams the record is for (bit <id> for stream <id>).
+    The length in len-bytes includes the bitmap.
+  * <params> may contain the key '--exc-cache', a positive integer <n>.
+    The pickle-data of a record with an 'exc_text' may then also carry an
+    'exc_ref' key, a hash of the text as bytes. Both ends remember the
+    last <n> references seen on the connection, and no more than
+    `EXC_CACHE_BYTES` bytes of their (UTF-8 encoded) texts, least recently
+    used first out. Once a reference has been sent with its text, records
+    may leave 'exc_text' as None and send just the reference. A text longer
+    than `EXC_CACHE_BYTES` is never sent with a reference.
+  * <params> may contain the key '--field-dictionary', a positive integer
+    <n>. The string values of the record attributes in `FIELD_DICTIONARY`
+    may then be numbered: the first <n> distinct strings, in the order in
+    which they are first sent (attributes of a record in the order of
+    `FIELD_DICTIONARY`), are numbered from 0. A string is sent as a pair
+    (<number>, <string>) the first time, and as its number afterwards.
   * The remaining keys in <params> are passed to the handler constructor to
     create the handler that will accept the client's logging requests.
 
@@ -35,7 +68,13 @@ on the same pickle-based protocol used in SocketHandler:
 
       'OK\n'
 
-  and the handshake is completed.
+  and the handshake is completed. A server may close connections that have
+  not sent the 'LOG\n' message below within a time limit, or that go without
+  sending anything for too long afterwards (see `logserv.timers`).
+
+  A client that wants to follow the records other clients send, rather than
+  log, sends 'SUBSCRIBE <filter>\n' instead of the IDENTIFY message (see
+  `logserv.tail`).
 
   Once the handshake has been performed, the client sends the message
 
@@ -45,6 +84,16 @@ on the same pickle-based protocol used in SocketHandler:
 
       'OK\n'
 
+  Local clients talking to a `server.RingServer` may instead send
+
+      'RING <name>\n'
+
+  where <name> names a shared-memory ring (see `logserv.ring`) created by
+  the client. After the server's 'OK\n', everything the client would have
+  sent over the socket is written to the ring instead, and the client only
+  writes to the socket (any bytes) to wake the server when the ring was
+  empty.
+
   At that point the server listens passively for log records in the format
   created by `logging.handlers.SocketHandlers`:
 
@@ -62,7 +111,7 @@ on the same pickle-based protocol used in SocketHandler:
       message       =  "\x00\x00\x00\x00" message-text
       message-text  =  <non-newline characters>* '\n'
 
-  Version 1.0 of the protocol supports two messages this way:
+  Version 1.0 of the protocol supports three messages this way:
 
   1. Formatter -- if the message text is a formatter-message, the server will
      use the parameters given as arguments to construct a `logging.Formatter`
@@ -79,19 +128,48 @@ on the same pickle-based protocol used in SocketHandler:
 
          'OK\n'
 
-  2. Quitting -- before terminating the connection, the client SHOULD send a
+     The style may also be "json", in which case the server writes each
+     record as a line of JSON (see `logserv.formatters`), and <params> may
+     contain a 'fields' key listing the record attributes to include.
+
+  2. Routing -- a relay (a client that sent '--relay') declares each sink
+     before sending records for it:
+
+         'ROUTE <id> <spec>\n'
+
+     where <id> is an integer chosen by the relay and <spec> a JSON sink
+     spec as in '--sinks'. The server opens the sink and responds 'OK\n'.
+     A relay's records are sent in batches: the pickle-data of each
+     log-record is a list of (<id>, record dict) pairs, compressed with
+     zlib if the relay asked for it.
+
+  3. Quitting -- before terminating the connection, the client SHOULD send a
      quit message:
 
          'QUIT\n'
 
   Additional notes:
 
+  * Whenever the server cannot accept a message it responds with
+
+        'ERROR <description>\n'
+
+    The server keeps reading while its responses are in flight, so they
+    may arrive after the client has sent further messages.
   * Except for the `len-bytes` and `pickle-data` transmissions, all text MUST
     be encoded in UTF-8.
   * Clients and servers are not required to support more messages more than
     10 KiB (10240 bytes) long.
 
 """
+
+# The most bytes of tracebacks both ends remember ('--exc-cache')
+EXC_CACHE_BYTES = 1 << 20
+# The record attributes that may be numbered ('--field-dictionary')
+FIELD_DICTIONARY = ('name', 'pathname', 'filename', 'module', 'funcName',
+                    'processName', 'threadName')
+
+
 class LogServerError(Exception):
     pass
 
@@ -0,0 +1,358 @@
+"""
+A control socket for profiling a running server.
+
+`AdminServer` listens on a Unix socket, created readable and writable by
+its owner only, next to the server's own sockets:
+
+    from logserv import admin, eventloop, server
+    admin.AdminServer('/run/logserv-admin.sock', server.LogServer.logging_map)
+    eventloop.loop(server.LogServer.logging_map)
+
+It accepts one command per line and answers 'OK\n', or 'ERROR <reason>\n':
+
+    SAMPLE <seconds> <path>   sample the loop thread's stack every
+                              `sample_interval` seconds, and write the
+                              counts in collapsed-stack format (as used by
+                              flamegraph.pl and speedscope)
+    PROFILE <seconds> <path>  run `cProfile` on the loop thread, and write
+                              the statistics in pstats format
+    TIME <seconds> <path>     time the stages of record processing (see
+                              `STAGES`), and write a JSON histogram per
+                              stage
+    STOP                      end the running session early
+    STATUS                    answer 'OK <command> <path>' or 'OK IDLE'
+
+Only one session runs at a time, for at most `max_duration` seconds; its
+results are written when it ends. Nothing is patched or running while no
+session is active, so the server pays nothing for the hooks.
+
+"""
+
+import cProfile
+import collections
+import json
+import logging
+import os
+import pickle
+import socket
+import sys
+import threading
+import time
+
+from . import eventloop
+from .server import LoggingChannel, StrictDispatcher
+
+# (name, owner, attribute) of the callables timed by TIME
+STAGES = (
+    ('dispatch_read', LoggingChannel, 'dispatch_read'),
+    ('pickle.loads', pickle, 'loads'),
+    ('makeLogRecord', logging, 'makeLogRecord'),
+    ('emit', LoggingChannel, 'deliver'),
+)
+
+
+def collapse(frame):
+    """
+    Return the stack ending at `frame` as a ';'-separated line.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s (%s:%d)' % (code.co_name,
+                                     os.path.basename(code.co_filename),
+                                     code.co_firstlineno))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Histogram:
+
+    """
+    Durations bucketed by powers of two of microseconds.
+    """
+
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[int(seconds * 1e6).bit_length()] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def report(self):
+        return {'count': self.count,
+                'total': self.total,
+                'max': self.max,
+                # Keyed on each bucket's (exclusive) upper bound
+                'buckets': {'<%dus' % (1 << bucket): n
+                            for bucket, n in sorted(self.buckets.items())}}
+
+
+class Session:
+
+    """
+    A profiling session writing its results to `path` when stopped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def start(self):
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+
+class SamplingSession(Session):
+
+    """
+    Samples the stack of the thread `thread_id` from a background thread.
+    """
+
+    def __init__(self, path, thread_id, interval):
+        super().__init__(path)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='logserv-sampler')
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.counts[collapse(frame)] += 1
+            del frame
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+        with open(self.path, 'w') as f:
+            for stack, count in self.counts.most_common():
+                f.write('%s %d\n' % (stack, count))
+
+
+class ProfileSession(Session):
+
+    """
+    Runs `cProfile` on the thread calling `start` and `stop`.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.profile.dump_stats(self.path)
+
+
+class TimingSession(Session):
+
+    """
+    Wraps each of the `stages` to record its durations.
+    """
+
+    def __init__(self, path, stages=STAGES):
+        super().__init__(path)
+        self.stages = stages
+        self.histograms = {name: Histogram() for name, _, _ in stages}
+        self.originals = []
+
+    @staticmethod
+    def timed(func, histogram):
+        perf_counter = time.perf_counter
+
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.add(perf_counter() - start)
+        return timed
+
+    def start(self):
+        for name, owner, attr in self.stages:
+            original = owner.__dict__[attr]
+            self.originals.append((owner, attr, original))
+            setattr(owner, attr, self.timed(original, self.histograms[name]))
+
+    def stop(self):
+        while self.originals:
+            owner, attr, original = self.originals.pop()
+            setattr(owner, attr, original)
+        with open(self.path, 'w') as f:
+            json.dump({name: histogram.report()
+                       for name, histogram in self.histograms.items()},
+                      f, indent=2)
+
+
+class AdminChannel(StrictDispatcher):
+
+    """
+    A connection to the admin socket, reading one command per line.
+    """
+
+    max_line_length = 10240
+
+    def __init__(self, sock, map, server):
+        super().__init__(sock, map)
+        self.server = server
+        self.read_buf = b''
+        self.write_buf = b''
+
+    def writable(self):
+        return bool(self.write_buf)
+
+    def handle_write(self):
+        sent = self.send(self.write_buf)
+        self.write_buf = self.write_buf[sent:]
+        if not self.write_buf:
+            self.interest_changed()
+
+    def handle_read(self):
+        self.read_buf += self.recv(4096)
+        while b'\n' in self.read_buf:
+            line, self.read_buf = self.read_buf.split(b'\n', 1)
+            self.reply(self.server.command(line.decode('UTF-8', 'replace')))
+        if len(self.read_buf) > self.max_line_length:
+            self.reply('ERROR line too long')
+            self.read_buf = b''
+
+    def reply(self, text):
+        was_empty = not self.write_buf
+        self.write_buf += (text + '\n').encode('UTF-8')
+        if was_empty:
+            self.interest_changed()
+
+
+class AdminServer(StrictDispatcher):
+
+    """
+    The admin socket of the server whose loop runs on `loop_thread` (by
+    default, the thread creating the admin server) over `map`.
+    """
+
+    channel_class = AdminChannel
+    max_duration = 300
+    sample_interval = 0.005
+    session_classes = {
+        'SAMPLE': SamplingSession,
+        'PROFILE': ProfileSession,
+        'TIME': TimingSession,
+    }
+
+    def __init__(self, socket_path, map, loop_thread=None):
+        super().__init__(map=map)
+        self.loop_thread = (threading.get_ident() if loop_thread is None
+                            else loop_thread)
+        self.session = None
+        self.command_name = None
+        self.timer = None
+        self.last_error = None
+        self.waker = eventloop.Waker(map)
+        try:
+            self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            # Only the owner may connect. Linux creates the socket file
+            # with the socket's own mode, so it is never open to others;
+            # the umask, which is per process, is left alone
+            try:
+                os.fchmod(self.socket.fileno(), 0o600)
+            except OSError:  # pragma: no cover
+                pass
+            self.bind(socket_path)
+            os.chmod(socket_path, 0o600)
+            self.listen(1)
+        except:  # pragma: no cover
+            self.close()
+            raise
+
+    def handle_accepted(self, conn, addr):
+        self.channel_class(conn, self._map, self)
+
+    def command(self, line):
+        """
+        Run the command `line` and return the reply.
+        """
+        words = line.split(' ', 2)
+        name = words[0]
+        if name == 'STATUS' and len(words) == 1:
+            if self.session is None:
+                if self.last_error is not None:
+                    return 'OK IDLE (last session failed: %s)' % (
+                        self.last_error)
+                return 'OK IDLE'
+            return 'OK %s %s' % (self.command_name, self.session.path)
+        if name == 'STOP' and len(words) == 1:
+            if self.session is None:
+                return 'ERROR no session running'
+            self.stop_session()
+            if self.last_error is not None:
+                return 'ERROR %s' % self.last_error
+            return 'OK'
+        if name not in self.session_classes or len(words) != 3:
+            return ('ERROR expected one of SAMPLE, PROFILE or TIME '
+                    '<seconds> <path>, STOP or STATUS')
+        if self.session is not None:
+            return 'ERROR a %s session is running' % self.command_name
+        try:
+            duration = float(words[1])
+        except ValueError:
+            return 'ERROR bad duration %r' % words[1]
+        if not 0 < duration <= self.max_duration:
+            return 'ERROR duration must be in (0, %s]' % self.max_duration
+        try:
+            self.start_session(name, words[2], duration)
+        except Exception as err:
+            return 'ERROR %s' % err
+        return 'OK'
+
+    def start_session(self, name, path, duration):
+        # Fail now rather than when the results are due
+        open(path, 'a').close()
+        cls = self.session_classes[name]
+        if cls is SamplingSession:
+            session = cls(path, self.loop_thread, self.sample_interval)
+        else:
+            session = cls(path)
+        session.start()
+        self.session, self.command_name = session, name
+        self.last_error = None
+        self.timer = threading.Timer(duration, self.waker.call,
+                                     (self.stop_session, session))
+        self.timer.daemon = True
+        self.timer.start()
+
+    def stop_session(self, session=None):
+        """
+        Stop the running `session` (any running session by default) and
+        write its results. Runs on the loop thread.
+        """
+        if self.session is None or session not in (None, self.session):
+            return
+        session, self.session = self.session, None
+        self.timer.cancel()
+        try:
+            session.stop()
+        except OSError as err:
+            # Keep the waker alive; the error is reported by STATUS
+            self.last_error = str(err)
+
+    def close(self):
+        super().close()
+        if self.session is not None:
+            self.stop_session()
+        self.waker.close()
@@ -0,0 +1,52 @@
+"""
+A shared pool of receive buffers.
+
+Channels only need a receive buffer while a message is partially received;
+an idle connection holds none. Buffers are bytearrays whose sizes are powers
+of two, so that a buffer released by one channel can be reused by any
+other channel receiving a message of similar size.
+
+"""
+
+
+class BufferPool:
+
+    """
+    A free list of bytearrays, bucketed by size.
+
+    Buffers larger than `max_size` are handed out but not kept once
+    released, and at most `max_free` buffers are kept per size.
+
+    """
+
+    min_size = 1024
+    max_size = 1 << 20
+    max_free = 64
+
+    def __init__(self, min_size=None, max_size=None, max_free=None):
+        if min_size is not None:
+            self.min_size = min_size
+        if max_size is not None:
+            self.max_size = max_size
+        if max_free is not None:
+            self.max_free = max_free
+        self.free = {}
+
+    def acquire(self, size):
+        """
+        Return a bytearray of at least `size` bytes.
+        """
+        size = max(size, self.min_size)
+        size = 1 << (size - 1).bit_length()
+        free = self.free.get(size)
+        if free:
+            return free.pop()
+        return bytearray(size)
+
+    def release(self, buf):
+        size = len(buf)
+        if size > self.max_size:
+            return
+        free = self.free.setdefault(size, [])
+        if len(free) < self.max_free:
+            free.append(buf)
@@ -1,10 +1,20 @@
+import asyncio
+import collections
+import hashlib
 import json
 import logging
 import logging.handlers
+import os
+import pickle
 import socket
+import struct
+import threading
 import time
+import weakref
 
-from . import ProtocolError, VersionMismatchError
+from . import (EXC_CACHE_BYTES, FIELD_DICTIONARY, ProtocolError,
+               VersionMismatchError)
+from .ring import Ring
 
 _REVERSE_STYLES = {
     logging.PercentStyle: '%',
@@ -13,6 +23,29 @@ _REVERSE_STYLES = {
 }
 
 
+def format_params(formatter):
+    """
+    Return the FORMAT parameters describing `formatter`.
+    """
+    return {
+        "fmt": formatter._style._fmt,
+        "datefmt": formatter.datefmt,
+        "style": _REVERSE_STYLES[formatter._style.__class__],
+    }
+
+# Every forwarder, so that children can drop the sockets they inherit
+_forwarders = weakref.WeakSet()
+
+
+def _after_fork():
+    for forwarder in list(_forwarders):
+        forwarder.forked()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
 class SocketForwarder(logging.handlers.SocketHandler):
 
     """
@@ -23,19 +56,49 @@ class SocketForwarder(logging.handlers.SocketHandler):
 
     All of the IO is performed blockingly, like in the parent class.
 
+    A child process never uses the connection it inherits from its parent:
+    the socket is dropped right after the fork, and the child's first
+    record starts a new connection on a background thread (see `warmUp`)
+    instead of waiting for it. With `warm_up_after_fork` set, the child
+    starts connecting as soon as it is forked.
+
+    With `exc_cache_size` set, a traceback already sent over the connection
+    is not sent again: the record carries a hash of it instead, which the
+    server resolves from the last `exc_cache_size` tracebacks it was sent.
+    Likewise, with `field_dictionary_size` set, the first
+    `field_dictionary_size` distinct logger, path, function, process and
+    thread names are numbered, and sent as their numbers after their first
+    use.
+
     """
 
     version_str = "1.0"
     max_line_length = 10240
+    warm_up_after_fork = False
+    # Records kept while warming up; any more are dropped
+    max_backlog = 1000
+    # Tracebacks remembered by both ends of a connection (0 to disable)
+    exc_cache_size = 0
+    # Strings numbered by both ends of a connection (0 to disable)
+    field_dictionary_size = 0
 
     def __init__(self, host, port, timeout=None, **kwargs):
         self.shook_hands = False
         self.kwargs = kwargs
+        self.backlog = None
+        self.dropped = 0
+        self.exc_cache = None
+        # The total size of the tracebacks in `exc_cache`
+        self.exc_cache_bytes = 0
+        self.field_ids = None
+        # Forked, and not connecting yet
+        self.warm_up_pending = False
         if timeout is None:
             self.timeout = socket.getdefaulttimeout()
         else:
             self.timeout = timeout
         super().__init__(host, port)
+        _forwarders.add(self)
 
     def createSocket(self):
         """
@@ -44,6 +107,127 @@ class SocketForwarder(logging.handlers.SocketHandler):
         super().createSocket()
         self.doHandshake()
 
+    def forked(self):
+        """
+        Forget the connection inherited from the parent process.
+        """
+        sock, self.sock = self.sock, None
+        if sock is not None:
+            # Only our copy of the descriptor; the parent's stays connected
+            sock.close()
+        self.shook_hands = False
+        self.retryTime = None
+        self.backlog = None
+        self.exc_cache = None
+        self.exc_cache_bytes = 0
+        self.field_ids = None
+        if self.warm_up_after_fork:
+            self.warmUp()
+        else:
+            # Not from the fork hook, but not on the request path either
+            self.warm_up_pending = True
+
+    def warmUp(self):
+        """
+        Connect and shake hands on a background thread.
+
+        Records emitted in the meantime are kept (up to `max_backlog`) and
+        sent once the handshake is done, so logging never waits for the
+        connection to be set up.
+
+        """
+        self.acquire()
+        try:
+            if self.backlog is not None or self.sock is not None:
+                return
+            self.backlog = []
+        finally:
+            self.release()
+        threading.Thread(target=self._warm_up, daemon=True,
+                         name='logserv-warm-up').start()
+
+    def _warm_up(self):
+        try:
+            self.createSocket()
+        except Exception:
+            # Leave it to the next record to try again
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+        self.acquire()
+        try:
+            backlog, self.backlog = self.backlog, None
+            for s in backlog or ():
+                self.send(s)
+        finally:
+            self.release()
+
+    def emit(self, record):
+        if self.warm_up_pending:
+            self.warm_up_pending = False
+            self.warmUp()
+        if self.backlog is None:
+            super().emit(record)
+        elif len(self.backlog) < self.max_backlog:
+            try:
+                self.backlog.append(self.makePickle(record))
+            except Exception:
+                self.handleError(record)
+        else:
+            self.dropped += 1
+
+    def makePickle(self, record):
+        # Only refer to what was sent over the connection we are sure to be
+        # sending this record on
+        if ((self.exc_cache is None and self.field_ids is None)
+                or self.sock is None or self.backlog is not None):
+            return super().makePickle(record)
+        if record.exc_info:
+            self.format(record)
+        d = dict(record.__dict__)
+        d['msg'] = record.getMessage()
+        d['args'] = None
+        d['exc_info'] = None
+        d.pop('message', None)
+        if self.exc_cache is not None and d.get('exc_text'):
+            self.encode_exc(d)
+        if self.field_ids is not None:
+            self.encode_fields(d)
+        s = pickle.dumps(d, 1)
+        return struct.pack('>L', len(s)) + s
+
+    def encode_exc(self, d):
+        data = d['exc_text'].encode('UTF-8', 'surrogatepass')
+        if len(data) > EXC_CACHE_BYTES:
+            return  # too big to remember; sent in full every time
+        ref = hashlib.blake2b(data, digest_size=16).digest()
+        d['exc_ref'] = ref
+        # Mirror the server's LRU order exactly, keeping the texts' sizes
+        cache = self.exc_cache
+        if ref in cache:
+            cache.move_to_end(ref)
+            d['exc_text'] = None
+        else:
+            cache[ref] = len(data)
+            self.exc_cache_bytes += len(data)
+            while (len(cache) > self.exc_cache_size
+                   or self.exc_cache_bytes > EXC_CACHE_BYTES):
+                self.exc_cache_bytes -= cache.popitem(last=False)[1]
+
+    def encode_fields(self, d):
+        # Both ends number the strings in the order they are first seen
+        ids = self.field_ids
+        for field in FIELD_DICTIONARY:
+            value = d.get(field)
+            if value.__class__ is not str:
+                continue
+            field_id = ids.get(value)
+            if field_id is not None:
+                d[field] = field_id
+            elif len(ids) < self.field_dictionary_size:
+                field_id = ids[value] = len(ids)
+                d[field] = (field_id, value)
+
     def sendtext(self, data):
         if isinstance(data, str):
             data = data.encode('UTF-8')
@@ -75,6 +259,11 @@ class SocketForwarder(logging.handlers.SocketHandler):
         return resp
 
     def doHandshake(self):
+        # A new connection: the server remembers nothing yet
+        self.exc_cache = (collections.OrderedDict() if self.exc_cache_size
+                          else None)
+        self.exc_cache_bytes = 0
+        self.field_ids = {} if self.field_dictionary_size else None
         self.sendtext('HELLO %s\n' % self.version_str)
         resp = self.recv_line()
         if not resp.startswith('HELLO '):
@@ -83,28 +272,32 @@ class SocketForwarder(logging.handlers.SocketHandler):
             raise VersionMismatchError("Handler does not support version %s",
                                        resp[6:],)
         params = {'--level': self.level}
+        if self.exc_cache_size:
+            params['--exc-cache'] = self.exc_cache_size
+        if self.field_dictionary_size:
+            params['--field-dictionary'] = self.field_dictionary_size
         params.update(self.kwargs)
         param_json = json.dumps(params) + '\n'
         self.sendtext('IDENTIFY %s' % param_json)
         resp = self.recv_line()
         if resp != 'OK\n':
             raise ProtocolError("'OK\n'", resp)
+        self.requestLog()
+        self.shook_hands = True
+
+    def requestLog(self):
+        """
+        Perform the final step of the handshake.
+        """
         self.sendtext('LOG\n')
         resp = self.recv_line()
         if resp != 'OK\n':
             raise ProtocolError("'OK\n'", resp)
-        self.shook_hands = True
 
     def sendFormat(self):
-        style = _REVERSE_STYLES[self.formatter._style.__class__]
-        fmt = self.formatter._style._fmt
-        data = {
-            "fmt": fmt,
-            "datefmt": self.formatter.datefmt,
-            "style": style,
-        }
         self.send(b'\x00\x00\x00\x00')
-        self.sendtext(json.dumps(data))
+        self.sendtext('FORMAT %s\n' % json.dumps(
+            format_params(self.formatter)))
 
 
 class UnixClient(SocketForwarder):
@@ -129,3 +322,497 @@ class UnixClient(SocketForwarder):
         s.settimeout(timeout)
         s.connect(self.host)
         return s
+
+
+class SeqPacketClient(UnixClient):
+
+    """
+    A `UnixClient` using a `SOCK_SEQPACKET` socket, for use with
+    `server.SeqPacketServer`.
+
+    Every record is sent as a single packet, so the server receives it with
+    a single `recv`.
+
+    """
+
+    def makeSocket(self, timeout=1):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        s.settimeout(timeout)
+        s.connect(self.host)
+        return s
+
+
+class RingClient(UnixClient):
+
+    """
+    A `UnixClient` that writes its records into a shared-memory ring.
+
+    The ring is created during the handshake and read by a
+    `server.RingServer`. Emitting a record only costs a system call when
+    the ring was empty, to wake the server up. If the ring is full, the
+    client waits for the server to make room for up to `timeout` seconds
+    (one second if no timeout is set).
+
+    """
+
+    ring_size = 1 << 20
+    # The longest sleep between checks for room in a full ring
+    max_pause = 0.01
+
+    def __init__(self, host, port=None, timeout=None, **kwargs):
+        self.ring = None
+        super().__init__(host, port, timeout, **kwargs)
+
+    def requestLog(self):
+        ring = Ring.create(self.ring_size)
+        try:
+            self.sendtext('RING %s\n' % ring.name)
+            resp = self.recv_line()
+            if resp != 'OK\n':
+                raise ProtocolError("'OK\n'", resp)
+        except:
+            ring.close()
+            raise
+        # From here on the socket only carries wakeups, which must never
+        # hold up the thread logging the record
+        self.sock.setblocking(False)
+        self.ring = ring
+
+    def send(self, s):
+        if self.sock is None:
+            self.createSocket()
+        if self.ring is None:
+            # Still shaking hands, or the connection could not be made
+            return super().send(s)
+        written, was_empty = self.ring.write(s)
+        if not written:
+            self.wait_for_room(s)
+        elif was_empty:
+            self.wake()
+
+    def forked(self):
+        if self.ring is not None:
+            # The ring belongs to the parent: detach without unlinking it
+            self.ring.owner = False
+            self.ring.close()
+            self.ring = None
+        super().forked()
+
+    def wake(self):
+        try:
+            self.sock.send(b'\x00')
+        except BlockingIOError:
+            pass  # unread wakeups are already waiting
+        except OSError:
+            # The server is gone; reconnect on the next record
+            self.closeRing()
+
+    def wait_for_room(self, s):
+        if len(s) > self.ring.capacity:
+            raise ValueError("record of %d bytes does not fit in the ring" %
+                             len(s))
+        deadline = time.time() + (1 if self.timeout is None
+                                  else self.timeout)
+        # The server keeps draining a non-empty ring once woken, so one
+        # wakeup is enough however long we wait
+        self.wake()
+        pause = 0.0005
+        while True:
+            if self.ring is None:
+                raise ConnectionError("the log server went away")
+            written, _ = self.ring.write(s)
+            if written:
+                return
+            if time.time() > deadline:
+                raise socket.timeout("ring full")
+            time.sleep(pause)
+            pause = min(pause * 2, self.max_pause)
+
+    def closeRing(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def close(self):
+        self.acquire()
+        try:
+            self.closeRing()
+        finally:
+            self.release()
+        super().close()
+
+
+class Multiplexer(SocketForwarder):
+
+    """
+    One connection to a log server carrying the records of several handlers.
+
+    Each handler returned by `stream` is identified to the server over this
+    connection with its own parameters, as if it were a `SocketForwarder`.
+    A record accepted by several streams of the same multiplexer is sent
+    once, tagged with the set of streams it is for.
+
+    To find that set, the first stream to emit a record walks the handlers
+    of the record's logger and its ancestors, the way `Logger.callHandlers`
+    does, checking the level and filters of the other streams; those then
+    skip the record when their turn comes. A stream used in any other way
+    (say, called directly by a `QueueListener`) sends the record for itself
+    alone, and a stream not in the set of the record's last send sends it
+    again.
+
+    """
+
+    max_streams = 64
+    _BITMAP_HEADER = struct.Struct('>LQ')
+
+    def __init__(self, host, port, timeout=None):
+        self.streams = []
+        self.local = threading.local()
+        super().__init__(host, port, timeout, **{'--multiplex': {}})
+
+    def stream(self, level=logging.NOTSET, **kwargs):
+        """
+        Return a new handler whose records go to a handler created on the
+        server with `kwargs`.
+        """
+        self.acquire()
+        try:
+            if len(self.streams) >= self.max_streams:
+                raise ValueError("a multiplexer carries at most %d streams" %
+                                 self.max_streams)
+            stream = MultiplexedStream(self, len(self.streams), level, kwargs)
+            self.streams.append(stream)
+            if self.sock is not None:
+                self.declare(stream)
+        finally:
+            self.release()
+        return stream
+
+    def createSocket(self):
+        # Only shake hands once connected, and declare the streams anew
+        logging.handlers.SocketHandler.createSocket(self)
+        if self.sock is None:
+            return
+        try:
+            self.doHandshake()
+            for stream in self.streams:
+                self.declare(stream)
+        except:
+            self.sock.close()
+            self.sock = None
+            raise
+
+    def declare(self, stream):
+        """
+        Identify `stream` to the server.
+        """
+        spec = dict(stream.kwargs)
+        # Levels are checked here, since they may change at any time
+        spec['--level'] = logging.NOTSET
+        if stream.formatter is not None:
+            spec['--format'] = format_params(stream.formatter)
+        self.sock.sendall(b'\x00\x00\x00\x00' + ('ROUTE %d %s\n' % (
+            stream.index, json.dumps(spec))).encode('UTF-8'))
+        resp = self.recv_line()
+        if resp != 'OK\n':
+            raise ProtocolError("'OK\n'", resp)
+
+    def redeclare(self, stream):
+        self.acquire()
+        try:
+            if self.sock is not None:
+                self.declare(stream)
+        except (OSError, ProtocolError):
+            # Reconnecting declares the stream again
+            self.sock.close()
+            self.sock = None
+        finally:
+            self.release()
+
+    def streams_for(self, record, origin):
+        """
+        Return the bitmap of the streams that will handle `record`, given
+        that `origin` is the first of them.
+        """
+        name = record.name
+        logger = (logging.getLogger(name) if name != 'root'
+                  else logging.getLogger())
+        bits = 0
+        found = False
+        while logger is not None:
+            for handler in logger.handlers:
+                if (not isinstance(handler, MultiplexedStream)
+                        or handler.connection is not self):
+                    continue
+                if handler is origin:
+                    found = True
+                elif (record.levelno >= handler.level
+                      and handler.filter(record)):
+                    bits |= 1 << handler.index
+            if not logger.propagate:
+                break
+            logger = logger.parent
+        if not found:
+            return 1 << origin.index
+        return bits | 1 << origin.index
+
+    def submit(self, record, origin):
+        """
+        Send `record` for `origin` and the streams after it, unless one of
+        the streams before it already has sent it for `origin` too.
+        """
+        # The last record this thread sent, and the streams it was for
+        last, bits = getattr(self.local, 'sent', (None, 0))
+        if last is record and bits >> origin.index & 1:
+            return
+        self.acquire()
+        try:
+            data = self.makePickle(record)
+            bits = self.streams_for(record, origin)
+            self.local.sent = (record, bits)
+            self.send(self._BITMAP_HEADER.pack(len(data) + 4, bits) +
+                      data[4:])
+        finally:
+            self.release()
+
+
+class UnixMultiplexer(Multiplexer, UnixClient):
+
+    """
+    A `Multiplexer` connecting through a Unix Domain Socket.
+    """
+
+    def __init__(self, host, port=None, timeout=None):
+        super().__init__(host, port, timeout)
+
+
+class MultiplexedStream(logging.Handler):
+
+    """
+    A handler sending its records over a `Multiplexer`.
+    """
+
+    def __init__(self, connection, index, level, kwargs):
+        super().__init__(level)
+        self.connection = connection
+        self.index = index
+        self.kwargs = kwargs
+
+    def setFormatter(self, fmt):
+        super().setFormatter(fmt)
+        self.connection.redeclare(self)
+
+    def emit(self, record):
+        try:
+            self.connection.submit(record, self)
+        except Exception:
+            self.handleError(record)
+
+
+class AsyncForwarder(logging.Handler):
+
+    """
+    A handler for asyncio applications, talking to a log server without
+    ever blocking the event loop.
+
+    `emit` only pickles the record and appends it to a buffer; a task on
+    the loop connects, performs the handshake and writes the buffer out in
+    batches over `asyncio` streams. The loop is the one running when the
+    handler is first used from it (or the `loop` given). Records emitted
+    from other threads are buffered the same way, and the loop is woken up
+    with `call_soon_threadsafe`.
+
+    While the server cannot be reached, records are kept, up to
+    `max_buffer` of them, and the connection is retried with an
+    exponential backoff like `SocketHandler`'s. Records beyond
+    `max_buffer`, and those of a batch whose write failed, are dropped and
+    counted in `dropped`.
+
+    Any extra keyword parameters are passed on to the handler on the other
+    end of the socket. Await `aclose` to send the buffered records before
+    closing; `close` drops them.
+
+    """
+
+    version_str = "1.0"
+    max_line_length = 10240
+    max_buffer = 10000
+    retry_start = 1.0
+    retry_factor = 2.0
+    retry_max = 30.0
+    # Records pickled the same way as by `SocketHandler`
+    makePickle = logging.handlers.SocketHandler.makePickle
+
+    def __init__(self, host, port, timeout=None, loop=None, **kwargs):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.loop = loop
+        self.kwargs = kwargs
+        self.buffer = collections.deque()
+        self.dropped = 0
+        self.task = None
+        self.writer = None
+        self.retry_delay = None
+        self.closed = False
+
+    def emit(self, record):
+        if self.closed:
+            return
+        try:
+            frame = self.makePickle(record)
+        except Exception:
+            self.handleError(record)
+            return
+        if len(self.buffer) >= self.max_buffer:
+            self.dropped += 1
+            return
+        self.buffer.append(frame)
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is not None and self.loop in (None, running):
+            self.loop = running
+            self.wake()
+        elif self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self.wake)
+            except RuntimeError:
+                pass  # the loop is closed; nothing will be sent
+
+    def wake(self):
+        """
+        Make sure the task sending the buffer is running. Loop thread only.
+        """
+        if not self.closed and (self.task is None or self.task.done()):
+            self.task = self.loop.create_task(self.run())
+
+    async def open_connection(self):
+        return await asyncio.open_connection(
+            self.host, self.port, limit=self.max_line_length)
+
+    async def read_line(self, reader):
+        try:
+            line = await reader.readline()
+        except ValueError:
+            raise ProtocolError("a line of length < %d" %
+                                self.max_line_length, "too many bytes")
+        if not line.endswith(b'\n'):
+            raise ProtocolError("a newline-terminated message", line)
+        try:
+            return line.decode('UTF-8')
+        except UnicodeDecodeError:
+            raise ProtocolError("a UTF-8 encoded message", line)
+
+    async def handshake(self):
+        """
+        Connect, and perform the handshake of `SocketForwarder.doHandshake`.
+        """
+        reader, writer = await self.open_connection()
+        try:
+            writer.write(('HELLO %s\n' % self.version_str).encode('UTF-8'))
+            resp = await self.read_line(reader)
+            if not resp.startswith('HELLO '):
+                raise ProtocolError('"HELLO <version>\n"', resp)
+            elif resp[6:] != '1.0\n':
+                raise VersionMismatchError(
+                    "Handler does not support version %s", resp[6:])
+            params = {'--level': self.level}
+            if self.formatter is not None:
+                params['--format'] = format_params(self.formatter)
+            params.update(self.kwargs)
+            writer.write(('IDENTIFY %s\n' % json.dumps(params)).encode(
+                'UTF-8'))
+            resp = await self.read_line(reader)
+            if resp != 'OK\n':
+                raise ProtocolError("'OK\n'", resp)
+            writer.write(b'LOG\n')
+            resp = await self.read_line(reader)
+            if resp != 'OK\n':
+                raise ProtocolError("'OK\n'", resp)
+        except:
+            writer.close()
+            raise
+        return writer
+
+    async def run(self):
+        while self.buffer and not self.closed:
+            if self.writer is None:
+                try:
+                    self.writer = await asyncio.wait_for(self.handshake(),
+                                                         self.timeout)
+                except (OSError, asyncio.TimeoutError, ProtocolError,
+                        VersionMismatchError):
+                    await asyncio.sleep(self.next_retry())
+                    continue
+                self.retry_delay = None
+            # Other threads may append while we take the batch
+            batch = []
+            while self.buffer:
+                batch.append(self.buffer.popleft())
+            try:
+                self.writer.write(b''.join(batch))
+                await asyncio.wait_for(self.writer.drain(), self.timeout)
+            except (OSError, asyncio.TimeoutError):
+                self.dropped += len(batch)
+                self.drop_connection()
+
+    def next_retry(self):
+        if self.retry_delay is None:
+            self.retry_delay = self.retry_start
+        else:
+            self.retry_delay = min(self.retry_delay * self.retry_factor,
+                                   self.retry_max)
+        return self.retry_delay
+
+    def drop_connection(self):
+        writer, self.writer = self.writer, None
+        if writer is not None:
+            writer.close()
+
+    async def aclose(self, timeout=None):
+        """
+        Send the buffered records (waiting at most `timeout` seconds), then
+        close the connection and the handler.
+        """
+        if self.task is not None and not self.task.done():
+            try:
+                await asyncio.wait_for(asyncio.shield(self.task), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self.close()
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+    def close(self):
+        self.closed = True
+        self.buffer.clear()
+        writer, self.writer = self.writer, None
+        if writer is not None and self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(writer.close)
+            except RuntimeError:
+                pass  # the loop is closed, and the transport with it
+        super().close()
+
+
+class AsyncUnixForwarder(AsyncForwarder):
+
+    """
+    An `AsyncForwarder` connecting through a Unix Domain Socket at the path
+    `host`.
+    """
+
+    def __init__(self, host, port=None, timeout=None, loop=None, **kwargs):
+        if port is not None:
+            raise TypeError("port must be None for an AsyncUnixForwarder")
+        super().__init__(host, port, timeout, loop, **kwargs)
+
+    async def open_connection(self):
+        return await asyncio.open_unix_connection(
+            self.host, limit=self.max_line_length)
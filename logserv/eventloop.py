@@ -0,0 +1,211 @@
+"""
+A selector-based replacement for `asyncore.loop`.
+
+`asyncore.loop` rebuilds its descriptor sets from the socket map on every
+iteration, calling `readable()` and `writable()` on every dispatcher in the
+map. With thousands of mostly idle connections that is a lot of work for
+very few events.
+
+`SelectorMap` is a socket map that keeps a selector (epoll where the
+platform has it) in sync with its contents instead. Dispatchers are
+registered once when they are added to the map, and their registration is
+only modified when they call `StrictDispatcher.interest_changed`, so idle
+connections cost nothing per iteration:
+
+    from logserv import eventloop, server
+    server.LogServer.logging_map = eventloop.SelectorMap()
+    s = server.LogServer(("localhost", 9876))
+    eventloop.loop(server.LogServer.logging_map)
+
+"""
+
+import asyncore
+import collections
+import os
+import selectors
+import time
+
+DefaultSelector = getattr(selectors, 'EpollSelector',
+                          selectors.DefaultSelector)
+
+
+def interest(obj):
+    """
+    Return the selector events `obj` currently wants to be notified of.
+    """
+    events = 0
+    if obj.readable():
+        events |= selectors.EVENT_READ
+    # accepting sockets should not be writable
+    if obj.writable() and not obj.accepting:
+        events |= selectors.EVENT_WRITE
+    return events
+
+
+class SelectorMap(dict):
+
+    """
+    A socket map that mirrors its contents into a selector.
+
+    Dispatchers added to the map are registered lazily, at the start of the
+    next `poll`, so that they have finished initializing by the time their
+    `readable()` and `writable()` methods are consulted.
+
+    """
+
+    selector_class = DefaultSelector
+
+    def __init__(self, selector=None):
+        super().__init__()
+        if selector is None:
+            selector = self.selector_class()
+        self.selector = selector
+        self._pending = set()
+
+    def __setitem__(self, fd, obj):
+        if fd in self:
+            self._unregister(fd)
+        super().__setitem__(fd, obj)
+        self._pending.add(fd)
+
+    def __delitem__(self, fd):
+        self._unregister(fd)
+        super().__delitem__(fd)
+
+    def pop(self, fd, *default):
+        if fd in self:
+            self._unregister(fd)
+        return super().pop(fd, *default)
+
+    def clear(self):
+        for fd in list(self):
+            self._unregister(fd)
+        super().clear()
+
+    def _unregister(self, fd):
+        self._pending.discard(fd)
+        if self.selector.get_map().get(fd) is not None:
+            self.selector.unregister(fd)
+
+    def update_interest(self, obj):
+        """
+        Bring the registration of `obj` in line with its current interest.
+        """
+        fd = obj._fileno
+        if fd is None or self.get(fd) is not obj or fd in self._pending:
+            return
+        events = interest(obj)
+        key = self.selector.get_map().get(fd)
+        if key is None:
+            if events:
+                self.selector.register(fd, events, obj)
+        elif not events:
+            self.selector.unregister(fd)
+        elif key.events != events:
+            self.selector.modify(fd, events, obj)
+
+    def poll(self, timeout=0.0):
+        """
+        Wait up to `timeout` seconds for events and dispatch them.
+        """
+        pending, self._pending = self._pending, set()
+        for fd in pending:
+            self.update_interest(self[fd])
+        if not self.selector.get_map():
+            time.sleep(timeout)
+            return
+        for key, mask in self.selector.select(timeout):
+            obj = key.data
+            # An earlier handler in this batch may have closed `obj`
+            if mask & selectors.EVENT_READ and self.get(key.fd) is obj:
+                asyncore.read(obj)
+            if mask & selectors.EVENT_WRITE and self.get(key.fd) is obj:
+                asyncore.write(obj)
+
+    def close(self):
+        self.selector.close()
+
+
+def loop(map, timeout=30.0, count=None, scheduler=None, timers=None):
+    """
+    Run the event loop over `map`, like `asyncore.loop`.
+
+    `map` is normally a `SelectorMap`; a plain dict falls back to
+    `asyncore.poll`. If a `scheduler.FairScheduler` is given, each
+    iteration is one of its rounds. If a `timers.TimerWheel` is given, it
+    is advanced after each poll, which waits no longer than its next tick.
+
+    """
+    poll = getattr(map, 'poll', None)
+    if poll is None:
+        def poll(timeout):
+            asyncore.poll(timeout, map)
+
+    def iterate():
+        wait = timeout
+        if timers is not None:
+            tick = timers.next_timeout()
+            if tick is not None and tick < wait:
+                wait = tick
+        if scheduler is None:
+            poll(wait)
+        else:
+            # Throttled channels are owed budget as soon as this round ends
+            poll(0 if scheduler.throttled else wait)
+            scheduler.new_round()
+        if timers is not None:
+            timers.advance()
+
+    if count is None:
+        while map:
+            iterate()
+    else:
+        while map and count > 0:
+            iterate()
+            count -= 1
+
+
+class Waker(asyncore.file_dispatcher):
+
+    """
+    Runs callbacks on the loop thread on behalf of other threads.
+
+    `call` may be used from any thread; the callback runs the next time the
+    loop services the waker's pipe, which `call` also makes readable so
+    that a sleeping loop wakes up immediately.
+
+    """
+
+    def __init__(self, map=None):
+        rfd, self._wfd = os.pipe()
+        os.set_blocking(self._wfd, False)
+        try:
+            super().__init__(rfd, map)
+        finally:
+            os.close(rfd)  # file_dispatcher keeps a dup of it
+        self.callbacks = collections.deque()
+
+    def call(self, func, *args):
+        self.callbacks.append((func, args))
+        try:
+            os.write(self._wfd, b'\x00')
+        except BlockingIOError:  # pragma: no cover
+            pass  # the pipe is full, so the loop is bound to wake anyway
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except BlockingIOError:  # pragma: no cover
+            pass
+        while self.callbacks:
+            func, args = self.callbacks.popleft()
+            func(*args)
+
+    def close(self):
+        super().close()
+        if self._wfd is not None:
+            os.close(self._wfd)
+            self._wfd = None
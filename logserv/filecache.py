@@ -0,0 +1,135 @@
+"""
+A cap on the number of log files the server keeps open.
+
+Each IDENTIFY may name a file of its own, so a server with many tenants can
+end up with a handler, and an open file, per tenant, and run into
+`RLIMIT_NOFILE`. Handlers using the `CachedFiles` mixin share a `FileCache`
+that keeps at most `max_open` of their files open: after each record, the
+files least recently written to beyond the cap are closed. A closed
+handler reopens its file, in append mode, when its next record arrives;
+since the size of a rotating file is read from the reopened file, rotation
+carries on where it left off.
+
+    from logserv import filecache, server
+    server.LoggingChannel.handler_class = filecache.CachedRotatingFileHandler
+    filecache.CachedFiles.file_cache.max_open = 1000
+
+`FileCache.report()` returns the number of open files along with the
+hit, miss and eviction counters.
+
+"""
+
+import collections
+import threading
+from logging.handlers import RotatingFileHandler
+
+
+class FileCache:
+
+    """
+    Keeps at most `max_open` of its handlers' files open, closing the least
+    recently used ones.
+    """
+
+    def __init__(self, max_open=1000):
+        if max_open < 1:
+            raise ValueError("max_open must be at least 1")
+        self.max_open = max_open
+        # Handlers with an open file, least recently used first
+        self.open = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, handler):
+        with self.lock:
+            return handler in self.open
+
+    def __len__(self):
+        return len(self.open)
+
+    def touch(self, handler, hit):
+        """
+        Record a use of `handler`'s file, which was already open if `hit`,
+        and close the files over the cap.
+        """
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.open[handler] = None
+            self.open.move_to_end(handler)
+            victims = []
+            while len(self.open) > self.max_open:
+                victims.append(self.open.popitem(last=False)[0])
+            self.evictions += len(victims)
+        # Outside of our lock, which handlers take while holding their own
+        for victim in victims:
+            victim.release_file(self)
+
+    def forget(self, handler):
+        with self.lock:
+            self.open.pop(handler, None)
+
+    def report(self):
+        with self.lock:
+            return {'open': len(self.open), 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+class CachedFiles:
+
+    """
+    A mixin for `logging.FileHandler` subclasses whose files are opened by
+    `_open` and may be closed by `file_cache` between records.
+    """
+
+    file_cache = FileCache()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.stream is not None:
+            # Opened right away (no `delay`)
+            self.file_cache.touch(self, False)
+
+    def emit(self, record):
+        # The server calls `emit` directly, without `handle`'s locking
+        self.acquire()
+        try:
+            hit = self.stream is not None
+            super().emit(record)
+        finally:
+            self.release()
+        self.file_cache.touch(self, hit)
+
+    def release_file(self, cache):
+        """
+        Close the file, unless it was used again since `cache` chose to.
+        """
+        self.acquire()
+        try:
+            if self.stream is None or self in cache:
+                return
+            stream, self.stream = self.stream, None
+            # Reopening must not truncate what was written
+            if self.mode == 'w':
+                self.mode = 'a'
+            try:
+                stream.flush()
+            finally:
+                stream.close()
+        finally:
+            self.release()
+
+    def close(self):
+        self.file_cache.forget(self)
+        super().close()
+
+
+class CachedRotatingFileHandler(CachedFiles, RotatingFileHandler):
+
+    """
+    A `RotatingFileHandler` whose file is kept open by a `FileCache`.
+    """
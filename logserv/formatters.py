@@ -0,0 +1,97 @@
+"""
+Server-side formatters.
+
+`JSONFormatter` renders each record as one line of JSON holding a fixed set
+of fields. The constant parts of the line (the braces, the field names and
+the separators) are encoded once, when the formatter is created; formatting
+a record then only encodes the field values, instead of building a dict and
+handing it to `json.dumps`.
+
+A client selects it with the `FORMAT` message, or in its `IDENTIFY`
+parameters, using the style `"json"`:
+
+    FORMAT {"style": "json", "fields": ["created", "levelname", "message"]}
+
+Tracebacks and stack traces are never left out: a record that has them
+gets 'exc_text' and 'stack_info' fields even if they were not chosen.
+
+"""
+
+import logging
+import math
+from json.encoder import encode_basestring
+
+DEFAULT_FIELDS = ('created', 'levelname', 'name', 'message')
+# Added to the chosen fields when a record has them
+TRACE_FIELDS = ('exc_text', 'stack_info')
+
+
+def _encode_float(value):
+    return float.__repr__(value) if math.isfinite(value) else 'null'
+
+
+_ENCODERS = {
+    str: encode_basestring,
+    int: int.__repr__,
+    float: _encode_float,
+    bool: lambda value: 'true' if value else 'false',
+    type(None): lambda value: 'null',
+}
+# Any other value is encoded as the JSON string of its str()
+
+
+class JSONFormatter(logging.Formatter):
+
+    """
+    Formats records as JSON objects with the attributes named in `fields`.
+
+    Besides the `LogRecord` attributes, the fields may include 'message'
+    (the formatted message) and 'asctime' (the creation time formatted with
+    `datefmt`). Attributes a record lacks are rendered as null. The
+    `TRACE_FIELDS` not among `fields` are added when not empty.
+
+    """
+
+    def __init__(self, fields=None, datefmt=None):
+        super().__init__(datefmt=datefmt)
+        self.fields = tuple(DEFAULT_FIELDS if fields is None else fields)
+        if not self.fields or not all(isinstance(f, str)
+                                      for f in self.fields):
+            raise ValueError("fields must be a non-empty list of names")
+        self.steps = tuple(
+            (('{' if i == 0 else ',') + encode_basestring(field) + ':',
+             self.getter(field))
+            for i, field in enumerate(self.fields))
+        self.trace_steps = tuple(
+            (',' + encode_basestring(field) + ':', field)
+            for field in TRACE_FIELDS if field not in self.fields)
+
+    def getter(self, field):
+        """
+        Return a function fetching `field` from a record.
+        """
+        if field == 'message':
+            return logging.LogRecord.getMessage
+        if field == 'asctime':
+            return lambda record: self.formatTime(record, self.datefmt)
+        return lambda record: getattr(record, field, None)
+
+    def format(self, record):
+        if record.exc_info and not record.exc_text:
+            # As `logging.Formatter` does, for records logged locally
+            record.exc_text = self.formatException(record.exc_info)
+        parts = []
+        append = parts.append
+        for prefix, getter in self.steps:
+            append(prefix)
+            value = getter(record)
+            encoder = _ENCODERS.get(type(value))
+            append(encode_basestring(str(value)) if encoder is None
+                   else encoder(value))
+        for prefix, field in self.trace_steps:
+            value = getattr(record, field, None)
+            if value:
+                append(prefix)
+                append(encode_basestring(str(value)))
+        append('}')
+        return ''.join(parts)
@@ -0,0 +1,188 @@
+"""
+Handing a running server's sockets over to a new process.
+
+To upgrade or restart a server without dropping its clients, start the new
+process and have it wait for the old one:
+
+    from logserv import eventloop, handoff, server
+    handoff.take_over('/run/logserv-handoff.sock')
+    eventloop.loop(server.LogServer.logging_map)
+
+Then have the old process, from its loop (e.g. after a signal), call
+
+    handoff.hand_over('/run/logserv-handoff.sock',
+                      server.LogServer.logging_map)
+
+and exit once its writers, if any, have drained (`WriterPool.close`).
+
+The old process passes the file descriptors of its listening sockets and,
+unless `channels` is false, of its established connections over a Unix
+socket (`SCM_RIGHTS`), each along with a JSON description: the class of its
+dispatcher and, for connections, the channel's state from
+`LoggingChannel.handoff_state` (protocol status, partially received bytes,
+unsent replies and IDENTIFY parameters). Clients notice nothing: they are
+neither disconnected nor asked to shake hands again, and records in flight
+are simply read by the new process. Connections that are not handed over
+are closed by the old process as it exits.
+
+Classes are looked up by name in the new process, so they must be
+importable there, or be passed in `classes`.
+
+"""
+
+import importlib
+import json
+import os
+import socket
+import struct
+
+from .server import LoggingChannel, LogServer
+
+_LENGTH = struct.Struct('>L')
+
+
+def class_name(cls):
+    return '%s:%s' % (cls.__module__, cls.__qualname__)
+
+
+def find_class(name, classes=None):
+    if classes is not None and name in classes:
+        return classes[name]
+    module, _, qualname = name.partition(':')
+    obj = importlib.import_module(module)
+    for attr in qualname.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
+def send_socket(conn, state, sock):
+    """
+    Send `sock` and its description `state` over the Unix socket `conn`.
+    """
+    body = json.dumps(state).encode('UTF-8')
+    socket.send_fds(conn, [_LENGTH.pack(len(body))], [sock.fileno()])
+    conn.sendall(body)
+
+
+def _recv_exactly(conn, size, data=b''):
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise EOFError("handoff connection closed mid-message")
+        data += chunk
+    return data
+
+
+def recv_socket(conn):
+    """
+    Return the next `(state, sock)` pair sent over `conn`, or None once the
+    sender is done.
+    """
+    head, fds, _, _ = socket.recv_fds(conn, _LENGTH.size, 1)
+    if not head:
+        return None
+    if not fds:
+        raise ValueError("handoff message without a file descriptor")
+    sock = socket.socket(fileno=fds[0])
+    try:
+        head = _recv_exactly(conn, _LENGTH.size, head)
+        body = _recv_exactly(conn, _LENGTH.unpack(head)[0])
+        return json.loads(body.decode('UTF-8')), sock
+    except:
+        sock.close()
+        raise
+
+
+def hand_over(path, map, channels=True, timeout=None):
+    """
+    Pass the servers in `map`, and unless `channels` is false its logging
+    channels, to the process waiting at `path`.
+
+    Each dispatcher is closed in this process as soon as it has been sent.
+    If the transfer fails half-way, the dispatchers not yet sent are still
+    in `map` and may go on being served. Returns the number of sockets
+    handed over.
+
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    count = 0
+    with conn:
+        conn.connect(path)
+        for obj in list(map.values()):
+            if isinstance(obj, LogServer):
+                state = {}
+            elif (channels and isinstance(obj, LoggingChannel)
+                  and obj.connected):
+                state = obj.handoff_state()
+            else:
+                continue
+            state['class'] = class_name(obj.__class__)
+            send_socket(conn, state, obj.socket)
+            # Our copy of the descriptor goes, the connection stays open
+            obj.close()
+            count += 1
+        conn.shutdown(socket.SHUT_WR)
+        # Wait for the other side to have taken everything
+        conn.recv(1)
+    return count
+
+
+def take_over(path, map=None, classes=None, timeout=None):
+    """
+    Wait at `path` for a process calling `hand_over`, and serve the sockets
+    it passes in `map` (by default `server.LogServer.logging_map`).
+
+    `classes` optionally maps class names (as sent by `hand_over`) to the
+    classes to use instead. Returns the list of the dispatchers created;
+    sockets whose class cannot be found or is neither a `LogServer` nor a
+    `LoggingChannel`, and connections whose channel cannot be restored, are
+    closed. Only our own user may connect to `path`.
+
+    """
+    if map is None:
+        map = LogServer.logging_map
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.settimeout(timeout)
+    dispatchers = []
+    try:
+        # Only the owner may hand us sockets, as with `admin.AdminServer`
+        try:
+            os.fchmod(listener.fileno(), 0o600)
+        except OSError:  # pragma: no cover
+            pass
+        listener.bind(path)
+        os.chmod(path, 0o600)
+        listener.listen(1)
+        conn, _ = listener.accept()
+    finally:
+        listener.close()
+        try:
+            os.unlink(path)
+        except FileNotFoundError:  # pragma: no cover
+            pass
+    with conn:
+        conn.settimeout(timeout)
+        while True:
+            received = recv_socket(conn)
+            if received is None:
+                break
+            state, sock = received
+            try:
+                cls = find_class(state.pop('class'), classes)
+                if not (isinstance(cls, type)
+                        and issubclass(cls, (LogServer, LoggingChannel))):
+                    raise TypeError("%r is not a server or channel class" %
+                                    (cls,))
+            except Exception:
+                sock.close()
+                continue
+            if issubclass(cls, LogServer):
+                dispatchers.append(cls(map=map, sock=sock))
+                continue
+            try:
+                dispatchers.append(cls.restore(sock, map, state))
+            except Exception:
+                sock.close()
+        conn.sendall(b'\x00')
+    return dispatchers
@@ -0,0 +1,160 @@
+"""
+Sparse time indexes kept alongside server-written log files.
+
+`IndexedRotatingFileHandler` is a drop-in `handler_class` for the server:
+
+    from logserv import index, server
+    server.LoggingChannel.handler_class = index.IndexedRotatingFileHandler
+
+Next to every log segment it writes a sidecar file (the segment's name plus
+`.idx`) holding an entry every `indexInterval` bytes or so. Each entry is a
+`(timestamp, offset, count)` triple: the `created` time of the record
+starting at byte `offset` of the segment, and the number of records before
+it in the segment. The sidecar files are rotated together with their
+segments.
+
+`read_range` uses an index to read only the part of a segment that can hold
+records from a given time window. Timestamps are made non-decreasing as
+they are indexed; records arriving far out of order may therefore fall
+outside the returned range.
+
+"""
+
+import bisect
+import mmap
+import os
+import struct
+from logging.handlers import RotatingFileHandler
+
+ENTRY = struct.Struct('<dQQ')
+SUFFIX = '.idx'
+
+
+def index_filename(segment):
+    return segment + SUFFIX
+
+
+def load_index(segment):
+    """
+    Return the list of `(timestamp, offset, count)` entries for `segment`.
+    """
+    try:
+        with open(index_filename(segment), 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return []
+    # Ignore a partially written last entry
+    data = data[:len(data) - len(data) % ENTRY.size]
+    return list(ENTRY.iter_unpack(data))
+
+
+class IndexedRotatingFileHandler(RotatingFileHandler):
+
+    """
+    A `RotatingFileHandler` that maintains a sidecar time index.
+
+    After a restart, the record counts continue from the last entry of the
+    existing index, so records written after that entry are not counted.
+
+    """
+
+    index_interval = 64 * 1024
+
+    def __init__(self, filename, mode='a', maxBytes=0, backupCount=0,
+                 encoding=None, delay=False, errors=None,
+                 indexInterval=None):
+        if indexInterval is not None:
+            self.index_interval = indexInterval
+        self.index_stream = None
+        self.position = None
+        super().__init__(filename, mode, maxBytes, backupCount, encoding,
+                         delay, errors)
+
+    def _restore(self):
+        """
+        Pick up the position and index state of the current segment.
+        """
+        if self.stream is None:
+            self.stream = self._open()
+        self.position = self.stream.seek(0, os.SEEK_END)
+        entries = load_index(self.baseFilename) if self.position else []
+        if entries:
+            self.last_time, self.indexed, self.count = entries[-1]
+        else:
+            self.last_time, self.indexed, self.count = 0.0, None, 0
+        if self.index_stream is None:
+            self.index_stream = open(index_filename(self.baseFilename),
+                                     'ab' if entries else 'wb', buffering=0)
+
+    def emit(self, record):
+        if self.position is None:
+            self._restore()
+        start = self.position
+        super().emit(record)
+        if self.position is None:
+            # The segment was rolled over before the record was written
+            self._restore()
+            start = 0
+        if self.stream is None:  # pragma: no cover
+            return  # the write failed and was reported by handleError
+        self.position = self.stream.tell()
+        if self.indexed is None or start - self.indexed >= self.index_interval:
+            self.last_time = max(self.last_time, record.created)
+            self.index_stream.write(ENTRY.pack(self.last_time, start,
+                                               self.count))
+            self.indexed = start
+        self.count += 1
+
+    def doRollover(self):
+        super().doRollover()
+        self.close_index()
+        if self.backupCount > 0:
+            for i in range(self.backupCount - 1, 0, -1):
+                sfn = index_filename(self.rotation_filename(
+                    "%s.%d" % (self.baseFilename, i)))
+                dfn = index_filename(self.rotation_filename(
+                    "%s.%d" % (self.baseFilename, i + 1)))
+                if os.path.exists(sfn):
+                    os.replace(sfn, dfn)
+            sfn = index_filename(self.baseFilename)
+            if os.path.exists(sfn):
+                os.replace(sfn, index_filename(self.rotation_filename(
+                    self.baseFilename + ".1")))
+        self.position = None
+
+    def close_index(self):
+        if self.index_stream is not None:
+            self.index_stream.close()
+            self.index_stream = None
+
+    def close(self):
+        self.acquire()
+        try:
+            self.close_index()
+        finally:
+            self.release()
+        super().close()
+
+
+def read_range(segment, start, end, chunk_size=64 * 1024):
+    """
+    Yield the bytes of `segment` that may hold records created between
+    `start` and `end` (both Unix timestamps), in chunks.
+
+    The range is widened to the surrounding index entries, so the first and
+    last chunks usually contain some records from outside the window.
+
+    """
+    entries = load_index(segment)
+    times = [entry[0] for entry in entries]
+    lo = bisect.bisect_right(times, start) - 1
+    hi = bisect.bisect_right(times, end)
+    with open(segment, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        begin = entries[lo][1] if lo >= 0 else 0
+        stop = entries[hi][1] if hi < len(entries) else size
+        if begin >= stop:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for pos in range(begin, stop, chunk_size):
+                yield mm[pos:min(pos + chunk_size, stop)]
@@ -0,0 +1,365 @@
+"""
+Relaying records from a per-host server to a central one.
+
+A `RelayServer` accepts local clients like any other server, but instead of
+writing their records it forwards them to a central `server.LogServer`
+over a few persistent connections, so that the central server handles one
+connection per host rather than one per process:
+
+    from logserv import eventloop, relay, server
+    relay.RelayChannel.upstream = relay.Upstream(
+        ('aggregator', 9876), server.LogServer.logging_map, compress=True)
+    s = relay.RelayServer('/run/logserv.sock')
+    eventloop.loop(server.LogServer.logging_map)
+
+The parameters each local client sends in its IDENTIFY message (its own
+handler's and those of its '--sinks') become *routes*: sink specs that the
+relay declares to the central server before sending the first record for
+them. Clients with the same parameters share a route, and the central
+server opens the sinks exactly as if the clients had connected to it
+directly, so the same files are written. Relative filenames are resolved
+by the central server, and the records of a route it rejects (say, for bad
+handler parameters) are dropped.
+
+Records for a route always travel over the same upstream connection, in
+batches of up to `Upstream.batch_size`. When the central server cannot be
+reached the batch is retried every `retry_interval` seconds, and once an
+upstream queue reaches its high watermark the local clients feeding it
+stop being read, as with `writer.WriterPool`. A batch that was being sent
+when a connection broke is sent again, so a few records may be written
+twice.
+
+"""
+
+import collections
+import json
+import logging.handlers
+import pickle
+import socket
+import struct
+import threading
+import time
+import zlib
+
+from . import LogServerError, ProtocolError, eventloop
+from .client import SocketForwarder
+from .server import LoggingChannel, LogServer
+
+
+class RelayForwarder(SocketForwarder):
+
+    """
+    The client end of one upstream connection.
+
+    The handshake is the usual one, with a '--relay' parameter asking the
+    central server to accept batches of records for declared routes.
+
+    """
+
+    compress_level = 1
+
+    def __init__(self, host, port, timeout=None, compress=False):
+        self.compress = compress
+        self.declared = set()
+        self.rejected = set()
+        super().__init__(host, port, timeout, **{
+            '--relay': {'compress': 'zlib' if compress else None}})
+
+    def makeSocket(self, timeout=1):
+        return super().makeSocket(self.timeout)
+
+    def createSocket(self):
+        # Routes are declared afresh on every connection. Unlike the parent
+        # class, only shake hands once connected, and drop the socket if
+        # the handshake fails, so that the next batch starts over.
+        self.declared = set()
+        self.rejected = set()
+        logging.handlers.SocketHandler.createSocket(self)
+        if self.sock is None:
+            return
+        try:
+            self.doHandshake()
+        except:
+            self.closeSocket()
+            raise
+
+    def send(self, s):
+        # Unlike `SocketHandler.send`, never reconnect in the middle of a
+        # batch; errors are left to `sendBatch`
+        self.sock.sendall(s)
+
+    def sendBatch(self, batch, specs):
+        """
+        Send a list of `(route, log_dict)` pairs, first declaring any routes
+        the central server does not know yet from `specs`.
+
+        Records for routes the central server rejected are dropped. Returns
+        False if the batch could not be sent.
+
+        """
+        try:
+            if self.sock is None:
+                self.createSocket()
+                if self.sock is None:
+                    return False
+            for route in sorted({route for route, _ in batch}
+                                - self.declared - self.rejected):
+                self.declareRoute(route, specs[route])
+        except (OSError, LogServerError):
+            self.closeSocket()
+            return False
+        if self.rejected:
+            batch = [item for item in batch if item[0] not in self.rejected]
+        payload = pickle.dumps(batch, pickle.HIGHEST_PROTOCOL)
+        if self.compress:
+            payload = zlib.compress(payload, self.compress_level)
+        try:
+            self.sock.sendall(struct.pack('>L', len(payload)) + payload)
+        except OSError:
+            self.closeSocket()
+            return False
+        return True
+
+    def declareRoute(self, route, spec):
+        """
+        Declare `route` and wait for the server to open its sink.
+        """
+        self.send(b'\x00\x00\x00\x00' + ('ROUTE %d %s\n' % (
+            route, json.dumps(spec))).encode('UTF-8'))
+        resp = self.recv_line()
+        if resp == 'OK\n':
+            self.declared.add(route)
+        elif resp.startswith('ERROR '):
+            self.rejected.add(route)
+        else:
+            raise ProtocolError("'OK\n' or 'ERROR <description>\n'", resp)
+
+    def closeSocket(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class UpstreamLink:
+
+    """
+    Sends the records queued for one upstream connection, in batches, on
+    a background thread.
+    """
+
+    def __init__(self, upstream, index):
+        self.upstream = upstream
+        self.forwarder = upstream.forwarder_class(
+            upstream.host, upstream.port, upstream.timeout, upstream.compress)
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.backlogged = False
+        self.waiting = set()
+        self.closing = False
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='logserv-relay:%d' % index)
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def put(self, route, log_dict):
+        """
+        Queue a record for `route` and return whether the link is
+        backlogged.
+        """
+        with self.cond:
+            self.queue.append((route, log_dict))
+            if len(self.queue) >= self.upstream.high_water:
+                self.backlogged = True
+            self.cond.notify()
+            return self.backlogged
+
+    def wait(self, channel):
+        """
+        Have `channel` re-check its interest once the backlog clears.
+        """
+        with self.cond:
+            if self.backlogged:
+                self.waiting.add(channel)
+
+    def run(self):
+        batch_size = self.upstream.batch_size
+        while True:
+            with self.cond:
+                while not self.queue and not self.closing:
+                    self.cond.wait()
+                if not self.queue:
+                    break
+                batch = [self.queue.popleft()
+                         for _ in range(min(len(self.queue), batch_size))]
+                if (self.backlogged
+                        and len(self.queue) <= self.upstream.low_water):
+                    self.backlogged = False
+                    waiting, self.waiting = self.waiting, set()
+                    self.upstream.resume(waiting)
+            self.send(batch)
+        self.forwarder.close()
+
+    def send(self, batch):
+        while not self.forwarder.sendBatch(batch, self.upstream.specs):
+            if self.closing:
+                return  # the central server is gone; give up on the batch
+            time.sleep(self.upstream.retry_interval)
+
+    def close(self, timeout=None):
+        """
+        Stop the thread once everything queued has been sent (or failed).
+        """
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.thread.join(timeout)
+
+
+class Upstream:
+
+    """
+    The connections from a relay to the central server at `address`.
+
+    `map` is the socket map of the loop serving the relay's channels; an
+    `eventloop.Waker` is added to it to resume channels paused by a
+    backlogged link.
+
+    """
+
+    connections = 2
+    batch_size = 256
+    high_water = 10000
+    low_water = 1000
+    retry_interval = 1.0
+    forwarder_class = RelayForwarder
+
+    def __init__(self, address, map, connections=None, compress=False,
+                 timeout=None):
+        if connections is not None:
+            self.connections = connections
+        if not 0 <= self.low_water < self.high_water:
+            raise ValueError("need 0 <= low_water < high_water")
+        self.host, self.port = address
+        self.compress = compress
+        self.timeout = timeout
+        self.specs = {}
+        self.route_ids = {}
+        self.waker = eventloop.Waker(map)
+        self.links = [UpstreamLink(self, i)
+                      for i in range(self.connections)]
+
+    def route_for(self, spec):
+        """
+        Return the route id for the sink described by `spec`.
+        """
+        key = json.dumps(spec, sort_keys=True)
+        route = self.route_ids.get(key)
+        if route is None:
+            route = self.route_ids[key] = len(self.specs)
+            self.specs[route] = spec
+        return route
+
+    def link_for(self, route):
+        return self.links[route % len(self.links)]
+
+    def resume(self, channels):
+        if channels:
+            self.waker.call(self._resume, channels)
+
+    @staticmethod
+    def _resume(channels):
+        for channel in channels:
+            channel.interest_changed()
+
+    def close(self, timeout=None):
+        """
+        Send everything queued, then close the connections and the waker.
+        """
+        for link in self.links:
+            link.close(timeout)
+        self.waker.close()
+
+
+class RelayChannel(LoggingChannel):
+
+    """
+    A channel forwarding its client's records to the `upstream` relay.
+
+    The IDENTIFY parameters are checked for well-formedness only; the
+    central server creates the handlers, and reports bad parameters to the
+    relay rather than to the client.
+
+    """
+
+    __slots__ = ('routes_out', 'own_spec')
+
+    # The `Upstream` shared by all relay channels
+    upstream = None
+
+    def __init__(self, sock=None, map=None):
+        super().__init__(sock, map)
+        self.routes_out = []
+        self.own_spec = None
+
+    def configure(self, params):
+        self.configure_exc_cache(params.pop('--exc-cache', None))
+        self.configure_field_ids(params.pop('--field-dictionary', None))
+        level = self.check_level(params.pop('--level'))
+        sink_specs = params.pop('--sinks', None)
+        format_params = params.pop('--format', None)
+        if format_params is not None:
+            self.formatter_for(format_params)
+        if sink_specs is not None and not isinstance(sink_specs, list):
+            raise ProtocolError("a list of sinks", sink_specs)
+        routes = []
+        if params or sink_specs is None:
+            spec = dict(params)
+            spec['--level'] = level
+            if format_params is not None:
+                spec['--format'] = format_params
+            routes.append((level, self.upstream.route_for(spec)))
+            self.own_spec = spec
+        for spec in sink_specs or ():
+            if not isinstance(spec, dict) or '--level' not in spec:
+                raise ProtocolError("a sink dict with a '--level' key", spec)
+            sink_level = self.check_level(spec['--level'])
+            if '--format' in spec:
+                self.formatter_for(spec['--format'])
+            routes.append((sink_level, self.upstream.route_for(spec)))
+        self.routes_out = routes
+
+    def format(self, **params):
+        self.make_formatter(**params)
+        if self.own_spec is None:
+            raise ProtocolError("a channel with a handler of its own",
+                                "a FORMAT message for shared sinks")
+        spec = dict(self.own_spec)
+        spec['--format'] = params
+        self.own_spec = spec
+        level, _ = self.routes_out[0]
+        self.routes_out[0] = (level, self.upstream.route_for(spec))
+        self.reply('OK\n')
+
+    def emit(self, record):
+        if self.scheduler is not None:
+            if not self.scheduler.observe(self, record):
+                return
+        for level, route in self.routes_out:
+            if record.levelno >= level:
+                link = self.upstream.link_for(route)
+                if link.put(route, record.__dict__):
+                    self.blocked_on = link
+                    link.wait(self)
+                    self.interest_changed()
+
+
+class RelayServer(LogServer):
+
+    """
+    A Unix-socket server relaying its clients' records upstream.
+    """
+
+    channel_class = RelayChannel
+    socket_family = socket.AF_UNIX
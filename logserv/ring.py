@@ -0,0 +1,133 @@
+"""
+Single-producer, single-consumer byte rings in shared memory.
+
+A `client.RingClient` creates a ring during the handshake and tells the
+server its name; from then on it writes its protocol stream (record frames
+and messages) into the ring instead of the socket. The socket is only used
+to wake the server when the ring goes from empty to non-empty.
+
+The ring is laid out as a header followed by the data area. The header
+holds the capacity, the total number of bytes ever written (`head`, only
+updated by the producer) and the total number of bytes ever read (`tail`,
+only updated by the consumer), each on its own cache line.
+
+"""
+
+import os
+import struct
+from multiprocessing import resource_tracker, shared_memory
+
+_COUNTER = struct.Struct('=Q')
+_CAPACITY = 0
+_HEAD = 64
+_TAIL = 128
+_DATA = 192
+
+NAME_PREFIX = 'logserv_'
+
+
+class Ring:
+
+    """
+    A byte ring over a `SharedMemory` block.
+
+    Use `create` in the producer, which owns (and eventually unlinks) the
+    block, and `attach` in the consumer.
+
+    """
+
+    def __init__(self, shm, owner=False):
+        self.shm = shm
+        self.owner = owner
+        self.buf = shm.buf
+        self.capacity = _COUNTER.unpack_from(self.buf, _CAPACITY)[0]
+        if not 0 < self.capacity <= shm.size - _DATA:
+            raise ValueError("not a ring: bad capacity %d" % self.capacity)
+
+    @classmethod
+    def create(cls, capacity):
+        name = NAME_PREFIX + os.urandom(8).hex()
+        shm = shared_memory.SharedMemory(name, create=True,
+                                         size=_DATA + capacity)
+        _COUNTER.pack_into(shm.buf, _CAPACITY, capacity)
+        _COUNTER.pack_into(shm.buf, _HEAD, 0)
+        _COUNTER.pack_into(shm.buf, _TAIL, 0)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        if not name.startswith(NAME_PREFIX):
+            raise ValueError("not a ring name: %r" % name)
+        try:
+            shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            # Before Python 3.13 every attachment is tracked, and the
+            # tracker would unlink the client's block when we exit
+            shm = shared_memory.SharedMemory(name)
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        try:
+            return cls(shm)
+        except ValueError:
+            shm.close()
+            raise
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def _head(self):
+        return _COUNTER.unpack_from(self.buf, _HEAD)[0]
+
+    def _tail(self):
+        return _COUNTER.unpack_from(self.buf, _TAIL)[0]
+
+    def __len__(self):
+        return self._head() - self._tail()
+
+    def write(self, data):
+        """
+        Append all of `data` to the ring, or nothing if it does not fit.
+
+        Returns a pair `(written, was_empty)`; `was_empty` is true when the
+        consumer had caught up before this write, and so may need waking.
+
+        """
+        size = len(data)
+        head = self._head()
+        if size > self.capacity - (head - self._tail()):
+            return False, False
+        pos = head % self.capacity
+        first = min(size, self.capacity - pos)
+        self.buf[_DATA + pos:_DATA + pos + first] = data[:first]
+        if first < size:
+            self.buf[_DATA:_DATA + size - first] = data[first:]
+        _COUNTER.pack_into(self.buf, _HEAD, head + size)
+        # Checked after publishing, so that a consumer that stops after
+        # seeing the old head is always woken
+        return True, self._tail() == head
+
+    def read(self, size):
+        """
+        Remove and return up to `size` bytes from the ring.
+        """
+        tail = self._tail()
+        size = min(size, self._head() - tail)
+        pos = tail % self.capacity
+        first = min(size, self.capacity - pos)
+        data = bytes(self.buf[_DATA + pos:_DATA + pos + first])
+        if first < size:
+            data += bytes(self.buf[_DATA:_DATA + size - first])
+        _COUNTER.pack_into(self.buf, _TAIL, tail + size)
+        return data
+
+    def close(self):
+        """
+        Detach from the block, unlinking it if this is the producer.
+        """
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:  # pragma: no cover
+                pass
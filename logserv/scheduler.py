@@ -0,0 +1,160 @@
+"""
+Deficit round-robin fairness between the channels of one loop.
+
+With a single loop, a chatty client can keep its channel busy reading and
+writing while quieter clients wait. A `FairScheduler` gives every channel
+a budget of bytes (and optionally records) per loop iteration, or round.
+A channel that overdraws its budget stops being readable until enough
+rounds have passed to pay the overdraft back, so a client sending large
+records does not get more than its share either.
+
+The scheduler also tracks how far behind each client is, measured as the
+age of its records (`record.created`) when they are handed to the
+handler, and can shed clients whose lag exceeds `shed_lag` seconds.
+
+    from logserv import eventloop, scheduler, server
+    server.LoggingChannel.scheduler = scheduler.FairScheduler(quantum=65536)
+    s = server.LogServer(("localhost", 9876))
+    eventloop.loop(server.LogServer.logging_map,
+                   scheduler=server.LoggingChannel.scheduler)
+
+"""
+
+import time
+
+
+class ClientStats:
+
+    __slots__ = ('deficit', 'record_deficit', 'round', 'bytes', 'records',
+                 'lag', 'max_lag', 'throttles')
+
+    def __init__(self, round, quantum, record_quantum):
+        self.deficit = quantum
+        self.record_deficit = record_quantum
+        self.round = round
+        self.bytes = 0
+        self.records = 0
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.throttles = 0
+
+
+class FairScheduler:
+
+    """
+    Hands out per-round read budgets to channels.
+
+    `quantum` is the number of bytes a channel may read per round and
+    `record_quantum` the number of records (None for no limit). Channels
+    whose records are more than `shed_lag` seconds old when written are
+    closed (None to never shed).
+
+    """
+
+    quantum = 64 * 1024
+    record_quantum = None
+    shed_lag = None
+
+    def __init__(self, quantum=None, record_quantum=None, shed_lag=None):
+        if quantum is not None:
+            self.quantum = quantum
+        if record_quantum is not None:
+            self.record_quantum = record_quantum
+        if shed_lag is not None:
+            self.shed_lag = shed_lag
+        self.round = 0
+        self.clients = {}
+        self.throttled = set()
+        self.shed_count = 0
+
+    def _record_quantum(self):
+        # Without a record limit, the record deficit never runs out
+        return float('inf') if self.record_quantum is None \
+            else self.record_quantum
+
+    def stats(self, channel):
+        st = self.clients.get(channel)
+        if st is None:
+            st = self.clients[channel] = ClientStats(
+                self.round, self.quantum, self._record_quantum())
+        return st
+
+    def may_read(self, channel):
+        return channel not in self.throttled
+
+    def charge(self, channel, nbytes, nrecords=0):
+        """
+        Deduct what `channel` just read from its budget for this round.
+        """
+        st = self.stats(channel)
+        if st.round != self.round:
+            # Unused budget from earlier rounds does not carry over
+            st.deficit = min(st.deficit, 0) + self.quantum
+            st.record_deficit = (min(st.record_deficit, 0) +
+                                 self._record_quantum())
+            st.round = self.round
+        st.deficit -= nbytes
+        st.record_deficit -= nrecords
+        st.bytes += nbytes
+        st.records += nrecords
+        if ((st.deficit <= 0 or st.record_deficit <= 0) and
+                channel not in self.throttled):
+            st.throttles += 1
+            self.throttled.add(channel)
+            channel.interest_changed()
+
+    def new_round(self):
+        """
+        Start a new round, topping up the budgets of throttled channels.
+        """
+        self.round += 1
+        for channel in list(self.throttled):
+            st = self.clients[channel]
+            st.deficit += self.quantum
+            st.record_deficit += self._record_quantum()
+            st.round = self.round
+            if st.deficit > 0 and st.record_deficit > 0:
+                self.throttled.discard(channel)
+                channel.interest_changed()
+
+    def observe(self, channel, record):
+        """
+        Update the lag of `channel` from a record it is about to write.
+
+        Return False if `channel` was shed, in which case the record must
+        not be written.
+
+        """
+        st = self.stats(channel)
+        st.lag = time.time() - record.created
+        if st.lag > st.max_lag:
+            st.max_lag = st.lag
+        if self.shed_lag is not None and st.lag > self.shed_lag:
+            self.shed(channel)
+            return False
+        return True
+
+    def shed(self, channel):
+        """
+        Disconnect `channel`, e.g. because it is hopelessly behind.
+        """
+        self.shed_count += 1
+        channel.close()
+
+    def forget(self, channel):
+        self.clients.pop(channel, None)
+        self.throttled.discard(channel)
+
+    def report(self):
+        """
+        Return a list of dicts describing each client's share and lag.
+        """
+        return [{'client': channel.addr,
+                 'target': getattr(channel.handler, 'baseFilename', None),
+                 'bytes': st.bytes,
+                 'records': st.records,
+                 'lag': st.lag,
+                 'max_lag': st.max_lag,
+                 'throttles': st.throttles,
+                 'throttled': channel in self.throttled}
+                for channel, st in self.clients.items()]
@@ -0,0 +1,293 @@
+"""
+A file handler for the server that preallocates its log segments.
+
+`PreallocatedFileHandler` is a drop-in `handler_class` for the server, taking
+the same parameters as `RotatingFileHandler`:
+
+    from logserv import segments, server
+    server.LoggingChannel.handler_class = segments.PreallocatedFileHandler
+
+Each segment is reserved on disk up front with `os.posix_fallocate` (all of
+`maxBytes` at once, or `preallocate_step` bytes at a time when the file is
+not rotated), so that the filesystem can lay it out contiguously and does
+not update its metadata on every extension. Records are encoded once and
+collected in a buffer of `bufferSize` bytes, which is written with
+`os.pwrite` at the end of the data; a background thread (the handler
+class's `flusher`) also writes buffers out within 0.2 seconds of their
+first record. When a segment is rotated or closed, it is truncated to the
+size of its data.
+
+Until then the file is longer than its data, with NUL bytes at the end, so
+readers following it should use `logserv.tail` rather than `tail -f`. The
+length of the data is kept in a sidecar file, `<segment>.end`, updated after
+every write and removed once the segment is truncated, so that a segment
+reopened after a crash is appended to right after its data (even if that
+ends in NUL bytes).
+
+"""
+
+import errno
+import io
+import locale
+import os
+import stat
+import struct
+import threading
+import time
+from logging.handlers import RotatingFileHandler
+
+# Errors meaning the file or filesystem cannot preallocate
+_NO_PREALLOCATION = {errno.EINVAL, errno.ENODEV, errno.ESPIPE,
+                     getattr(errno, 'EOPNOTSUPP', errno.EINVAL),
+                     getattr(errno, 'ENOTSUP', errno.EINVAL)}
+
+
+# The contents of a `<segment>.end` file
+END = struct.Struct('>Q')
+
+
+def data_end(fd, size, chunk_size=64 * 1024):
+    """
+    Return the offset just past the last non-NUL byte of the first `size`
+    bytes of the file `fd`.
+    """
+    end = size
+    while end > 0:
+        start = max(0, end - chunk_size)
+        chunk = os.pread(fd, end - start, start).rstrip(b'\x00')
+        if chunk:
+            return start + len(chunk)
+        end = start
+    return 0
+
+
+class Segment:
+
+    """
+    An open segment, written through a buffer at a tracked offset.
+
+    A segment of at most `max_bytes` bytes is allocated in full when opened;
+    with `max_bytes` zero, `step` more bytes are allocated whenever needed.
+    While the file is longer than its data, the data's length is kept in
+    `end_path`.
+
+    """
+
+    def __init__(self, path, mode, max_bytes, step, buffer_size):
+        self.end_path = path + '.end'
+        self.end_fd = None
+        # Readable too, to find the end of the data when reopening
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_CLOEXEC', 0)
+        if 'w' in mode:
+            flags |= os.O_TRUNC
+        self.fd = os.open(path, flags, 0o666)
+        try:
+            st = os.fstat(self.fd)
+        except:
+            os.close(self.fd)
+            raise
+        # Devices and pipes are written to as they are
+        self.regular = stat.S_ISREG(st.st_mode)
+        self.position = 0
+        self.allocated = st.st_size
+        if self.regular:
+            recorded = self.recorded_end()
+            self.position = st.st_size if recorded is None else recorded
+            if recorded is not None or self.allocated > self.position:
+                self.record_end()
+        self.max_bytes = max_bytes
+        self.step = step
+        self.preallocate = (self.regular and (max_bytes > 0 or step > 0)
+                            and hasattr(os, 'posix_fallocate'))
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.reserve(max_bytes)
+
+    def tell(self):
+        return self.position + len(self.buffer)
+
+    def recorded_end(self):
+        """
+        Return the length of the data according to `end_path`, or None if
+        the file was closed properly (or never preallocated).
+        """
+        try:
+            with open(self.end_path, 'rb') as f:
+                data = f.read(END.size)
+        except FileNotFoundError:
+            return None
+        if len(data) < END.size:
+            # Cut short while first written: nothing was preallocated yet,
+            # so NUL bytes at the end can only be padding
+            return data_end(self.fd, self.allocated)
+        return min(END.unpack(data)[0], self.allocated)
+
+    def record_end(self):
+        if self.end_fd is None:
+            self.end_fd = os.open(
+                self.end_path,
+                os.O_WRONLY | os.O_CREAT | getattr(os, 'O_CLOEXEC', 0),
+                0o666)
+        os.pwrite(self.end_fd, END.pack(self.position), 0)
+
+    def reserve(self, end):
+        """
+        Make sure the first `end` bytes of the file are allocated.
+        """
+        if not self.preallocate or end <= self.allocated:
+            return
+        if self.max_bytes > 0:
+            size = max(end, self.max_bytes)
+        else:
+            size = max(end, self.allocated + self.step)
+        # Before there is any padding to tell apart from the data
+        self.record_end()
+        try:
+            os.posix_fallocate(self.fd, self.allocated,
+                               size - self.allocated)
+        except OSError as err:
+            if err.errno not in _NO_PREALLOCATION:
+                raise
+            self.preallocate = False
+            return
+        self.allocated = size
+
+    def write(self, data):
+        """
+        Buffer the bytes `data`, writing the buffer out once full.
+        """
+        self.buffer += data
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        data, self.buffer = self.buffer, bytearray()
+        if not data:
+            return
+        if not self.regular:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self.fd, view):]
+            return
+        self.reserve(self.position + len(data))
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self.fd, view, self.position)
+            self.position += written
+            view = view[written:]
+        if self.end_fd is not None:
+            self.record_end()
+
+    def close(self):
+        if self.fd is None:
+            return
+        try:
+            self.flush()
+            if self.regular and self.allocated > self.position:
+                # Give back the space reserved but not used
+                os.ftruncate(self.fd, self.position)
+            if self.end_fd is not None:
+                # The file's size is its data's length again
+                try:
+                    os.unlink(self.end_path)
+                except FileNotFoundError:
+                    pass
+        finally:
+            os.close(self.fd)
+            self.fd = None
+            if self.end_fd is not None:
+                os.close(self.end_fd)
+                self.end_fd = None
+
+
+class Flusher:
+
+    """
+    Writes out the buffers of handlers within `interval` seconds of their
+    first buffered record, from a background thread.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add(self, handler):
+        with self.lock:
+            self.pending.add(handler)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True,
+                                               name='logserv-flusher')
+                self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                pending, self.pending = self.pending, set()
+            for handler in pending:
+                try:
+                    handler.flush()
+                except Exception:
+                    # Reported by the handler's next emit, if it persists
+                    pass
+
+
+class PreallocatedFileHandler(RotatingFileHandler):
+
+    """
+    A `RotatingFileHandler` writing bytes into preallocated segments.
+
+    Unlike its base class, it measures `maxBytes` in encoded bytes, formats
+    each record once, and never rolls over an empty segment.
+
+    """
+
+    buffer_size = 64 * 1024
+    # Bytes reserved at a time for segments that are not rotated
+    preallocate_step = 16 * 1024 * 1024
+    flusher = Flusher(0.2)
+
+    def __init__(self, filename, mode='a', maxBytes=0, backupCount=0,
+                 encoding=None, delay=False, errors=None, bufferSize=None):
+        if bufferSize is not None:
+            self.buffer_size = bufferSize
+        encoding = io.text_encoding(encoding)
+        if encoding == 'locale':
+            encoding = locale.getpreferredencoding(False)
+        # `_open` needs it before the base class sets it
+        self.maxBytes = maxBytes
+        super().__init__(filename, mode, maxBytes, backupCount, encoding,
+                         delay, errors)
+
+    def _open(self):
+        return Segment(self.baseFilename, self.mode, self.maxBytes,
+                       self.preallocate_step, self.buffer_size)
+
+    def emit(self, record):
+        try:
+            data = (self.format(record) + self.terminator).encode(
+                self.encoding, self.errors or 'strict')
+        except Exception:
+            self.handleError(record)
+            return
+        # The server calls `emit` directly, without `handle`'s locking
+        self.acquire()
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            position = self.stream.tell()
+            if (self.maxBytes > 0 and self.stream.regular and position
+                    and position + len(data) >= self.maxBytes):
+                self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+            was_empty = not self.stream.buffer
+            self.stream.write(data)
+            if was_empty and self.stream.buffer:
+                self.flusher.add(self)
+        except Exception:
+            self.handleError(record)
+        finally:
+            self.release()
@@ -7,13 +7,23 @@ handles each connection's state and file handler.
 """
 
 import asyncore
+import base64
+import collections
 import json
 import logging
 import pickle
 import socket
 import struct
+import sys
+import zlib
 
-from . import ProtocolError
+from . import EXC_CACHE_BYTES, FIELD_DICTIONARY, ProtocolError
+from .eventloop import Waker
+from .buffers import BufferPool
+from .formatters import JSONFormatter
+from .ring import Ring
+from .sinks import SinkRegistry
+from .tail import SubscriptionHub
 from logging.handlers import RotatingFileHandler
 
 class StrictDispatcher(asyncore.dispatcher):
@@ -23,93 +33,287 @@ class StrictDispatcher(asyncore.dispatcher):
         raise AttributeError("%s object has no attribute '%s'" %
                              (self.__class__.__name__, attr))
 
+    def interest_changed(self):
+        """
+        Signal that `readable()` or `writable()` may now answer differently.
+
+        Socket maps that cache interest (see `eventloop.SelectorMap`) are
+        told to refresh it; plain dicts need no notification.
+
+        """
+        update = getattr(self._map, 'update_interest', None)
+        if update is not None:
+            update(self)
+
 
 class LoggingChannel(StrictDispatcher):
 
-    # The channel has 7 primary states in which it can be:
+    # The channel has 8 primary states in which it can be:
     #
     #   1. WELCOMING: initial state, awaiting Hello message
-    #   2. IDENTIFYING: awaiting IDENTIFY message
+    #   2. IDENTIFYING: awaiting IDENTIFY (or SUBSCRIBE) message
     #   3. WAITING: awaiting LOG message
     #   4. LOG-HEADER: awaiting a new log record, including length header
     #   5. LOGGING: receiving body of a log record
     #   6. MESSAGING: receiving a message during the main connection
-    #   7. CLOSED: not receiving any messages
+    #   7. SUBSCRIBED: sending records to a subscriber (see `logserv.tail`)
+    #   8. CLOSED: not receiving any messages
     #
     #   State transition diagram:
     #
     #                           +--> 5
     #                           |    |
     #         1 --> 2 --> 3 --> 4 <--+
-    #                           |    |
-    #                           +--> 6
+    #               |           |    |
+    #               +--> 7      +--> 6
     #
-    #      All states can go to state 7 as well
+    #      All states can go to state 8 as well
     #
     # In reality, the number of states is much greater since between many
     # state transitions the server sends a message to the client.
+    #
+    # States are stored as the integer codes below, and `dispatch_read`
+    # looks up the method for the current state in `state_readers`.
+
+    (WELCOMING, IDENTIFYING, WAITING, LOG_HEADER, LOGGING, MESSAGING,
+     SUBSCRIBED, CLOSED) = range(8)
+    state_names = ('WELCOMING', 'IDENTIFYING', 'WAITING', 'LOG-HEADER',
+                   'LOGGING', 'MESSAGING', 'SUBSCRIBED', 'CLOSED')
+    state_readers = ('welcome', 'identify', 'confirm_log', 'receive_header',
+                     'receive_log', 'receive_msg', 'await_quit', None)
+
+    # Connection state lives in slots; only `asyncore.dispatcher`'s own
+    # attributes still need the instance dict.
+    __slots__ = ('state', 'params', 'handler', 'sinks', 'routes',
+                 'relay_compress', 'multiplexed', 'subscription', 'exc_cache',
+                 'exc_cache_size', 'exc_cache_bytes', 'field_ids',
+                 'field_ids_size', 'blocked_on',
+                 'read_buf', 'read_len', '_write_buf', 'remaining',
+                 'bytes_in', 'records_in', 'timer', 'opened_at',
+                 'last_active')
 
     NUM_LEN_BYTES = 4
+    # Multiplexed records start with a bitmap of their streams
+    STREAM_BITMAP = struct.Struct('>Q')
     version = "1.0"
     handler_class = RotatingFileHandler
+    # Formatter for handlers whose client does not choose one, e.g. a
+    # `formatters.JSONFormatter` to write JSON lines by default
+    default_formatter = None
+    # Handlers for the '--sinks' of all the channels
+    shared_sinks = SinkRegistry()
+    # Receive buffers are shared by all the channels
+    buffers = BufferPool()
+    # A `writer.WriterPool`, or None to emit records on the loop thread
+    writers = None
+    # A `scheduler.FairScheduler`, or None to read whenever data arrives
+    scheduler = None
+    # Subscribers to the records of all the channels
+    subscriptions = SubscriptionHub()
+    # Bytes of queued records handed to each `send` to a subscriber
+    subscription_write_size = 65536
+    # The most tracebacks a client may ask us to remember ('--exc-cache')
+    max_exc_cache = 4096
+    # The most strings a client may number ('--field-dictionary')
+    max_field_dictionary = 4096
+    # A `timers.TimerWheel`, or None for connections never to time out
+    timers = None
+    # Seconds a client has to finish HELLO, IDENTIFY and LOG
+    handshake_timeout = 30.0
+    # Seconds without data after which a client is disconnected, or None
+    idle_timeout = None
+    # Bytes of unsent replies at which we stop reading from a client that
+    # does not read them, or None for no limit
+    max_pending_replies = 1 << 20
 
     def __init__(self, sock=None, map=None):
         super().__init__(sock, map)
-        self._status = 'WELCOMING'
+        self.state = self.WELCOMING
+        self.params = None
         self.handler = None
-        self.read_buf = []
-        self.write_buf = b''
+        self.sinks = None
+        self.routes = None
+        self.relay_compress = False
+        self.multiplexed = False
+        self.subscription = None
+        self.exc_cache = None
+        self.exc_cache_size = 0
+        self.exc_cache_bytes = 0
+        self.field_ids = None
+        self.field_ids_size = 0
+        self.blocked_on = None
+        self.read_buf = None
+        self.read_len = 0
+        self._write_buf = b''
         self.remaining = 0
+        self.bytes_in = 0
+        self.records_in = 0
+        self.timer = None
+        if self.timers is not None:
+            self.opened_at = self.last_active = self.timers.now
+            self.check_timeout()
+
+    @property
+    def write_buf(self):
+        return self._write_buf
+
+    @write_buf.setter
+    def write_buf(self, val):
+        old_len = len(self._write_buf)
+        self._write_buf = val
+        self.write_buf_resized(old_len)
+
+    def write_buf_resized(self, old_len):
+        new_len = len(self._write_buf)
+        if ((not old_len) != (not new_len)
+                or self.replies_backlogged(old_len)
+                != self.replies_backlogged(new_len)):
+            self.interest_changed()
+
+    def replies_backlogged(self, size):
+        return (self.max_pending_replies is not None
+                and size >= self.max_pending_replies)
 
     @property
     def status(self):
-        return self._status
+        return self.state_names[self.state]
 
     @status.setter
     def status(self, val):
-        if val == 'LOG-HEADER':
+        self.state = self.state_names.index(val)
+        if self.state == self.LOG_HEADER:
             self.remaining = self.NUM_LEN_BYTES
-        self._status = val
+
+    @property
+    def pending(self):
+        """The bytes of a partially received message."""
+        if self.read_buf is None:
+            return b''
+        return bytes(self.read_buf[:self.read_len])
 
     def readable(self):
-        return not self.write_buf
+        # Replies drain independently until the client lets them pile up
+        if self.replies_backlogged(len(self._write_buf)):
+            return False
+        if self.blocked_on is not None and self.blocked_on.backlogged:
+            return False
+        return self.scheduler is None or self.scheduler.may_read(self)
 
     def writable(self):
-        return bool(self.write_buf)
+        return bool(self.write_buf) or (self.subscription is not None
+                                        and bool(self.subscription.queue))
 
     def handle_write(self):
+        if not self.write_buf and self.subscription is not None:
+            self.write_buf = self.subscription.take(
+                self.subscription_write_size)
         if isinstance(self.write_buf, str):
             self.write_buf = self.write_buf.encode('UTF-8')
         sent = self.send(self.write_buf)
-        self.write_buf = self.write_buf[sent:]
+        buf = self._write_buf
+        if isinstance(buf, bytearray):
+            old_len = len(buf)
+            del buf[:sent]
+            self.write_buf_resized(old_len)
+        else:
+            self.write_buf = buf[sent:]
 
     def handle_read(self):
+        if self.timers is not None:
+            self.last_active = self.timers.now
+        bytes_in, records_in = self.bytes_in, self.records_in
         try:
             self.dispatch_read()
         except ProtocolError as err:
             self.alert_error(err)
+        if self.scheduler is not None and self.connected:
+            self.scheduler.charge(self, self.bytes_in - bytes_in,
+                                  self.records_in - records_in)
+
+    def timeout_deadline(self):
+        """
+        Return when the channel times out as things stand, or None.
+        """
+        # The handshake ends with 'LOG'
+        if self.state in (self.WELCOMING, self.IDENTIFYING, self.WAITING):
+            if self.handshake_timeout is not None:
+                return self.opened_at + self.handshake_timeout
+        elif self.state == self.SUBSCRIBED:
+            # Subscribers have nothing to send until they quit
+            return None
+        if self.idle_timeout is None:
+            return None
+        return self.last_active + self.idle_timeout
+
+    def check_timeout(self):
+        """
+        Close the channel if it has timed out, or check again when it could.
+        """
+        self.timer = None
+        if self.state == self.CLOSED:
+            return
+        deadline = self.timeout_deadline()
+        if deadline is None:
+            return
+        now = self.timers.now
+        if deadline <= now and not self.readable():
+            # We are the ones not reading (backlogged writer or throttled),
+            # so the client is not idle
+            self.last_active = now
+            deadline = self.timeout_deadline()
+        if deadline <= now:
+            self.close()
+        else:
+            # Reads only update `last_active`; the timer catches up here
+            self.timer = self.timers.schedule(deadline - now,
+                                              self.check_timeout)
 
     def dispatch_read(self):
-        if self.status == 'WELCOMING':
-            self.welcome()
-        elif self.status == 'IDENTIFYING':
-            self.identify()
-        elif self.status == 'WAITING':
-            self.confirm_log()
-        elif self.status == 'LOG-HEADER':
-            self.receive_header()
-        elif self.status == 'LOGGING':
-            self.receive_log()
-        elif self.status == 'MESSAGING':
-            self.receive_msg()
-        else: # pragma: no cover
+        reader = self.state_readers[self.state]
+        if reader is None:  # pragma: no cover
             raise ValueError("self.status is %r" % self.status)
+        getattr(self, reader)()
+
+    def buffer(self, data):
+        """
+        Append `data` to the receive buffer, taking one from the pool first
+        if needed.
+        """
+        end = self.read_len + len(data)
+        buf = self.read_buf
+        if buf is None:
+            buf = self.read_buf = self.buffers.acquire(end)
+        elif end > len(buf):
+            bigger = self.buffers.acquire(end)
+            bigger[:self.read_len] = memoryview(buf)[:self.read_len]
+            self.buffers.release(buf)
+            buf = self.read_buf = bigger
+        buf[self.read_len:end] = data
+        self.read_len = end
+
+    def take(self, data=b''):
+        """
+        Return the buffered bytes followed by `data`, and return the
+        receive buffer to the pool.
+        """
+        if self.read_buf is None:
+            return data
+        self.buffer(data)
+        all_data = bytes(self.read_buf[:self.read_len])
+        self.release_buffer()
+        return all_data
+
+    def release_buffer(self):
+        if self.read_buf is not None:
+            self.buffers.release(self.read_buf)
+            self.read_buf = None
+            self.read_len = 0
 
     def find_term(self, term='\n'.encode('UTF-8')):
         data = self.recv(1024)
-        self.read_buf.append(data)
+        self.bytes_in += len(data)
         if term in data:
-            resp = b''.join(self.read_buf)
+            resp = self.take(data)
             if not data.endswith(term):
                 raise ProtocolError("a %s-terminated message" % term, resp)
             elif term in data[:-1]:
@@ -119,8 +323,8 @@ class LoggingChannel(StrictDispatcher):
                 resp = resp.decode('UTF-8')
             except UnicodeDecodeError:
                 raise ProtocolError("a UTF-8 string", resp)
-            self.read_buf = []
             return resp
+        self.buffer(data)
         return None
 
     def welcome(self):
@@ -130,13 +334,16 @@ class LoggingChannel(StrictDispatcher):
             if head != 'HELLO':
                 raise ProtocolError("'HELLO'", msg)
             # regardless of the client version, we just use 1.0
-            self.write_buf = 'HELLO %s\n' % self.version
-            self.status = 'IDENTIFYING'
+            self.reply('HELLO %s\n' % self.version)
+            self.state = self.IDENTIFYING
 
     def identify(self):
         msg = self.find_term()
         if msg is not None:
             head = msg.split(' ', 1)[0]
+            if head == 'SUBSCRIBE':
+                self.subscribe(msg.split(' ', 1)[1])
+                return
             if not head == 'IDENTIFY':
                 raise ProtocolError("'IDENTIFY'", head)
             rest = msg.split(' ', 1)[1]  # This will never fail
@@ -146,33 +353,181 @@ class LoggingChannel(StrictDispatcher):
                 raise ProtocolError("a JSON object", rest)
             if '--level' not in params:
                 raise ProtocolError("a '--level' key", None)
-            level = params.pop('--level')
-            try:
-                self.handler = self.handler_class(**params)
-            except TypeError as err:
-                raise ProtocolError("valid parameters for "
-                                    "`%s`" % self.handler_class.__name__,
-                                    err.args[0])
-            self.handler.setLevel(level)
-            self.write_buf = 'OK\n'
-            self.status = 'WAITING'
+            self.configure(dict(params))
+            self.params = params
+            self.reply('OK\n')
+            self.state = self.WAITING
+
+    def subscribe(self, rest):
+        """
+        Make this the channel of a subscriber to the records matching the
+        JSON filter `rest`.
+        """
+        try:
+            spec = json.loads(rest)
+        except ValueError:
+            raise ProtocolError("a JSON object", rest)
+        self.subscription = self.subscriptions.subscribe(self, spec)
+        self.reply('OK\n')
+        self.state = self.SUBSCRIBED
+
+    def await_quit(self):
+        msg = self.find_term()
+        if msg is not None:
+            if msg != 'QUIT\n':
+                raise ProtocolError("'QUIT\n'", msg)
+            self.close()
+
+    def configure(self, params):
+        """
+        Set up the channel's handler and sinks from its IDENTIFY parameters.
+        """
+        self.configure_exc_cache(params.pop('--exc-cache', None))
+        self.configure_field_ids(params.pop('--field-dictionary', None))
+        if '--relay' in params:
+            self.configure_relay(params.pop('--relay'))
+            return
+        if '--multiplex' in params:
+            if not isinstance(params['--multiplex'], dict):
+                raise ProtocolError("a dict of multiplexing options",
+                                    params['--multiplex'])
+            self.routes = {}
+            self.multiplexed = True
+            return
+        level = params.pop('--level')
+        sink_specs = params.pop('--sinks', None)
+        formatter = self.formatter_for(params.pop('--format', None))
+        if sink_specs is not None and not isinstance(sink_specs, list):
+            raise ProtocolError("a list of sinks", sink_specs)
+        # Nothing is kept unless everything could be opened
+        sinks = []
+        handler = None
+        try:
+            for spec in sink_specs or ():
+                sinks.append(self.open_sink(spec))
+            if params or sink_specs is None:
+                handler = self.make_handler(params)
+                handler.setLevel(level)
+                if formatter is not None:
+                    handler.setFormatter(formatter)
+        except:
+            for _, sink in sinks:
+                self.shared_sinks.release(sink, self.close_handler)
+            if handler is not None:
+                handler.close()
+            raise
+        if sink_specs is not None:
+            self.sinks = sinks
+        self.handler = handler
+
+    def configure_exc_cache(self, size):
+        """
+        Remember the last `size` tracebacks sent by the client, which may
+        then refer to them instead of sending them again.
+        """
+        if size is None:
+            return
+        if (not isinstance(size, int) or isinstance(size, bool)
+                or not 0 < size <= self.max_exc_cache):
+            raise ProtocolError("an '--exc-cache' size between 1 and %d" %
+                                self.max_exc_cache, size)
+        self.exc_cache = collections.OrderedDict()
+        self.exc_cache_size = size
+        self.exc_cache_bytes = 0
+
+    def configure_field_ids(self, size):
+        """
+        Accept up to `size` numbered strings from the client (see
+        `resolve_fields`).
+        """
+        if size is None:
+            return
+        if (not isinstance(size, int) or isinstance(size, bool)
+                or not 0 < size <= self.max_field_dictionary):
+            raise ProtocolError("a '--field-dictionary' size between 1 and "
+                                "%d" % self.max_field_dictionary, size)
+        self.field_ids = []
+        self.field_ids_size = size
+
+    def configure_relay(self, options):
+        """
+        Make this the channel of a `relay.RelayForwarder`, whose records
+        arrive in batches and are routed to the sinks it declares.
+        """
+        if (not isinstance(options, dict)
+                or options.get('compress') not in (None, 'zlib')):
+            raise ProtocolError("relay options with a null or \"zlib\" "
+                                "'compress'", options)
+        self.routes = {}
+        self.relay_compress = options.get('compress') == 'zlib'
+
+    def make_handler(self, params):
+        try:
+            return self.handler_class(**params)
+        except TypeError as err:
+            raise ProtocolError("valid parameters for "
+                                "`%s`" % self.handler_class.__name__,
+                                err.args[0])
+
+    def formatter_for(self, format_params):
+        """
+        Return the formatter for the '--format' parameters given, or the
+        default formatter if there are none.
+        """
+        if format_params is None:
+            return self.default_formatter
+        if not isinstance(format_params, dict):
+            raise ProtocolError("a JSON dict for '--format'", format_params)
+        try:
+            return self.make_formatter(**format_params)
+        except (TypeError, ValueError) as e:
+            raise ProtocolError("valid formatter parameters", e.args[0])
+
+    def open_sink(self, spec):
+        """
+        Return a `(level, handler)` pair for the sink described by `spec`,
+        sharing the handler with any other channel using the same sink.
+        """
+        if not isinstance(spec, dict) or '--level' not in spec:
+            raise ProtocolError("a sink dict with a '--level' key", spec)
+        spec = dict(spec)
+        level = self.check_level(spec.pop('--level'))
+        format_params = spec.pop('--format', None)
+        formatter = self.formatter_for(format_params)
+
+        def factory():
+            handler = self.make_handler(spec)
+            if formatter is not None:
+                handler.setFormatter(formatter)
+            return handler
+
+        key = self.shared_sinks.make_key(self.handler_class, spec,
+                                         format_params)
+        return level, self.shared_sinks.acquire(key, factory)
+
+    @staticmethod
+    def check_level(level):
+        try:
+            return logging._checkLevel(level)
+        except (TypeError, ValueError) as err:
+            raise ProtocolError("a valid level", err.args[0])
 
     def confirm_log(self):
         msg = self.find_term()
         if msg is not None:
             if msg != 'LOG\n':
                 raise ProtocolError("'LOG\n'", msg)
-            self.write_buf = 'OK\n'
-            self.status = 'LOG-HEADER'
+            self.reply('OK\n')
+            self.state = self.LOG_HEADER
+            self.remaining = self.NUM_LEN_BYTES
 
     def receive_by_len(self):
         data = self.recv(self.remaining)
-        self.read_buf.append(data)
+        self.bytes_in += len(data)
         self.remaining -= len(data)
         if self.remaining == 0:
-            all_data = b''.join(self.read_buf)
-            self.read_buf = []
-            return all_data
+            return self.take(data)
+        self.buffer(data)
         return None
 
     def receive_header(self):
@@ -180,26 +535,194 @@ class LoggingChannel(StrictDispatcher):
         if data is not None:
             slen = struct.unpack(">L", data)[0]
             if slen == 0:
-                self.status = 'MESSAGING'
+                self.state = self.MESSAGING
             else:
-                self.status = 'LOGGING'
+                self.state = self.LOGGING
             self.remaining = slen
 
     def receive_log(self):
         data = self.receive_by_len()
         if data is not None:
-            self.status = 'LOG-HEADER'
+            self.state = self.LOG_HEADER
             self.remaining = self.NUM_LEN_BYTES
+            if self.multiplexed:
+                self.receive_multiplexed(data)
+            elif self.routes is not None:
+                self.receive_batch(data)
+            else:
+                log_record = self.decode_record(data)
+                if self.exc_cache is not None:
+                    self.resolve_exc(log_record)
+                if self.field_ids is not None:
+                    self.resolve_fields(log_record)
+                self.records_in += 1
+                self.emit(log_record)
+
+    @staticmethod
+    def decode_record(data):
+        try:
+            log_dict = pickle.loads(data)
+        except Exception as err:
+            raise ProtocolError("a valid pickled object", err.args)
+        try:
+            return logging.makeLogRecord(log_dict)
+        except Exception:
+            raise ProtocolError("a pickled log-record dict", log_dict)
+
+    def resolve_exc(self, record):
+        """
+        Fill in the traceback of `record` if it only refers to one sent
+        earlier, and remember the traceback it carries otherwise.
+
+        Clients keep the same LRU order of references, and the same limits
+        on their number and total size, as we do (see
+        `client.SocketForwarder.exc_cache_size`), so they never refer to a
+        traceback we have forgotten.
+
+        """
+        ref = record.__dict__.pop('exc_ref', None)
+        if ref is None:
+            return
+        if not isinstance(ref, bytes):
+            raise ProtocolError("a bytes traceback reference", ref)
+        cache = self.exc_cache
+        if record.exc_text is None:
             try:
-                log_dict = pickle.loads(data)
-            except Exception as err:
-                raise ProtocolError("a valid pickled object", err.args)
+                record.exc_text = cache[ref]
+            except KeyError:
+                raise ProtocolError("a known traceback reference", ref)
+            cache.move_to_end(ref)
+        else:
+            self.remember_exc(ref, record.exc_text)
+
+    def remember_exc(self, ref, text):
+        """
+        Add the traceback `text` to the cache, forgetting the least recently
+        used ones beyond `exc_cache_size` or `EXC_CACHE_BYTES`.
+        """
+        if not isinstance(text, str):
+            raise ProtocolError("a traceback string", text)
+        size = len(text.encode('UTF-8', 'surrogatepass'))
+        if size > EXC_CACHE_BYTES:
+            raise ProtocolError("a traceback of at most %d bytes to refer to"
+                                % EXC_CACHE_BYTES, "%d bytes" % size)
+        cache = self.exc_cache
+        old = cache.pop(ref, None)
+        if old is not None:
+            self.exc_cache_bytes -= len(old.encode('UTF-8', 'surrogatepass'))
+        cache[ref] = text
+        self.exc_cache_bytes += size
+        while (len(cache) > self.exc_cache_size
+               or self.exc_cache_bytes > EXC_CACHE_BYTES):
+            _, text = cache.popitem(last=False)
+            self.exc_cache_bytes -= len(text.encode('UTF-8', 'surrogatepass'))
+
+    def resolve_fields(self, record):
+        """
+        Replace the numbers standing for strings in `record`, and learn the
+        strings it numbers for the first time.
+
+        The strings are interned, so that every channel's records share a
+        single copy of each.
+
+        """
+        table = self.field_ids
+        d = record.__dict__
+        for field in FIELD_DICTIONARY:
+            value = d.get(field)
+            if value.__class__ is int:
+                if not 0 <= value < len(table):
+                    raise ProtocolError("a known field number", value)
+                d[field] = table[value]
+            elif value.__class__ is tuple:
+                if (len(value) != 2 or value[0] != len(table)
+                        or value[1].__class__ is not str
+                        or len(table) >= self.field_ids_size):
+                    raise ProtocolError("a pair of the next field number "
+                                        "and a string", value)
+                string = sys.intern(value[1])
+                table.append(string)
+                d[field] = string
+
+    def receive_multiplexed(self, data):
+        """
+        Deliver a record to each of the streams set in its bitmap.
+        """
+        size = self.STREAM_BITMAP.size
+        if len(data) <= size:
+            raise ProtocolError("a stream bitmap and a record",
+                                "%d bytes" % len(data))
+        bits = self.STREAM_BITMAP.unpack_from(data)[0]
+        record = self.decode_record(memoryview(data)[size:])
+        if self.exc_cache is not None:
+            self.resolve_exc(record)
+        if self.field_ids is not None:
+            self.resolve_fields(record)
+        self.records_in += 1
+        if self.scheduler is not None:
+            if not self.scheduler.observe(self, record):
+                return
+        while bits:
+            low = bits & -bits
+            bits ^= low
+            sink = self.routes.get(low.bit_length() - 1)
+            if sink is None:
+                raise ProtocolError("a declared stream",
+                                    low.bit_length() - 1)
+            level, handler = sink
+            if record.levelno >= level:
+                self.deliver(handler, record)
+
+    def receive_batch(self, data):
+        """
+        Route each record of a relayed batch to its declared sink.
+        """
+        try:
+            if self.relay_compress:
+                data = zlib.decompress(data)
+            batch = pickle.loads(data)
+        except Exception as err:
+            raise ProtocolError("a valid relayed batch", err.args)
+        for route, log_dict in batch:
+            sink = self.routes.get(route)
+            if sink is None:
+                raise ProtocolError("a declared route", route)
             try:
-                log_record = logging.makeLogRecord(log_dict)
+                record = logging.makeLogRecord(log_dict)
             except Exception:
                 raise ProtocolError("a pickled log-record dict", log_dict)
-            else:
-                self.handler.emit(log_record)
+            self.records_in += 1
+            if self.scheduler is not None:
+                # A shed channel's routes are gone with the rest of it
+                if not self.scheduler.observe(self, record):
+                    return
+            level, handler = sink
+            if record.levelno >= level:
+                self.deliver(handler, record)
+
+    def emit(self, record):
+        if self.scheduler is not None:
+            if not self.scheduler.observe(self, record):
+                return
+        if self.handler is not None:
+            self.deliver(self.handler, record)
+        if self.sinks is not None:
+            for level, handler in self.sinks:
+                if record.levelno >= level:
+                    self.deliver(handler, record)
+
+    def deliver(self, handler, record):
+        if self.subscriptions.subscriptions:
+            self.subscriptions.publish(record, handler)
+        if self.writers is None:
+            handler.emit(record)
+            return
+        writer = self.writers.writer_for(handler)
+        if writer.put(handler, record):
+            # The whole channel waits, even if only this sink is behind
+            self.blocked_on = writer
+            writer.wait(self)
+            self.interest_changed()
 
     def receive_msg(self):
         msg = self.find_term()
@@ -216,27 +739,388 @@ class LoggingChannel(StrictDispatcher):
                                         "a " + params.__class__.__name__)
                 try:
                     self.format(**params)
-                except TypeError as e:
+                except (TypeError, ValueError) as e:
                     raise ProtocolError("valid formatter parameters",
                                         e.args[0])
+                if self.params is not None:
+                    self.params['--format'] = params
+                self.state = self.LOG_HEADER
+                self.remaining = self.NUM_LEN_BYTES
+            elif head == 'ROUTE' and self.routes is not None:
+                self.state = self.LOG_HEADER
+                self.remaining = self.NUM_LEN_BYTES
+                self.declare_route(msg)
             elif head == 'QUIT\n':
                 self.close()
             else:
                 raise ProtocolError("One of 'FORMAT' or 'QUIT'",
                                     msg)
 
-    def format(self, fmt=None, datefmt=None, style='%'):
-        formatter = logging.Formatter(fmt, datefmt, style=style)
+    def declare_route(self, msg):
+        try:
+            route, spec = msg.split(' ', 2)[1:]
+            route = int(route)
+            spec = json.loads(spec)
+        except ValueError:
+            raise ProtocolError("'ROUTE <id> <sink spec>'", msg)
+        if self.multiplexed and not 0 <= route < 8 * self.STREAM_BITMAP.size:
+            raise ProtocolError("a stream id below %d" %
+                                (8 * self.STREAM_BITMAP.size), route)
+        self.open_route(route, spec)
+        self.reply('OK\n')
+
+    def open_route(self, route, spec):
+        sink = self.open_sink(spec)
+        old = self.routes.get(route)
+        self.routes[route] = sink
+        if old is not None:
+            self.shared_sinks.release(old[1], self.close_handler)
+        # Kept for `handoff_state`
+        self.params.setdefault('--routes', {})[route] = spec
+
+    def make_formatter(self, fmt=None, datefmt=None, style='%', fields=None):
+        if style == 'json':
+            return JSONFormatter(fields, datefmt)
+        return logging.Formatter(fmt, datefmt, style=style)
+
+    def format(self, **params):
+        formatter = self.make_formatter(**params)
+        if self.handler is None:
+            raise ProtocolError("a channel with a handler of its own",
+                                "a FORMAT message for shared sinks")
         self.handler.setFormatter(formatter)
-        self.write_buf = 'OK\n'
+        self.reply('OK\n')
+
+    def reply(self, msg):
+        """
+        Queue `msg` for the client behind anything not yet sent.
+        """
+        buf = self._write_buf
+        if isinstance(buf, bytearray):
+            # Grown in place, where the setter cannot see the change
+            old_len = len(buf)
+            buf += msg.encode('UTF-8')
+            self.write_buf_resized(old_len)
+        else:
+            if isinstance(buf, str):
+                buf = buf.encode('UTF-8')
+            self.write_buf = bytearray(buf) + msg.encode('UTF-8')
 
     def alert_error(self, err):
-        self.write_buf = ('ERROR %s' % err.args[0]).encode('UTF-8')
+        # The message may quote the client's own newline-terminated text
+        self.reply('ERROR %s\n' % str(err.args[0]).replace('\n', '\\n'))
+
+    def handoff_state(self):
+        """
+        Return what another process needs to carry on serving this
+        connection, as a JSON-serializable dict (see `logserv.handoff`).
+        """
+        write_buf = self.write_buf
+        if isinstance(write_buf, str):
+            write_buf = write_buf.encode('UTF-8')
+        return {'status': self.status,
+                'remaining': self.remaining,
+                'pending': base64.b64encode(self.pending).decode('ascii'),
+                'write_buf': base64.b64encode(write_buf).decode('ascii'),
+                'params': self.params,
+                'subscription': self.subscription_state(),
+                'exc_cache': None if self.exc_cache is None else [
+                    [base64.b64encode(ref).decode('ascii'), text]
+                    for ref, text in self.exc_cache.items()],
+                'field_ids': self.field_ids}
+
+    def subscription_state(self):
+        if self.subscription is None:
+            return None
+        # The queued records are not handed over; they count as dropped
+        subscription = self.subscription
+        return {'filter': subscription.spec,
+                'dropped': subscription.unreported + sum(
+                    1 for frame in subscription.queue
+                    if not frame.startswith(b'\x00\x00\x00\x00'))}
+
+    @classmethod
+    def restore(cls, sock, map, state):
+        """
+        Create a channel for `sock` picking up from `handoff_state`.
+        """
+        channel = cls(sock, map)
+        try:
+            params = state['params']
+            if params is not None:
+                routes = params.pop('--routes', {})
+                channel.configure(dict(params))
+                channel.params = params
+                for route, spec in routes.items():
+                    channel.open_route(int(route), spec)
+            for ref, text in state.get('exc_cache') or ():
+                channel.remember_exc(base64.b64decode(ref), text)
+            for string in state.get('field_ids') or ():
+                channel.field_ids.append(sys.intern(string))
+            subscription = state.get('subscription')
+            if subscription is not None:
+                channel.subscription = channel.subscriptions.subscribe(
+                    channel, subscription['filter'])
+                channel.subscription.unreported = subscription['dropped']
+            channel.status = state['status']
+            channel.remaining = state['remaining']
+            pending = base64.b64decode(state['pending'])
+            if pending:
+                channel.buffer(pending)
+            channel.write_buf = base64.b64decode(state['write_buf'])
+        except:
+            channel.close()
+            raise
+        return channel
 
     def close(self):
         super().close()
-        self.read_buf = []
+        self.state = self.CLOSED
+        self.release_buffer()
         self.write_buf = b''
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.scheduler is not None:
+            self.scheduler.forget(self)
+        if self.subscription is not None:
+            self.subscriptions.unsubscribe(self.subscription)
+            self.subscription = None
+        if self.handler is not None:
+            # A `CachedFiles` handler also leaves its `FileCache` here
+            self.close_handler(self.handler)
+            self.handler = None
+        if self.sinks is not None:
+            for _, handler in self.sinks:
+                self.shared_sinks.release(handler, self.close_handler)
+            self.sinks = None
+        if self.routes is not None:
+            for _, handler in self.routes.values():
+                self.shared_sinks.release(handler, self.close_handler)
+            self.routes = None
+
+    def close_handler(self, handler):
+        """
+        Close `handler` once the records handed to it have been written.
+        """
+        if self.writers is None:
+            handler.close()
+        else:
+            self.writers.close_handler(handler)
+
+
+class SeqPacketChannel(LoggingChannel):
+
+    """
+    A channel for `AF_UNIX`/`SOCK_SEQPACKET` connections.
+
+    The protocol is unchanged, but the kernel delivers each message sent by
+    the client (a handshake line or a whole log record with its length
+    header) as one packet, so a frame never takes more than one `recv`.
+    Each time the socket becomes readable up to `batch_size` packets are
+    received and processed.
+
+    """
+
+    __slots__ = ('packet', 'offset')
+
+    max_packet = 1 << 20
+    batch_size = 64
+
+    def __init__(self, sock=None, map=None):
+        super().__init__(sock, map)
+        self.packet = b''
+        self.offset = 0
+
+    def recv_packet(self):
+        """
+        Return the next packet, or None if there is none waiting.
+        """
+        # Received into a pooled buffer, and only the packet copied out
+        buf = self.buffers.acquire(self.max_packet)
+        try:
+            with memoryview(buf) as view:
+                nbytes, _, flags, _ = self.socket.recvmsg_into(
+                    [view[:self.max_packet]])
+                data = bytes(view[:nbytes])
+        except BlockingIOError:
+            return None
+        except OSError as why:
+            if why.args[0] in asyncore._DISCONNECTED:
+                self.handle_close()
+                return None
+            raise
+        finally:
+            self.buffers.release(buf)
+        if not data:
+            self.handle_close()
+            return None
+        if flags & socket.MSG_TRUNC:
+            raise ProtocolError("a packet of at most %d bytes" %
+                                self.max_packet, "a longer packet")
+        return data
+
+    def recv(self, buffer_size):
+        # The state machine reads from the current packet
+        data = self.packet[self.offset:self.offset + buffer_size]
+        self.offset += len(data)
+        return data
+
+    def handle_read(self):
+        for _ in range(self.batch_size):
+            try:
+                packet = self.recv_packet()
+            except ProtocolError as err:
+                self.alert_error(err)
+                continue
+            if packet is None:
+                break
+            self.packet, self.offset = packet, 0
+            while self.offset < len(self.packet) and self.connected:
+                super().handle_read()
+            self.packet = b''
+            if not self.connected or not self.readable():
+                break
+
+
+class RingChannel(LoggingChannel):
+
+    """
+    A channel whose client may move its stream into a shared-memory ring.
+
+    In the WAITING state the client may send
+
+        'RING <name>\n'
+
+    instead of 'LOG\n', naming a `ring.Ring` it has created. The server
+    attaches to it, responds 'OK\n', and from then on reads the client's
+    records and messages from the ring. Anything arriving on the socket is
+    only a wakeup, upon which the server drains every active ring, up to
+    `batch_size` steps each.
+
+    The client only wakes us when its ring was empty, so a ring left with
+    records (after `batch_size` steps, or while the channel may not read)
+    is drained again through a `Waker` on the channel's map, once the
+    channel can read.
+
+    """
+
+    __slots__ = ('ring', 'drain_scheduled')
+
+    batch_size = 256
+    # Channels whose ring is attached; shared by all ring channels
+    active = set()
+    # A `Waker` per socket map, created when first needed
+    wakers = {}
+
+    def __init__(self, sock=None, map=None):
+        super().__init__(sock, map)
+        self.ring = None
+        self.drain_scheduled = False
+
+    def confirm_log(self):
+        msg = self.find_term()
+        if msg is not None:
+            if msg.startswith('RING '):
+                try:
+                    self.ring = Ring.attach(msg[5:-1])
+                except (OSError, ValueError) as err:
+                    raise ProtocolError("the name of a logserv ring",
+                                        str(err))
+                self.active.add(self)
+            elif msg != 'LOG\n':
+                raise ProtocolError("'LOG\n' or 'RING <name>\n'", msg)
+            self.reply('OK\n')
+            self.state = self.LOG_HEADER
+            self.remaining = self.NUM_LEN_BYTES
+
+    def handoff_state(self):
+        state = super().handoff_state()
+        state['ring'] = None if self.ring is None else self.ring.name
+        return state
+
+    @classmethod
+    def restore(cls, sock, map, state):
+        channel = super().restore(sock, map, state)
+        if state.get('ring') is not None:
+            try:
+                channel.ring = Ring.attach(state['ring'])
+            except:
+                channel.close()
+                raise
+            channel.active.add(channel)
+            # The client only wakes us when its ring was empty
+            channel.drain()
+        return channel
+
+    def recv(self, buffer_size):
+        if self.ring is None:
+            return super().recv(buffer_size)
+        return self.ring.read(buffer_size)
+
+    def handle_read(self):
+        if self.ring is None:
+            super().handle_read()
+            return
+        try:
+            # Wakeups carry no data; EOF closes the channel (after draining)
+            asyncore.dispatcher.recv(self, 4096)
+        except BlockingIOError:  # pragma: no cover
+            pass
+        for channel in list(self.active):
+            channel.drain()
+
+    def check_timeout(self):
+        if self.ring is not None and len(self.ring) and self.readable():
+            # Records the client left without a wakeup count as activity
+            # only once read; stranded ones are read here
+            self.drain()
+        super().check_timeout()
+
+    def interest_changed(self):
+        super().interest_changed()
+        # Resumed by a writer or the scheduler with records left over
+        if (self.ring is not None and not self.drain_scheduled
+                and self.connected and len(self.ring) and self.readable()):
+            self.schedule_drain()
+
+    def schedule_drain(self):
+        """
+        Drain the ring again on the next loop iteration.
+        """
+        entry = self.wakers.get(id(self._map))
+        if entry is None or entry[0] is not self._map:
+            entry = self.wakers[id(self._map)] = (self._map,
+                                                  Waker(self._map))
+        self.drain_scheduled = True
+        entry[1].call(self.scheduled_drain)
+
+    def scheduled_drain(self):
+        self.drain_scheduled = False
+        self.drain()
+
+    def drain(self):
+        steps = 0
+        while (self.ring is not None and len(self.ring) and self.connected
+               and self.readable() and steps < self.batch_size):
+            super().handle_read()
+            steps += 1
+        if (steps == self.batch_size and not self.drain_scheduled
+                and self.connected and self.ring is not None
+                and len(self.ring)):
+            # Not to starve the other channels, the rest comes next time
+            self.schedule_drain()
+
+    def handle_close(self):
+        self.drain()
+        self.close()
+
+    def close(self):
+        super().close()
+        self.active.discard(self)
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
 
 
 class LogServer(StrictDispatcher):
@@ -244,16 +1128,59 @@ class LogServer(StrictDispatcher):
     channel_class = LoggingChannel
     logging_map = {}
     socket_family = socket.AF_INET
+    socket_type = socket.SOCK_STREAM
+    # Connections the kernel may queue while the loop is busy
+    listen_backlog = socket.SOMAXCONN
+    # Connections accepted each time the socket is readable
+    accept_batch = 64
 
-    def __init__(self, socket_path):
+    def __init__(self, socket_path=None, map=None, sock=None):
+        # A map of its own lets several servers share a process
+        if map is not None:
+            self.logging_map = map
+        if sock is not None:
+            # Already listening, e.g. handed over by `handoff.hand_over`
+            super().__init__(sock, map=self.logging_map)
+            self.accepting = True
+            return
         super().__init__(map=self.logging_map)
         try:
-            self.create_socket(self.socket_family, socket.SOCK_STREAM)
+            self.create_socket(self.socket_family, self.socket_type)
             self.bind(socket_path)
-            self.listen(5)
+            self.listen(self.listen_backlog)
         except:  # pragma: no cover
             self.close()
             raise
 
+    def handle_accept(self):
+        # A reconnect storm is drained in a few loop iterations, not one
+        # iteration per connection
+        for _ in range(self.accept_batch):
+            pair = self.accept()
+            if pair is None:
+                break
+            self.handle_accepted(*pair)
+
     def handle_accepted(self, conn, addr):
         self.channel_class(conn, self.logging_map)
+
+
+class SeqPacketServer(LogServer):
+
+    """
+    A server for local clients using `client.SeqPacketClient`.
+    """
+
+    channel_class = SeqPacketChannel
+    socket_family = socket.AF_UNIX
+    socket_type = socket.SOCK_SEQPACKET
+
+
+class RingServer(LogServer):
+
+    """
+    A Unix-socket server for local clients using `client.RingClient`.
+    """
+
+    channel_class = RingChannel
+    socket_family = socket.AF_UNIX
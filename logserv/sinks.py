@@ -0,0 +1,70 @@
+"""
+Handlers shared between channels.
+
+A client may ask for its records to go to several sinks at once, by listing
+them under the '--sinks' key of its IDENTIFY parameters:
+
+    IDENTIFY {"--level": 0,
+              "--sinks": [{"--level": 0, "filename": "app.log"},
+                          {"--level": 40, "filename": "errors.log"}]}
+
+Each sink spec holds a '--level', an optional '--format' and the handler
+parameters. Channels asking for the same sink (same handler parameters and
+format) share a single handler, so each record is decoded once per channel
+and written by one handler per file. Sinks are reference counted and closed
+when the last channel using them goes away; with a `writer.WriterPool`, on
+the sink's writer thread once the records queued for it are written.
+
+"""
+
+import json
+
+
+class SinkRegistry:
+
+    """
+    Hands out shared handlers keyed by their parameters.
+    """
+
+    def __init__(self):
+        self.sinks = {}
+        self.keys = {}
+
+    @staticmethod
+    def make_key(handler_class, params, format_params):
+        return (handler_class, json.dumps(params, sort_keys=True),
+                json.dumps(format_params, sort_keys=True))
+
+    def acquire(self, key, factory):
+        """
+        Return the handler for `key`, calling `factory()` to create it if
+        no channel is using it yet.
+        """
+        entry = self.sinks.get(key)
+        if entry is None:
+            handler = factory()
+            entry = self.sinks[key] = [handler, 0]
+            self.keys[id(handler)] = key
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, handler, close=None):
+        """
+        Drop a reference to `handler`, and once no channel uses it close it
+        with `close(handler)` (by default, `handler.close()`).
+        """
+        key = self.keys.get(id(handler))
+        if key is None:
+            return
+        entry = self.sinks[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self.sinks[key]
+            del self.keys[id(handler)]
+            if close is None:
+                handler.close()
+            else:
+                close(handler)
+
+    def __len__(self):
+        return len(self.sinks)
@@ -0,0 +1,269 @@
+"""
+Live tails of the records passing through a server.
+
+Instead of identifying itself as a logging client, a connection may ask to
+follow the records the server is writing: after the HELLO exchange it
+sends
+
+    'SUBSCRIBE <filter>\n'
+
+where <filter> is a JSON dict with any of the keys
+
+    'level'     the lowest level of the records wanted
+    'logger'    a logger name; records of that logger and its children only
+    'file'      a file name; records written to that file only (relative
+                names are relative to the server)
+    'contains'  a substring of the records' messages
+
+The server responds 'OK\n', and from then on writes every matching record
+it delivers to a handler in the log-record format the clients use
+(`len-bytes pickle-data`). The subscriber may only send 'QUIT\n'.
+
+Records are queued for each subscriber up to `SubscriptionHub.max_queued`
+bytes. A subscriber that cannot keep up misses the records that do not
+fit, and is told how many with a message like the clients' own:
+
+    "\x00\x00\x00\x00DROPPED <count>\n"
+
+The server never waits for its subscribers, so a slow tail cannot slow
+down the clients. `Subscriber` is a blocking client for this.
+
+"""
+
+import collections
+import json
+import logging
+import os
+import pickle
+import socket
+import struct
+
+from . import ProtocolError, VersionMismatchError
+
+_HEADER = struct.Struct('>L')
+
+
+class Subscription:
+
+    """
+    The filter and send queue of one subscribed channel.
+    """
+
+    fields = ('level', 'logger', 'file', 'contains')
+
+    def __init__(self, channel, spec, max_queued):
+        if not isinstance(spec, dict) or not set(spec) <= set(self.fields):
+            raise ProtocolError("a filter dict with keys among %s" %
+                                ', '.join(self.fields), spec)
+        self.channel = channel
+        self.level = self.check_level(spec.get('level', 0))
+        self.logger = self.check_str(spec, 'logger')
+        self.file = self.check_str(spec, 'file')
+        if self.file is not None:
+            self.file = os.path.abspath(self.file)
+        self.contains = self.check_str(spec, 'contains')
+        self.spec = spec
+        self.max_queued = max_queued
+        self.queue = collections.deque()
+        self.queued = 0
+        self.dropped = 0
+        self.unreported = 0
+
+    @staticmethod
+    def check_level(level):
+        try:
+            return logging._checkLevel(level)
+        except (TypeError, ValueError) as err:
+            raise ProtocolError("a valid level", err.args[0])
+
+    @staticmethod
+    def check_str(spec, key):
+        value = spec.get(key)
+        if value is not None and not isinstance(value, str):
+            raise ProtocolError("a string for %r" % key, value)
+        return value
+
+    def matches(self, record, handler):
+        if record.levelno < self.level:
+            return False
+        if self.logger is not None:
+            name = record.name
+            if name != self.logger and not name.startswith(self.logger + '.'):
+                return False
+        if (self.file is not None
+                and getattr(handler, 'baseFilename', None) != self.file):
+            return False
+        if self.contains is not None:
+            return self.contains in record.getMessage()
+        return True
+
+    def push(self, frame):
+        """
+        Queue `frame`, or count it as dropped if the queue is full.
+        """
+        if self.queued + len(frame) > self.max_queued:
+            self.dropped += 1
+            self.unreported += 1
+            return
+        was_empty = not self.queue
+        if self.unreported:
+            notice = b'\x00\x00\x00\x00DROPPED %d\n' % self.unreported
+            self.unreported = 0
+            self.queue.append(notice)
+            self.queued += len(notice)
+        self.queue.append(frame)
+        self.queued += len(frame)
+        if was_empty:
+            self.channel.interest_changed()
+
+    def take(self, size):
+        """
+        Remove and return queued frames totalling about `size` bytes.
+        """
+        frames = []
+        taken = 0
+        queue = self.queue
+        while queue and taken < size:
+            frame = queue.popleft()
+            frames.append(frame)
+            taken += len(frame)
+        self.queued -= taken
+        return b''.join(frames)
+
+
+class SubscriptionHub:
+
+    """
+    The subscriptions of the channels sharing a hub, which are fed every
+    record the channels deliver.
+    """
+
+    def __init__(self, max_queued=1 << 20):
+        self.max_queued = max_queued
+        self.subscriptions = []
+        # The record last published, and its frame once made
+        self.last = None
+        self.frame = None
+
+    def subscribe(self, channel, spec):
+        subscription = Subscription(channel, spec, self.max_queued)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        try:
+            self.subscriptions.remove(subscription)
+        except ValueError:
+            pass
+
+    def publish(self, record, handler):
+        """
+        Queue `record`, which is being delivered to `handler`, for the
+        subscriptions it matches.
+        """
+        # A record delivered to several handlers is published each time,
+        # but only subscriptions to a file may take it more than once
+        again = record is self.last
+        if not again:
+            self.last, self.frame = record, None
+        for subscription in self.subscriptions:
+            if again and subscription.file is None:
+                continue
+            if subscription.matches(record, handler):
+                if self.frame is None:
+                    data = pickle.dumps(record.__dict__, 1)
+                    self.frame = _HEADER.pack(len(data)) + data
+                subscription.push(self.frame)
+
+
+class Subscriber:
+
+    """
+    A blocking client following the records of the server at `address`
+    that match the filter given as keyword arguments.
+
+        for record in Subscriber(('loghost', 9020), level='ERROR'):
+            print(record.getMessage())
+
+    `dropped` counts the records the server reported as dropped.
+
+    """
+
+    version_str = "1.0"
+
+    def __init__(self, address, family=socket.AF_INET, timeout=None,
+                 **spec):
+        self.address = address
+        self.family = family
+        self.timeout = timeout
+        self.spec = spec
+        self.sock = None
+        self.buf = b''
+        self.dropped = 0
+
+    def connect(self):
+        self.sock = socket.socket(self.family, socket.SOCK_STREAM)
+        try:
+            self.sock.settimeout(self.timeout)
+            self.sock.connect(self.address)
+            self.sock.sendall(b'HELLO %s\n' % self.version_str.encode())
+            resp = self.read_line()
+            if resp != 'HELLO 1.0\n':
+                raise VersionMismatchError("Unexpected greeting %r" % resp)
+            self.sock.sendall(
+                ('SUBSCRIBE %s\n' % json.dumps(self.spec)).encode('UTF-8'))
+            resp = self.read_line()
+            if resp != 'OK\n':
+                raise ProtocolError("'OK\n'", resp)
+        except:
+            self.close()
+            raise
+
+    def read(self, size):
+        while len(self.buf) < size:
+            data = self.sock.recv(65536)
+            if not data:
+                raise EOFError("the server closed the connection")
+            self.buf += data
+        data, self.buf = self.buf[:size], self.buf[size:]
+        return data
+
+    def read_line(self):
+        while b'\n' not in self.buf:
+            data = self.sock.recv(4096)
+            if not data:
+                raise EOFError("the server closed the connection")
+            self.buf += data
+        line, self.buf = self.buf.split(b'\n', 1)
+        return line.decode('UTF-8') + '\n'
+
+    def next_record(self):
+        """
+        Wait for and return the next matching record.
+        """
+        if self.sock is None:
+            self.connect()
+        while True:
+            size = _HEADER.unpack(self.read(_HEADER.size))[0]
+            if size:
+                return logging.makeLogRecord(pickle.loads(self.read(size)))
+            msg = self.read_line()
+            if not msg.startswith('DROPPED '):
+                raise ProtocolError("'DROPPED <count>\n'", msg)
+            self.dropped += int(msg[8:])
+
+    def __iter__(self):
+        try:
+            while True:
+                yield self.next_record()
+        except EOFError:
+            return
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.sendall(b'QUIT\n')
+            except OSError:
+                pass
+            self.sock.close()
+            self.sock = None
@@ -0,0 +1,167 @@
+import asyncore
+import json
+import logging
+import os
+import pickle
+import pstats
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from .. import admin, server
+
+
+def busy_loop(done):
+    while not done.is_set():
+        sum(range(100))
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_buckets(self):
+        h = admin.Histogram()
+        for seconds in (0.0000005, 0.000003, 0.000003, 0.001):
+            h.add(seconds)
+        report = h.report()
+        self.assertEqual(report['count'], 4)
+        self.assertEqual(report['max'], 0.001)
+        self.assertEqual(report['buckets'],
+                         {'<1us': 1, '<4us': 2, '<1024us': 1})
+
+
+class TestSessions(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'out')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_timing_patches_and_restores(self):
+        original = server.LoggingChannel.__dict__['dispatch_read']
+        loads = pickle.loads
+        session = admin.TimingSession(self.path)
+        session.start()
+        self.assertIsNot(server.LoggingChannel.__dict__['dispatch_read'],
+                         original)
+        pickle.loads(pickle.dumps({'msg': 'x'}))
+        logging.makeLogRecord({'msg': 'x'})
+        session.stop()
+        self.assertIs(server.LoggingChannel.__dict__['dispatch_read'],
+                      original)
+        self.assertIs(pickle.loads, loads)
+        with open(self.path) as f:
+            report = json.load(f)
+        self.assertEqual(set(report), {'dispatch_read', 'pickle.loads',
+                                       'makeLogRecord', 'emit'})
+        self.assertEqual(report['pickle.loads']['count'], 1)
+        self.assertEqual(report['makeLogRecord']['count'], 1)
+
+    def test_sampling(self):
+        done = threading.Event()
+        busy = threading.Thread(target=busy_loop, args=(done,))
+        busy.start()
+        session = admin.SamplingSession(self.path, busy.ident, 0.001)
+        session.start()
+        time.sleep(0.05)
+        session.stop()
+        done.set()
+        busy.join()
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertIn('busy_loop (admin.py:', stack.split(';')[-1])
+        self.assertGreater(int(count), 0)
+
+    def test_profile(self):
+        session = admin.ProfileSession(self.path)
+        session.start()
+        sum(range(1000))
+        session.stop()
+        self.assertIsInstance(pstats.Stats(self.path), pstats.Stats)
+
+
+class TestAdminServer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'admin.sock')
+        self.map = {}
+        self.server = admin.AdminServer(self.path, self.map)
+        self.conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.conn.connect(self.path)
+        self.conn.settimeout(0)
+
+    def tearDown(self):
+        self.conn.close()
+        self.server.close()
+        asyncore.close_all(self.map)
+        shutil.rmtree(self.tmp)
+
+    def ask(self, command, timeout=5):
+        self.conn.sendall(command.encode() + b'\n')
+        data = b''
+        deadline = time.time() + timeout
+        while not data.endswith(b'\n'):
+            if time.time() > deadline:  # pragma: no cover
+                self.fail("no reply")
+            asyncore.poll(0.01, self.map)
+            try:
+                data += self.conn.recv(1024)
+            except BlockingIOError:
+                pass
+        return data.decode()[:-1]
+
+    def test_socket_private(self):
+        mode = stat.S_IMODE(os.stat(self.path).st_mode)
+        self.assertEqual(mode & 0o077, 0)
+
+    def test_umask_untouched(self):
+        path = os.path.join(self.tmp, 'other.sock')
+        with mock.patch('os.umask') as umask:
+            other = admin.AdminServer(path, self.map)
+        other.close()
+        umask.assert_not_called()
+
+    def test_time_session(self):
+        out = os.path.join(self.tmp, 'stages.json')
+        self.assertEqual(self.ask('STATUS'), 'OK IDLE')
+        self.assertEqual(self.ask('TIME 60 %s' % out), 'OK')
+        self.assertEqual(self.ask('STATUS'), 'OK TIME %s' % out)
+        self.assertTrue(self.ask('SAMPLE 1 x').startswith('ERROR a TIME'))
+        self.assertEqual(self.ask('STOP'), 'OK')
+        self.assertEqual(self.ask('STATUS'), 'OK IDLE')
+        with open(out) as f:
+            self.assertIn('dispatch_read', json.load(f))
+
+    def test_session_ends_by_itself(self):
+        out = os.path.join(self.tmp, 'stacks.txt')
+        self.assertEqual(self.ask('SAMPLE 0.05 %s' % out), 'OK')
+        deadline = time.time() + 5
+        while self.server.session is not None and time.time() < deadline:
+            asyncore.poll(0.01, self.map)
+        self.assertIsNone(self.server.session)
+        self.assertTrue(os.path.exists(out))
+
+    def test_profile_session(self):
+        out = os.path.join(self.tmp, 'profile.pstats')
+        self.assertEqual(self.ask('PROFILE 60 %s' % out), 'OK')
+        self.assertEqual(self.ask('STOP'), 'OK')
+        self.assertIsInstance(pstats.Stats(out), pstats.Stats)
+
+    def test_bad_commands(self):
+        for command in ('FROB', 'TIME soon x', 'TIME 100000 x', 'STOP',
+                        'TIME 1 %s' % os.path.join(self.tmp, 'no', 'x')):
+            self.assertTrue(self.ask(command).startswith('ERROR '), command)
+        self.assertIsNone(self.server.session)
+
+
+if __name__ == "__main__":
+    unittest.main()
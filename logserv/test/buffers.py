@@ -0,0 +1,32 @@
+import unittest
+
+from .. import buffers
+
+
+class TestBufferPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = buffers.BufferPool(min_size=16, max_size=64, max_free=2)
+
+    def test_sizes(self):
+        self.assertEqual(len(self.pool.acquire(1)), 16)
+        self.assertEqual(len(self.pool.acquire(17)), 32)
+        self.assertEqual(len(self.pool.acquire(32)), 32)
+
+    def test_reuse(self):
+        buf = self.pool.acquire(20)
+        self.pool.release(buf)
+        self.assertIs(self.pool.acquire(30), buf)
+        self.assertIsNot(self.pool.acquire(30), buf)
+
+    def test_limits(self):
+        big = self.pool.acquire(100)
+        self.pool.release(big)
+        self.assertNotIn(128, self.pool.free)
+        for _ in range(3):
+            self.pool.release(bytearray(16))
+        self.assertEqual(len(self.pool.free[16]), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
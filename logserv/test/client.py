@@ -1,11 +1,23 @@
+import asyncio
+import asyncore
+import collections
 import json
 import logging
+import logging.handlers
+import os
+import pickle
+import queue
+import shutil
 import socket
+import struct
+import sys
+import tempfile
+import threading
 import time
 import unittest
 from unittest import mock
 
-from .. import client, ProtocolError, VersionMismatchError
+from .. import client, server, ProtocolError, VersionMismatchError
 from . import utils
 
 
@@ -50,6 +62,19 @@ class TestClientBasics(TestClient):
         self.s.sendtext('Test bytes'.encode('UTF-8'))
         self.s.send.assert_called_once_with('Test bytes'.encode('UTF-8'))
 
+    def test_sendFormat(self):
+        self.s.send = mock.MagicMock()
+        self.s.setFormatter(logging.Formatter('%(message)s', '%H', '%'))
+        self.s.sendFormat()
+        header, msg = [c[0][0] for c in self.s.send.call_args_list]
+        self.assertEqual(header, b'\x00\x00\x00\x00')
+        msg = msg.decode('UTF-8')
+        self.assertTrue(msg.startswith('FORMAT '))
+        self.assertTrue(msg.endswith('\n'))
+        self.assertEqual(json.loads(msg[7:]), {'fmt': '%(message)s',
+                                               'datefmt': '%H',
+                                               'style': '%'})
+
     # test for recv_line in its own test case
 
     def test_handshake_ok(self):
@@ -94,6 +119,16 @@ class TestClientBasics(TestClient):
                        mock.call('LOG\n'.encode('UTF-8'))])
 
 
+class TestSeqPacketClient(TestClient):
+
+    def test_socket_type(self):
+        s = client.SeqPacketClient('/tmp/test.sock', filename='test.log')
+        sock = s.makeSocket()
+        self.mocks['socket'].assert_called_once_with(socket.AF_UNIX,
+                                                     socket.SOCK_SEQPACKET)
+        sock.connect.assert_called_once_with('/tmp/test.sock')
+
+
 class Test_Recv_Line(TestClient):
 
     def setUp(self):
@@ -172,5 +207,479 @@ class TestHandshakeFailures(TestClient):
         self.force()
         self.assertEqual(3, len(self.s.sendtext.call_args_list))
 
+
+class TestAsyncForwarder(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'logserv.sock')
+        self.log = os.path.join(self.tmp, 'app.log')
+        self.map = {}
+        self.stop = threading.Event()
+        self.loop = None
+
+    def start_server(self):
+        class UnixServer(server.LogServer):
+            socket_family = socket.AF_UNIX
+        UnixServer(self.path, self.map)
+        self.loop = threading.Thread(target=self.run_loop, daemon=True)
+        self.loop.start()
+
+    def run_loop(self):
+        while not self.stop.is_set():
+            asyncore.poll(0.005, self.map)
+
+    def tearDown(self):
+        self.stop.set()
+        if self.loop is not None:
+            self.loop.join(5)
+        for obj in list(self.map.values()):
+            if getattr(obj, 'handler', None) is not None:
+                obj.handler.close()
+        asyncore.close_all(self.map)
+        shutil.rmtree(self.tmp)
+
+    def forwarder(self):
+        f = client.AsyncUnixForwarder(self.path, timeout=5, filename=self.log)
+        f.setFormatter(logging.Formatter('%(message)s'))
+        f.retry_start = 0.01
+        return f
+
+    async def wait_for_lines(self, count, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                with open(self.log) as f:
+                    lines = f.read().splitlines()
+            except FileNotFoundError:
+                lines = []
+            if len(lines) >= count:
+                return lines
+            await asyncio.sleep(0.01)
+        return lines
+
+    def test_records_sent_from_loop_and_threads(self):
+        self.start_server()
+
+        async def main():
+            f = self.forwarder()
+            f.emit(exc_record('from the loop'))
+            thread = threading.Thread(
+                target=f.emit, args=(logging.LogRecord(
+                    'app', logging.INFO, __file__, 1, 'from a thread', None,
+                    None),))
+            thread.start()
+            thread.join()
+            lines = await self.wait_for_lines(2)
+            await f.aclose(5)
+            return lines
+
+        lines = asyncio.run(main())
+        self.assertEqual(lines[0], 'from the loop')
+        self.assertIn('from a thread', lines)
+        self.assertTrue(any('ValueError: from the loop' in line
+                            for line in lines))
+
+    def test_waits_for_server_without_blocking(self):
+        async def main():
+            f = self.forwarder()
+            start = time.perf_counter()
+            for i in range(3):
+                f.emit(logging.LogRecord('app', logging.INFO, __file__, 1,
+                                         'early %d' % i, None, None))
+            elapsed = time.perf_counter() - start
+            await asyncio.sleep(0.05)
+            self.assertIsNone(f.writer)
+            self.start_server()
+            lines = await self.wait_for_lines(3)
+            await f.aclose(5)
+            return elapsed, lines
+
+        elapsed, lines = asyncio.run(main())
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(lines, ['early 0', 'early 1', 'early 2'])
+
+    def test_buffer_bound(self):
+        async def main():
+            f = self.forwarder()
+            f.max_buffer = 2
+            for _ in range(5):
+                f.emit(logging.LogRecord('app', logging.INFO, __file__, 1,
+                                         'x', None, None))
+            await f.aclose(0)
+            return f
+
+        f = asyncio.run(main())
+        self.assertEqual(f.dropped, 3)
+        self.assertEqual(len(f.buffer), 0)
+
+    def test_unix_port(self):
+        self.assertRaises(TypeError, client.AsyncUnixForwarder, self.path, 1)
+
+    def test_record_added_while_batching(self):
+        f = self.forwarder()
+        written = []
+        f.writer = mock.MagicMock(write=written.append,
+                                  drain=mock.AsyncMock())
+
+        class Racing(collections.deque):
+            # Another thread's `emit` landing while the batch is taken
+            def popleft(self):
+                item = super().popleft()
+                if item == b'first':
+                    self.append(b'second')
+                return item
+
+        f.buffer = Racing([b'first'])
+        asyncio.run(f.run())
+        self.assertEqual(b''.join(written), b'firstsecond')
+        self.assertEqual(f.dropped, 0)
+
+
+class TestFork(TestClient):
+
+    def record(self, msg):
+        return logging.LogRecord('app', logging.INFO, __file__, 1, msg,
+                                 None, None)
+
+    def test_forked_drops_socket(self):
+        sock = self.s.sock = mock.MagicMock()
+        self.s.shook_hands = True
+        self.s.forked()
+        sock.close.assert_called_once_with()
+        sock.shutdown.assert_not_called()
+        self.assertIsNone(self.s.sock)
+        self.assertFalse(self.s.shook_hands)
+
+    def test_after_fork_hook(self):
+        with mock.patch.object(self.s, 'forked') as forked:
+            client._after_fork()
+        forked.assert_called_once_with()
+
+    def test_warm_up_after_fork(self):
+        self.s.warm_up_after_fork = True
+        with mock.patch.object(self.s, 'warmUp') as warm_up:
+            self.s.forked()
+        warm_up.assert_called_once_with()
+
+    def test_first_record_after_fork_warms_up(self):
+        with mock.patch.object(self.s, 'warmUp') as warm_up:
+            self.s.forked()
+            warm_up.assert_not_called()
+            self.s.createSocket = mock.MagicMock()
+            self.s.backlog = []  # as `warmUp` would
+            self.s.emit(self.record('first'))
+            self.s.emit(self.record('second'))
+        warm_up.assert_called_once_with()
+        self.s.createSocket.assert_not_called()
+        self.assertEqual(len(self.s.backlog), 2)
+
+    def test_warm_up_keeps_records(self):
+        connected = mock.MagicMock()
+        gate = threading.Event()
+
+        def createSocket():
+            gate.wait(5)
+            self.s.sock = connected
+        self.s.createSocket = createSocket
+        self.s.send = mock.MagicMock()
+        self.s.warmUp()
+        records = [self.record('one'), self.record('two')]
+        start = time.time()
+        for r in records:
+            self.s.emit(r)
+        self.assertLess(time.time() - start, 1)
+        self.s.send.assert_not_called()
+        gate.set()
+        deadline = time.time() + 5
+        while self.s.backlog is not None and time.time() < deadline:
+            time.sleep(0.001)
+        self.assertEqual([c[0][0] for c in self.s.send.call_args_list],
+                         [self.s.makePickle(r) for r in records])
+        self.s.emit(self.record('three'))
+        self.assertEqual(self.s.send.call_count, 3)
+
+    def test_warm_up_backlog_bound(self):
+        self.s.backlog = []
+        self.s.max_backlog = 1
+        self.s.emit(self.record('one'))
+        self.s.emit(self.record('two'))
+        self.assertEqual(len(self.s.backlog), 1)
+        self.assertEqual(self.s.dropped, 1)
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), "needs fork")
+class TestForkedChild(unittest.TestCase):
+
+    def setUp(self):
+        self.s = client.SocketForwarder('test-host', 999)
+
+    def test_child_does_not_inherit_socket(self):
+        ours, theirs = socket.socketpair()
+        self.s.sock = ours
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            os._exit(0 if self.s.sock is None else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        # The parent's connection is untouched
+        self.assertIs(self.s.sock, ours)
+        ours.sendall(b'x')
+        self.assertEqual(theirs.recv(1), b'x')
+        ours.close()
+        theirs.close()
+
+
+class TestMultiplexer(TestClient):
+
+    def setUp(self):
+        super().setUp()
+        self.m = client.Multiplexer('test-host', 999)
+        self.m.send = mock.MagicMock()
+        self.logger = logging.getLogger('logserv.test.mux.%d' % id(self))
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        self.a = self.m.stream(filename='a.log')
+        self.b = self.m.stream(logging.ERROR, filename='b.log')
+        self.logger.addHandler(self.a)
+        self.logger.addHandler(self.b)
+
+    def tearDown(self):
+        self.logger.handlers.clear()
+        super().tearDown()
+
+    def sent_bitmaps(self):
+        return [struct.unpack('>LQ', c[0][0][:12])[1]
+                for c in self.m.send.call_args_list]
+
+    def test_sent_once_with_bitmap(self):
+        self.logger.error('both')
+        self.logger.info('only a')
+        self.assertEqual(self.sent_bitmaps(), [0b11, 0b01])
+        data = self.m.send.call_args[0][0]
+        self.assertEqual(struct.unpack('>L', data[:4])[0], len(data) - 4)
+        self.assertEqual(pickle.loads(data[12:])['msg'], 'only a')
+
+    def test_streams_of_ancestors(self):
+        child = self.logger.getChild('child')
+        c = self.m.stream(filename='c.log')
+        child.addHandler(c)
+        child.error('all three')
+        self.assertEqual(self.sent_bitmaps(), [0b111])
+        child.handlers.clear()
+
+    def test_filters_respected(self):
+        self.b.addFilter(lambda record: False)
+        self.logger.error('a only')
+        self.assertEqual(self.sent_bitmaps(), [0b01])
+
+    def test_direct_emit(self):
+        record = logging.LogRecord('elsewhere', logging.ERROR, __file__, 1,
+                                   'direct', None, None)
+        self.b.handle(record)
+        self.assertEqual(self.sent_bitmaps(), [0b10])
+
+    def test_queue_listener(self):
+        # The listener hands each record to every handler in turn, none of
+        # them attached to the record's logger
+        q = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(q, self.a, self.b)
+        listener.start()
+        q.put(logging.LogRecord('elsewhere', logging.ERROR, __file__, 1,
+                                'queued', None, None))
+        listener.stop()
+        self.assertEqual(self.sent_bitmaps(), [0b01, 0b10])
+
+    def test_declare(self):
+        self.m.sock = mock.MagicMock()
+        self.m.recv_line = mock.MagicMock(return_value='OK\n')
+        self.a.setFormatter(logging.Formatter('%(message)s'))
+        data = self.m.sock.sendall.call_args[0][0]
+        self.assertTrue(data.startswith(b'\x00\x00\x00\x00ROUTE 0 '))
+        self.assertEqual(json.loads(data[12:].decode()), {
+            'filename': 'a.log', '--level': 0,
+            '--format': {'fmt': '%(message)s', 'datefmt': None,
+                         'style': '%'}})
+
+    def test_declare_failure_drops_socket(self):
+        sock = self.m.sock = mock.MagicMock()
+        self.m.recv_line = mock.MagicMock(return_value='ERROR no\n')
+        self.m.redeclare(self.a)
+        sock.close.assert_called_once_with()
+        self.assertIsNone(self.m.sock)
+
+    def test_stream_limit(self):
+        self.m.max_streams = 2
+        with self.assertRaises(ValueError):
+            self.m.stream(filename='c.log')
+
+    def test_handshake_params(self):
+        self.assertEqual(self.m.kwargs, {'--multiplex': {}})
+
+
+def exc_record(msg='boom', error=ValueError):
+    try:
+        raise error(msg)
+    except Exception:
+        return logging.LogRecord('app', logging.ERROR, __file__, 1, msg,
+                                 None, sys.exc_info())
+
+
+class TestExcCache(unittest.TestCase):
+
+    def setUp(self):
+        self.f = client.SocketForwarder('localhost', 9876)
+        self.f.exc_cache_size = 2
+        # As after the handshake
+        self.f.exc_cache = collections.OrderedDict()
+        self.f.sock = mock.MagicMock()
+
+    def unpickle(self, record):
+        data = self.f.makePickle(record)
+        self.assertEqual(struct.unpack('>L', data[:4])[0], len(data) - 4)
+        return pickle.loads(data[4:])
+
+    def test_repeats_sent_as_references(self):
+        first = self.unpickle(exc_record())
+        self.assertIn('ValueError: boom', first['exc_text'])
+        self.assertEqual(len(first['exc_ref']), 16)
+        again = self.unpickle(exc_record())
+        self.assertIsNone(again['exc_text'])
+        self.assertEqual(again['exc_ref'], first['exc_ref'])
+        self.assertNotIn('exc_ref', self.unpickle(
+            logging.LogRecord('app', logging.INFO, __file__, 1, 'hi', None,
+                              None)))
+
+    def test_least_recently_used_forgotten(self):
+        a = exc_record('a')
+        self.unpickle(a)
+        self.unpickle(exc_record('b'))
+        self.unpickle(exc_record('a'))
+        self.unpickle(exc_record('c'))  # evicts b
+        self.assertIsNone(self.unpickle(exc_record('a'))['exc_text'])
+        self.assertIsNotNone(self.unpickle(exc_record('b'))['exc_text'])
+
+    def test_total_size_kept(self):
+        for msg in 'abac':
+            self.unpickle(exc_record(msg))
+            self.assertEqual(self.f.exc_cache_bytes,
+                             sum(self.f.exc_cache.values()))
+        self.assertEqual(len(self.f.exc_cache), 2)
+
+    def test_no_references_before_connecting(self):
+        self.unpickle(exc_record())
+        self.f.sock = None
+        self.assertIsNotNone(self.unpickle(exc_record())['exc_text'])
+
+    def test_handshake(self):
+        self.f.sendtext = mock.MagicMock()
+        self.f.recv_line = mock.MagicMock(side_effect=['HELLO 1.0\n', 'OK\n',
+                                                       'OK\n'])
+        self.unpickle(exc_record())
+        self.f.doHandshake()
+        self.assertEqual(self.f.exc_cache, {})
+        self.assertEqual(self.f.exc_cache_bytes, 0)
+        identify = self.f.sendtext.call_args_list[1][0][0]
+        self.assertEqual(json.loads(identify[9:])['--exc-cache'], 2)
+
+
+class TestFieldDictionary(unittest.TestCase):
+
+    def setUp(self):
+        self.f = client.SocketForwarder('localhost', 9876)
+        self.f.field_dictionary_size = 3
+        self.f.field_ids = {}
+        self.f.sock = mock.MagicMock()
+
+    def unpickle(self, name='app', func='handle'):
+        record = logging.LogRecord(name, logging.INFO, '/src/app.py', 1,
+                                   'hi', None, None, func)
+        record.processName = record.threadName = 'Main'
+        return pickle.loads(self.f.makePickle(record)[4:])
+
+    def test_strings_numbered(self):
+        first = self.unpickle()
+        self.assertEqual(first['name'], (0, 'app'))
+        self.assertEqual(first['pathname'], (1, '/src/app.py'))
+        self.assertEqual(first['filename'], (2, 'app.py'))
+        # Numbered along with the logger name
+        self.assertEqual(first['module'], 0)
+        # The dictionary is full
+        self.assertEqual(first['funcName'], 'handle')
+        self.assertEqual(first['threadName'], 'Main')
+        again = self.unpickle()
+        self.assertEqual([again[f] for f in ('name', 'pathname', 'filename',
+                                             'module')], [0, 1, 2, 0])
+
+    def test_handshake(self):
+        self.f.sendtext = mock.MagicMock()
+        self.f.recv_line = mock.MagicMock(side_effect=['HELLO 1.0\n', 'OK\n',
+                                                       'OK\n'])
+        self.unpickle()
+        self.f.doHandshake()
+        self.assertEqual(self.f.field_ids, {})
+        identify = self.f.sendtext.call_args_list[1][0][0]
+        self.assertEqual(json.loads(identify[9:])['--field-dictionary'], 3)
+
+
+class TestMultiplexEndToEnd(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'logserv.sock')
+        self.map = {}
+
+        class UnixServer(server.LogServer):
+            socket_family = socket.AF_UNIX
+        UnixServer(self.path, self.map)
+        self.stop = threading.Event()
+        self.loop = threading.Thread(target=self.run_loop, daemon=True)
+        self.loop.start()
+
+    def run_loop(self):
+        while not self.stop.is_set():
+            asyncore.poll(0.005, self.map)
+
+    def tearDown(self):
+        self.stop.set()
+        self.loop.join(5)
+        for _, entry in list(server.LoggingChannel.shared_sinks.sinks.items()):
+            entry[0].close()
+        asyncore.close_all(self.map)
+        shutil.rmtree(self.tmp)
+
+    def read_when(self, name, lines, timeout=5):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                with open(os.path.join(self.tmp, name)) as f:
+                    content = f.read().splitlines()
+            except FileNotFoundError:
+                content = []
+            if len(content) >= lines or time.time() > deadline:
+                return content
+            time.sleep(0.01)
+
+    def test_streams_share_one_connection(self):
+        m = client.UnixMultiplexer(self.path)
+        logger = logging.getLogger('logserv.test.mux_e2e')
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        for name, level in (('all.log', logging.DEBUG),
+                            ('errors.log', logging.ERROR)):
+            stream = m.stream(level, filename=os.path.join(self.tmp, name))
+            stream.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+            logger.addHandler(stream)
+        try:
+            logger.info('one')
+            logger.error('two')
+        finally:
+            logger.handlers.clear()
+            m.close()
+        self.assertEqual(self.read_when('all.log', 2),
+                         ['INFO one', 'ERROR two'])
+        self.assertEqual(self.read_when('errors.log', 1), ['ERROR two'])
+
+
 if __name__ == "__main__":
     unittest.main()
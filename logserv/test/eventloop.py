@@ -0,0 +1,94 @@
+import selectors
+import socket
+import unittest
+from unittest import mock
+
+from .. import eventloop, server
+
+
+class TestSelectorMap(unittest.TestCase):
+
+    def setUp(self):
+        self.map = eventloop.SelectorMap()
+        self.ours, self.theirs = socket.socketpair()
+        self.c = server.LoggingChannel(self.ours, self.map)
+
+    def tearDown(self):
+        self.c.close()
+        self.theirs.close()
+        self.map.close()
+
+    def registered(self):
+        key = self.map.selector.get_map().get(self.c._fileno)
+        return None if key is None else key.events
+
+    def test_lazy_registration(self):
+        self.assertIn(self.c._fileno, self.map)
+        self.assertIsNone(self.registered())
+        self.map.poll(0)
+        self.assertEqual(self.registered(), selectors.EVENT_READ)
+
+    def test_write_buf_updates_interest(self):
+        self.map.poll(0)
+        self.c.write_buf = b'OK\n'
+        self.assertTrue(self.registered() & selectors.EVENT_WRITE)
+        self.map.poll(0)
+        self.assertEqual(self.theirs.recv(10), b'OK\n')
+        self.assertEqual(self.registered(), selectors.EVENT_READ)
+
+    def test_idle_channels_not_polled(self):
+        self.map.poll(0)
+        with mock.patch.object(self.c, 'readable') as readable:
+            self.map.poll(0)
+            self.map.poll(0)
+        self.assertFalse(readable.called)
+
+    def test_dispatch_read(self):
+        self.map.poll(0)
+        self.theirs.sendall(b'HELLO 1.0\n')
+        self.map.poll(1)
+        self.assertEqual(self.c.status, 'IDENTIFYING')
+
+    def test_close_unregisters(self):
+        self.map.poll(0)
+        fd = self.c._fileno
+        self.c.close()
+        self.assertNotIn(fd, self.map)
+        self.assertIsNone(self.map.selector.get_map().get(fd))
+
+    def test_clear(self):
+        self.map.poll(0)
+        self.map.clear()
+        self.assertFalse(self.map.selector.get_map())
+
+
+class TestLoop(unittest.TestCase):
+
+    def test_count(self):
+        m = mock.MagicMock()
+        m.__len__.return_value = 1
+        eventloop.loop(m, timeout=0, count=3)
+        self.assertEqual(m.poll.call_count, 3)
+
+    def test_plain_dict(self):
+        with mock.patch('asyncore.poll') as poll:
+            m = {1: object()}
+            eventloop.loop(m, timeout=0, count=2)
+        poll.assert_called_with(0, m)
+        self.assertEqual(poll.call_count, 2)
+
+    def test_timers(self):
+        m = mock.MagicMock()
+        m.__len__.return_value = 1
+        wheel = mock.MagicMock()
+        wheel.next_timeout.return_value = 0.5
+        eventloop.loop(m, timeout=30, count=2, timers=wheel)
+        m.poll.assert_called_with(0.5)
+        self.assertEqual(wheel.advance.call_count, 2)
+        wheel.next_timeout.return_value = None
+        eventloop.loop(m, timeout=30, count=1, timers=wheel)
+        m.poll.assert_called_with(30)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+import logging
+import os
+import tempfile
+import threading
+import unittest
+
+from .. import filecache, segments
+
+
+def record(msg):
+    return logging.LogRecord('app', logging.INFO, __file__, 1, msg, None,
+                             None)
+
+
+class CachedPreallocatedFileHandler(filecache.CachedFiles,
+                                    segments.PreallocatedFileHandler):
+    pass
+
+
+class TestFileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = filecache.FileCache(max_open=2)
+        self.handlers = []
+
+    def tearDown(self):
+        for handler in self.handlers:
+            handler.close()
+        self.tmpdir.cleanup()
+
+    def handler(self, name, cls=filecache.CachedRotatingFileHandler,
+                **kwargs):
+        cls = type(cls.__name__, (cls,), {'file_cache': self.cache})
+        handler = cls(os.path.join(self.tmpdir.name, name), **kwargs)
+        self.handlers.append(handler)
+        return handler
+
+    def read(self, name):
+        with open(os.path.join(self.tmpdir.name, name)) as f:
+            return f.read()
+
+    def test_least_recently_used_closed(self):
+        a, b, c = (self.handler(name, delay=True)
+                   for name in ('a.log', 'b.log', 'c.log'))
+        a.emit(record('a1'))
+        b.emit(record('b1'))
+        a.emit(record('a2'))
+        c.emit(record('c1'))
+        self.assertIsNone(b.stream)
+        self.assertIsNotNone(a.stream)
+        self.assertEqual(self.cache.report(), {'open': 2, 'hits': 1,
+                                               'misses': 3, 'evictions': 1})
+        b.emit(record('b2'))
+        self.assertIsNone(a.stream)
+        self.assertEqual(self.read('b.log'), 'b1\nb2\n')
+
+    def test_write_mode_reopened_for_append(self):
+        a = self.handler('a.log', mode='w', delay=True)
+        b = self.handler('b.log', delay=True)
+        c = self.handler('c.log', delay=True)
+        for handler in (a, b, c, a):
+            handler.emit(record(handler.baseFilename[-5:]))
+        self.assertEqual(self.read('a.log'), 'a.log\na.log\n')
+
+    def test_rotation_continues_after_reopening(self):
+        a = self.handler('a.log', maxBytes=100, backupCount=1, delay=True)
+        others = [self.handler('%d.log' % i, delay=True) for i in range(2)]
+        for i in range(6):
+            a.emit(record('%02d' % i + 'x' * 27))
+            for other in others:
+                other.emit(record('other'))
+        self.assertEqual(self.read('a.log.1').splitlines(),
+                         ['%02d' % i + 'x' * 27 for i in range(3)])
+        self.assertEqual(len(self.read('a.log').splitlines()), 3)
+
+    def test_opened_without_delay(self):
+        self.handler('a.log')
+        self.assertEqual(self.cache.report()['open'], 1)
+
+    def test_closed_handler_forgotten(self):
+        a = self.handler('a.log', delay=True)
+        a.emit(record('x'))
+        a.close()
+        self.assertNotIn(a, self.cache)
+
+    def test_preallocated_segments(self):
+        a, b, c = (self.handler(name, cls=CachedPreallocatedFileHandler,
+                                maxBytes=1000, delay=True)
+                   for name in ('a.log', 'b.log', 'c.log'))
+        for handler in (a, b, c, a):
+            handler.emit(record('rec'))
+        a.close()
+        self.assertEqual(self.read('a.log'), 'rec\nrec\n')
+        # Evicted segments are truncated to their data
+        self.assertEqual(self.read('b.log'), 'rec\n')
+
+    def test_threads(self):
+        self.cache.max_open = 3
+        handlers = [self.handler('%d.log' % i, delay=True) for i in range(8)]
+
+        def write(handler):
+            for i in range(200):
+                handler.emit(record(str(i)))
+                handlers[i % len(handlers)].emit(record('noise'))
+
+        threads = [threading.Thread(target=write, args=(h,))
+                   for h in handlers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertLessEqual(self.cache.report()['open'], 3)
+        open_files = sum(h.stream is not None for h in handlers)
+        self.assertLessEqual(open_files, 3)
+        for i, handler in enumerate(handlers):
+            handler.close()
+            lines = self.read('%d.log' % i).splitlines()
+            self.assertEqual([l for l in lines if l != 'noise'],
+                             [str(n) for n in range(200)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import json
+import logging
+import sys
+import unittest
+
+from .. import formatters
+
+
+class TestJSONFormatter(unittest.TestCase):
+
+    def setUp(self):
+        self.record = logging.makeLogRecord({
+            'name': 'app.db', 'msg': 'say "%s"\n', 'args': ('hi',),
+            'levelname': 'INFO', 'levelno': 20, 'created': 1234.5,
+            'exc_text': None})
+
+    def test_default_fields(self):
+        line = formatters.JSONFormatter().format(self.record)
+        self.assertEqual(json.loads(line), {
+            'created': 1234.5, 'levelname': 'INFO', 'name': 'app.db',
+            'message': 'say "hi"\n'})
+        self.assertNotIn('\n', line)
+
+    def test_chosen_fields(self):
+        f = formatters.JSONFormatter(['levelno', 'exc_text', 'missing',
+                                      'asctime'], datefmt='%Y')
+        self.assertEqual(json.loads(f.format(self.record)), {
+            'levelno': 20, 'exc_text': None, 'missing': None,
+            'asctime': f.formatTime(self.record, '%Y')})
+
+    def test_tracebacks_kept(self):
+        self.record.exc_text = 'Traceback ...\nValueError: boom'
+        self.record.stack_info = 'Stack (most recent call last): ...'
+        for fields in (None, ['message']):
+            line = formatters.JSONFormatter(fields).format(self.record)
+            decoded = json.loads(line)
+            self.assertEqual(decoded['exc_text'], self.record.exc_text)
+            self.assertEqual(decoded['stack_info'], self.record.stack_info)
+            self.assertNotIn('\n', line)
+
+    def test_traceback_formatted_locally(self):
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            record = logging.LogRecord('app', logging.ERROR, __file__, 1,
+                                       'failed', None, sys.exc_info())
+        decoded = json.loads(formatters.JSONFormatter().format(record))
+        self.assertIn('ValueError: boom', decoded['exc_text'])
+        self.assertNotIn('stack_info', decoded)
+
+    def test_matches_json_dumps(self):
+        f = formatters.JSONFormatter(['value'])
+        for value in ['plain', 'ünïcode \t', 3, -1.25, True, None,
+                      float('nan'), ('a', 1)]:
+            self.record.value = value
+            expected = value if value == value else None
+            if isinstance(value, tuple):
+                expected = str(value)
+            self.assertEqual(json.loads(f.format(self.record)),
+                             {'value': expected})
+
+    def test_bad_fields(self):
+        self.assertRaises(ValueError, formatters.JSONFormatter, [])
+        self.assertRaises(ValueError, formatters.JSONFormatter, [1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()
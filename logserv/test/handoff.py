@@ -0,0 +1,207 @@
+import asyncore
+import json
+import logging
+import os
+import pickle
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from .. import client, handoff, server, sinks
+
+
+class UnixServer(server.LogServer):
+    socket_family = socket.AF_UNIX
+
+
+class RouteChannel(server.LoggingChannel):
+    handler_class = mock.MagicMock(
+        side_effect=lambda **kw: mock.MagicMock(name=kw['filename']))
+    shared_sinks = sinks.SinkRegistry()
+
+
+def frame(msg):
+    data = pickle.dumps(logging.LogRecord('app', logging.INFO, __file__, 1,
+                                          msg, None, None).__dict__)
+    return struct.pack('>L', len(data)) + data
+
+
+class TestChannelState(unittest.TestCase):
+
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair()
+        self.c = RouteChannel(self.ours, {})
+
+    def tearDown(self):
+        self.c.close()
+        self.theirs.close()
+
+    def say(self, data):
+        self.theirs.sendall(data)
+        time.sleep(0.01)
+        self.c.handle_read()
+
+    def restore(self):
+        state = json.loads(json.dumps(self.c.handoff_state()))
+        sock = socket.socket(fileno=os.dup(self.ours.fileno()))
+        return RouteChannel.restore(sock, {}, state)
+
+    def test_relay_routes_restored(self):
+        self.say(b'HELLO 1.0\n')
+        self.say(b'IDENTIFY {"--level": 0, "--relay": {}}\n')
+        self.say(b'LOG\n')
+        self.say(b'\x00\x00\x00\x00')
+        self.say(b'ROUTE 3 {"--level": 40, "filename": "errors.log"}\n')
+        self.say(b'\x00\x00')
+        restored = self.restore()
+        try:
+            self.assertEqual(restored.status, 'LOG-HEADER')
+            self.assertEqual(restored.remaining, 2)
+            self.assertEqual(restored.pending, b'\x00\x00')
+            self.assertEqual(restored.write_buf, self.c.write_buf)
+            self.assertEqual(list(restored.routes), [3])
+            self.assertEqual(restored.routes[3][0], 40)
+            # The sink is shared with the original channel
+            self.assertIs(restored.routes[3][1], self.c.routes[3][1])
+        finally:
+            restored.close()
+
+    def test_bad_state_closes(self):
+        sock = socket.socket(fileno=os.dup(self.ours.fileno()))
+        with self.assertRaises(KeyError):
+            RouteChannel.restore(sock, {}, {'params': None})
+        self.assertEqual(sock.fileno(), -1)
+
+
+class TestHandOver(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'logserv.sock')
+        self.handoff_path = os.path.join(self.tmp, 'handoff.sock')
+        self.log = os.path.join(self.tmp, 'app.log')
+        self.old_map, self.new_map = {}, {}
+        UnixServer(self.path, self.old_map)
+        self.clients = []
+
+    def tearDown(self):
+        for c in self.clients:
+            c.close()
+        for m in (self.old_map, self.new_map):
+            for obj in list(m.values()):
+                if getattr(obj, 'handler', None) is not None:
+                    obj.handler.close()
+            asyncore.close_all(m)
+        shutil.rmtree(self.tmp)
+
+    def connect(self, map):
+        c = client.UnixClient(self.path, filename=self.log,
+                              **{'--format': {'fmt': '%(message)s'}})
+        self.clients.append(c)
+        t = threading.Thread(target=c.createSocket)
+        t.start()
+        while t.is_alive():
+            asyncore.poll(0.01, map)
+        return c
+
+    def lines(self):
+        with open(self.log) as f:
+            return f.read().splitlines()
+
+    def poll_until(self, map, predicate, timeout=5):
+        deadline = time.time() + timeout
+        while not predicate():
+            if time.time() > deadline:  # pragma: no cover
+                self.fail("timed out")
+            asyncore.poll(0.01, map)
+
+    def hand_over(self, **kwargs):
+        taken = []
+        t = threading.Thread(target=lambda: taken.extend(handoff.take_over(
+            self.handoff_path, self.new_map, timeout=5)))
+        t.start()
+        while not os.path.exists(self.handoff_path):
+            time.sleep(0.001)
+        count = handoff.hand_over(self.handoff_path, self.old_map,
+                                  timeout=5, **kwargs)
+        t.join(5)
+        self.assertEqual(count, len(taken))
+        return taken
+
+    def test_connections_survive(self):
+        c = self.connect(self.old_map)
+        c.sock.sendall(frame('one'))
+        self.poll_until(self.old_map, lambda: self.lines() == ['one'])
+        # Leave a record half-received
+        two = frame('two')
+        c.sock.sendall(two[:10])
+        channel, = [obj for obj in self.old_map.values()
+                    if isinstance(obj, server.LoggingChannel)]
+        self.poll_until(self.old_map, lambda: channel.pending)
+
+        taken = self.hand_over()
+        self.assertEqual(self.old_map, {})
+        self.assertEqual(sorted(type(d).__name__ for d in taken),
+                         ['LoggingChannel', 'UnixServer'])
+        restored, = [d for d in taken
+                     if isinstance(d, server.LoggingChannel)]
+        self.assertEqual(restored.status, 'LOGGING')
+        self.assertEqual(restored.pending, two[4:10])
+
+        c.sock.sendall(two[10:] + frame('three'))
+        self.poll_until(self.new_map,
+                        lambda: self.lines() == ['one', 'two', 'three'])
+        # The listening socket was handed over too
+        other = self.connect(self.new_map)
+        other.sock.sendall(frame('four'))
+        self.poll_until(self.new_map, lambda: len(self.lines()) == 4)
+
+    def test_handoff_socket_private(self):
+        modes = []
+        t = threading.Thread(target=handoff.take_over,
+                             args=(self.handoff_path, self.new_map, None, 5))
+        t.start()
+        while not os.path.exists(self.handoff_path):
+            time.sleep(0.001)
+        modes.append(os.stat(self.handoff_path).st_mode & 0o777)
+        handoff.hand_over(self.handoff_path, {}, timeout=5)
+        t.join(5)
+        self.assertEqual(modes, [0o600])
+
+    def test_bad_classes_closed(self):
+        taken = []
+        t = threading.Thread(target=lambda: taken.extend(handoff.take_over(
+            self.handoff_path, self.new_map, timeout=5)))
+        t.start()
+        while not os.path.exists(self.handoff_path):
+            time.sleep(0.001)
+        peers = []
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(5)
+            conn.connect(self.handoff_path)
+            for name in ('os:system', 'logserv.handoff:_LENGTH',
+                         'logserv.no_such_module:Server',
+                         'logserv.server:NoSuchServer',
+                         'logserv.buffers:BufferPool'):
+                ours, theirs = socket.socketpair()
+                handoff.send_socket(conn, {'class': name}, ours)
+                ours.close()
+                peers.append(theirs)
+            conn.shutdown(socket.SHUT_WR)
+            conn.recv(1)
+        t.join(5)
+        self.assertEqual(taken, [])
+        for peer in peers:
+            with peer:
+                self.assertEqual(peer.recv(1), b'')
+
+    def test_servers_only(self):
+        self.connect(self.old_map)
+        taken = self.hand_over(channels=False)
+        self.assertEqual([type(d) for d in taken], [UnixServer])
+        self.assertEqual(len(self.old_map), 1)
@@ -0,0 +1,87 @@
+import logging
+import os
+import tempfile
+import unittest
+
+from .. import index
+
+
+def record(msg, created):
+    return logging.makeLogRecord({'msg': msg, 'created': created})
+
+
+class TestIndexedHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'test.log')
+        self.handler = index.IndexedRotatingFileHandler(
+            self.path, maxBytes=1000, backupCount=2, indexInterval=100)
+
+    def tearDown(self):
+        self.handler.close()
+        self.tmpdir.cleanup()
+
+    def write(self, count, start=1000.0, size=30):
+        for i in range(count):
+            # 29 characters plus the newline
+            self.handler.emit(record('%05d' % i + 'x' * (size - 6),
+                                     start + i))
+
+    def test_sparse_entries(self):
+        self.write(10)
+        entries = index.load_index(self.path)
+        self.assertEqual(entries, [(1000.0, 0, 0), (1004.0, 120, 4),
+                                   (1008.0, 240, 8)])
+
+    def test_timestamps_non_decreasing(self):
+        self.handler.emit(record('a' * 200, 50.0))
+        self.handler.emit(record('late', 10.0))
+        times = [e[0] for e in index.load_index(self.path)]
+        self.assertEqual(times, [50.0, 50.0])
+
+    def test_rotates_with_segment(self):
+        self.write(40)
+        self.assertTrue(os.path.exists(self.path + '.1'))
+        self.assertTrue(os.path.exists(self.path + '.1.idx'))
+        rotated = index.load_index(self.path + '.1')
+        current = index.load_index(self.path)
+        self.assertEqual(rotated[0], (1000.0, 0, 0))
+        self.assertEqual(current[0][1:], (0, 0))
+        self.assertGreater(current[0][0], rotated[-1][0])
+
+    def test_reopen_continues_index(self):
+        self.write(5)
+        self.handler.close()
+        self.handler = index.IndexedRotatingFileHandler(
+            self.path, maxBytes=1000, backupCount=2, indexInterval=100)
+        self.write(5, start=2000.0)
+        entries = index.load_index(self.path)
+        # Offsets stay exact; the count misses the record written after the
+        # last entry before the restart
+        self.assertEqual(entries[-1], (2003.0, 240, 7))
+
+    def test_read_range(self):
+        self.write(30)
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        chunks = list(index.read_range(self.path, 1010.0, 1013.5,
+                                       chunk_size=50))
+        selected = b''.join(chunks)
+        self.assertEqual(selected, data[240:480])
+        self.assertIn(b'00010', selected)
+        self.assertIn(b'00013', selected)
+        self.assertNotIn(b'00005', selected)
+        self.assertTrue(all(len(c) <= 50 for c in chunks))
+
+    def test_read_range_open_ended(self):
+        self.write(5)
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        self.assertEqual(b''.join(index.read_range(self.path, 0, 10 ** 10)),
+                         data)
+        self.assertEqual(list(index.read_range(self.path, 0, 1)), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,302 @@
+import asyncore
+import json
+import logging
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from unittest import mock
+
+from .. import client, relay, server, sinks
+from . import utils
+
+
+def record(level=logging.INFO, msg='hi'):
+    return logging.LogRecord('app', level, __file__, 1, msg, None, None)
+
+
+class TestAggregatorChannel(utils.Patches, unittest.TestCase):
+
+    TO_PATCH = {'socket': 'socket.socket'}
+
+    def setUp(self):
+        super().setUp()
+        self.c = server.LoggingChannel(mock.MagicMock(), {})
+        self.c.shared_sinks = sinks.SinkRegistry()
+        self.c.handler_class = mock.MagicMock(
+            side_effect=lambda **kw: mock.MagicMock(name=kw['filename']))
+        self.c.recv = mock.MagicMock()
+        self.c.status = 'IDENTIFYING'
+        self.feed(b'IDENTIFY {"--level": 0, '
+                  b'"--relay": {"compress": "zlib"}}\n')
+        self.c.status = 'LOG-HEADER'
+        self.c.write_buf = b''
+
+    def feed(self, *chunks):
+        for chunk in chunks:
+            self.c.recv.return_value = chunk
+            self.c.handle_read()
+
+    def declare(self, route, spec):
+        self.feed(b'\x00\x00\x00\x00',
+                  ('ROUTE %d %s\n' % (route, json.dumps(spec))).encode())
+
+    def send_batch(self, batch):
+        payload = zlib.compress(pickle.dumps(batch))
+        self.feed(struct.pack('>L', len(payload)), payload)
+
+    def test_identify(self):
+        self.assertEqual(self.c.routes, {})
+        self.assertTrue(self.c.relay_compress)
+        self.assertIsNone(self.c.handler)
+
+    def test_bad_relay_options(self):
+        c = server.LoggingChannel(mock.MagicMock(), {})
+        c.recv = mock.MagicMock(
+            return_value=b'IDENTIFY {"--level": 0, '
+                         b'"--relay": {"compress": "lzma"}}\n')
+        c.status = 'IDENTIFYING'
+        c.handle_read()
+        self.assertTrue(c.write_buf.startswith(b'ERROR '))
+        self.assertIsNone(c.routes)
+
+    def test_routes_batches(self):
+        self.declare(0, {'--level': 0, 'filename': 'app.log'})
+        self.declare(1, {'--level': 40, 'filename': 'errors.log'})
+        self.assertEqual(self.c.write_buf, b'OK\nOK\n')
+        self.send_batch([(0, record().__dict__),
+                         (1, record(logging.INFO).__dict__),
+                         (1, record(logging.ERROR, 'bad').__dict__)])
+        app = self.c.routes[0][1]
+        errors = self.c.routes[1][1]
+        self.assertEqual(app.emit.call_count, 1)
+        errors.emit.assert_called_once_with(mock.ANY)
+        self.assertEqual(errors.emit.call_args[0][0].msg, 'bad')
+        self.assertEqual(self.c.records_in, 3)
+        self.assertEqual(self.c.status, 'LOG-HEADER')
+
+    def test_undeclared_route(self):
+        self.send_batch([(7, record().__dict__)])
+        self.assertTrue(self.c.write_buf.startswith(b'ERROR '))
+
+    def test_routes_released_on_close(self):
+        self.declare(0, {'--level': 0, 'filename': 'app.log'})
+        app = self.c.routes[0][1]
+        self.c.close()
+        app.close.assert_called_once_with()
+        self.assertEqual(len(self.c.shared_sinks), 0)
+
+
+class TestRelayChannel(utils.Patches, unittest.TestCase):
+
+    TO_PATCH = {'socket': 'socket.socket'}
+
+    def setUp(self):
+        super().setUp()
+        self.upstream = mock.MagicMock()
+        self.specs = []
+        self.upstream.route_for.side_effect = self.route_for
+        self.upstream.link_for.return_value.put.return_value = False
+        self.c = relay.RelayChannel(mock.MagicMock(), {})
+        self.c.upstream = self.upstream
+        self.c.recv = mock.MagicMock()
+        self.c.status = 'IDENTIFYING'
+
+    def route_for(self, spec):
+        self.specs.append(spec)
+        return len(self.specs) - 1
+
+    def identify(self, params):
+        self.c.recv.return_value = ('IDENTIFY %s\n' %
+                                    json.dumps(params)).encode()
+        self.c.handle_read()
+
+    def test_routes_from_params(self):
+        self.identify({'--level': 10, 'filename': 'app.log',
+                       '--sinks': [{'--level': 40,
+                                    'filename': 'errors.log'}]})
+        self.assertEqual(self.c.write_buf, b'OK\n')
+        self.assertEqual(self.specs,
+                         [{'--level': 10, 'filename': 'app.log'},
+                          {'--level': 40, 'filename': 'errors.log'}])
+        self.assertEqual(self.c.routes_out, [(10, 0), (40, 1)])
+
+    def test_emit_by_level(self):
+        self.identify({'--level': 0, '--sinks': [
+            {'--level': 40, 'filename': 'errors.log'}]})
+        info, error = record(), record(logging.ERROR)
+        self.c.emit(info)
+        self.c.emit(error)
+        put = self.upstream.link_for.return_value.put
+        put.assert_called_once_with(0, error.__dict__)
+
+    def test_format_changes_route(self):
+        self.identify({'--level': 0, 'filename': 'app.log'})
+        self.c.format(fmt='%(message)s')
+        self.assertEqual(self.specs[-1],
+                         {'--level': 0, 'filename': 'app.log',
+                          '--format': {'fmt': '%(message)s'}})
+        self.assertEqual(self.c.routes_out, [(0, 1)])
+
+    def test_backlog_pauses_reading(self):
+        self.identify({'--level': 0, 'filename': 'app.log'})
+        link = self.upstream.link_for.return_value
+        link.put.return_value = True
+        link.backlogged = True
+        self.c.emit(record())
+        link.wait.assert_called_once_with(self.c)
+        self.assertFalse(self.c.readable())
+
+    def test_bad_level(self):
+        self.identify({'--level': 'LOUD', 'filename': 'app.log'})
+        self.assertTrue(self.c.write_buf.startswith(b'ERROR '))
+        self.assertEqual(self.c.status, 'IDENTIFYING')
+
+
+class TestRelayForwarder(unittest.TestCase):
+
+    def setUp(self):
+        self.f = relay.RelayForwarder('localhost', 9876, compress=True)
+        self.f.sock = mock.MagicMock()
+        self.f.recv_line = mock.MagicMock(return_value='OK\n')
+        self.specs = {0: {'--level': 0, 'filename': 'app.log'},
+                      1: {'--level': 0, 'filename': 'bad.log'}}
+
+    def sent(self):
+        return [c[0][0] for c in self.f.sock.sendall.call_args_list]
+
+    def unpack(self, frame):
+        self.assertEqual(struct.unpack('>L', frame[:4]), (len(frame) - 4,))
+        return pickle.loads(zlib.decompress(frame[4:]))
+
+    def test_declares_routes_once(self):
+        batch = [(0, {'msg': 'hi'})]
+        self.assertTrue(self.f.sendBatch(batch, self.specs))
+        decl, frame = self.sent()
+        self.assertEqual(decl, b'\x00\x00\x00\x00ROUTE 0 %s\n' %
+                         json.dumps(self.specs[0]).encode())
+        self.assertEqual(self.unpack(frame), batch)
+        self.f.sendBatch(batch, self.specs)
+        self.assertEqual(len(self.sent()), 3)
+
+    def test_rejected_route_dropped(self):
+        self.f.recv_line.side_effect = ['OK\n', 'ERROR bad params\n']
+        self.f.sendBatch([(0, {'msg': 'a'}), (1, {'msg': 'b'})], self.specs)
+        self.assertEqual(self.unpack(self.sent()[-1]), [(0, {'msg': 'a'})])
+        self.assertEqual(self.f.rejected, {1})
+
+    def test_send_failure_drops_socket(self):
+        sock = self.f.sock
+        sock.sendall.side_effect = OSError
+        self.assertFalse(self.f.sendBatch([(0, {})], self.specs))
+        sock.close.assert_called_once_with()
+        self.assertIsNone(self.f.sock)
+
+    def test_reconnect_redeclares(self):
+        self.f.sendBatch([(0, {})], self.specs)
+        self.f.sock = None
+        sock = mock.MagicMock()
+
+        def connect(handler):
+            handler.sock = sock
+        with mock.patch('logging.handlers.SocketHandler.createSocket',
+                        side_effect=connect), \
+                mock.patch.object(self.f, 'doHandshake') as handshake:
+            self.assertTrue(self.f.sendBatch([(0, {})], self.specs))
+        handshake.assert_called_once_with()
+        decl, _ = [c[0][0] for c in sock.sendall.call_args_list]
+        self.assertTrue(decl.startswith(b'\x00\x00\x00\x00ROUTE 0 '))
+
+    def test_handshake_params(self):
+        self.assertEqual(self.f.kwargs, {'--relay': {'compress': 'zlib'}})
+
+
+class TestRelayEndToEnd(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        registry = sinks.SinkRegistry()
+
+        class CentralChannel(server.LoggingChannel):
+            shared_sinks = registry
+
+        class CentralServer(server.LogServer):
+            channel_class = CentralChannel
+
+        self.registry = registry
+        self.central_map, self.relay_map = {}, {}
+        self.central = CentralServer(('127.0.0.1', 0), self.central_map)
+        port = self.central.socket.getsockname()[1]
+        upstream = relay.Upstream(('127.0.0.1', port), self.relay_map,
+                                  connections=2, compress=True, timeout=5)
+        self.upstream = upstream
+
+        class LocalChannel(relay.RelayChannel):
+            pass
+        LocalChannel.upstream = upstream
+
+        class LocalServer(relay.RelayServer):
+            channel_class = LocalChannel
+
+        self.path = os.path.join(self.tmp, 'relay.sock')
+        self.local = LocalServer(self.path, self.relay_map)
+        self.stop = threading.Event()
+        self.loop = threading.Thread(target=self.run_loops, daemon=True)
+        self.loop.start()
+
+    def run_loops(self):
+        while not self.stop.is_set():
+            asyncore.poll(0.005, self.central_map)
+            asyncore.poll(0.005, self.relay_map)
+
+    def tearDown(self):
+        self.upstream.close(5)
+        self.stop.set()
+        self.loop.join(5)
+        for m in (self.central_map, self.relay_map):
+            asyncore.close_all(m)
+        for _, entry in list(self.registry.sinks.items()):
+            entry[0].close()
+        shutil.rmtree(self.tmp)
+
+    def read_when(self, filename, lines, timeout=5):
+        deadline = time.time() + timeout
+        while True:
+            try:
+                with open(filename) as f:
+                    content = f.read().splitlines()
+            except FileNotFoundError:
+                content = []
+            if len(content) >= lines or time.time() > deadline:
+                return content
+            time.sleep(0.01)
+
+    def test_records_reach_central_files(self):
+        app = os.path.join(self.tmp, 'app.log')
+        errors = os.path.join(self.tmp, 'errors.log')
+        handlers = [
+            client.UnixClient(self.path, filename=app,
+                              **{'--format': {'fmt': '%(message)s'}}),
+            client.UnixClient(self.path, **{'--sinks': [
+                {'--level': 40, 'filename': errors,
+                 '--format': {'fmt': '%(levelname)s %(message)s'}}]}),
+        ]
+        for i in range(50):
+            handlers[0].emit(record(msg='app %d' % i))
+            handlers[1].emit(record(logging.INFO, 'ignored'))
+            handlers[1].emit(record(logging.ERROR, 'err %d' % i))
+        for h in handlers:
+            h.close()
+        self.assertEqual(self.read_when(app, 50),
+                         ['app %d' % i for i in range(50)])
+        self.assertEqual(self.read_when(errors, 50),
+                         ['ERROR err %d' % i for i in range(50)])
+        # One connection per upstream link, whatever the number of clients
+        channels = [c for c in self.central_map.values()
+                    if isinstance(c, server.LoggingChannel)]
+        self.assertLessEqual(len(channels), 2)
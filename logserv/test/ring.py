@@ -0,0 +1,206 @@
+import asyncore
+import logging
+import pickle
+import socket
+import struct
+import unittest
+from unittest import mock
+
+from .. import client, ring, server, timers, ProtocolError
+
+
+class RingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Producer and consumer share a process here, so keep the resource
+        # tracker from seeing the consumer let go of the producer's block
+        patcher = mock.patch('logserv.ring.resource_tracker')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+
+
+class TestRing(RingTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.producer = ring.Ring.create(16)
+        self.consumer = ring.Ring.attach(self.producer.name)
+
+    def tearDown(self):
+        self.consumer.close()
+        self.producer.close()
+
+    def test_write_read(self):
+        self.assertEqual(self.producer.write(b'hello'), (True, True))
+        self.assertEqual(len(self.consumer), 5)
+        self.assertEqual(self.consumer.read(3), b'hel')
+        self.assertEqual(self.producer.write(b'!'), (True, False))
+        self.assertEqual(self.consumer.read(100), b'lo!')
+        self.assertEqual(len(self.consumer), 0)
+
+    def test_wraparound(self):
+        self.producer.write(b'x' * 12)
+        self.consumer.read(12)
+        self.assertEqual(self.producer.write(b'0123456789'), (True, True))
+        self.assertEqual(self.consumer.read(10), b'0123456789')
+
+    def test_full(self):
+        self.assertEqual(self.producer.write(b'x' * 16), (True, True))
+        self.assertEqual(self.producer.write(b'y'), (False, False))
+        self.consumer.read(1)
+        self.assertEqual(self.producer.write(b'y'), (True, False))
+
+    def test_attach_validates_name(self):
+        self.assertRaises(ValueError, ring.Ring.attach, 'psm_not_ours')
+        self.assertRaises(FileNotFoundError, ring.Ring.attach,
+                          ring.NAME_PREFIX + 'missing')
+
+
+class TestRingTransport(RingTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.ours, self.theirs = socket.socketpair()
+        self.map = {}
+        self.c = server.RingChannel(self.ours, self.map)
+        self.c.handler = mock.MagicMock()
+        self.c.status = 'WAITING'
+        self.client = client.RingClient('/unused.sock', filename='test.log')
+        self.client.sock = self.theirs
+
+    def tearDown(self):
+        self.client.close()
+        self.c.close()
+        entry = server.RingChannel.wakers.pop(id(self.map), None)
+        if entry is not None:
+            entry[1].close()
+
+    def connect_ring(self):
+        self.client.recv_line = mock.MagicMock(return_value='OK\n')
+        self.client.requestLog()
+        self.c.handle_read()
+        self.assertIsNotNone(self.c.ring)
+        self.assertIn(self.c, server.RingChannel.active)
+
+    def test_ring_request(self):
+        self.connect_ring()
+        self.assertEqual(self.c.write_buf, b'OK\n')
+        self.assertEqual(self.c.status, 'LOG-HEADER')
+
+    def test_plain_log_still_works(self):
+        self.theirs.send(b'LOG\n')
+        self.c.handle_read()
+        self.assertIsNone(self.c.ring)
+        self.assertEqual(self.c.status, 'LOG-HEADER')
+
+    def test_bad_ring(self):
+        self.theirs.send(('RING %smissing\n' % ring.NAME_PREFIX).encode())
+        self.assertRaises(ProtocolError, self.c.dispatch_read)
+
+    def test_records_through_ring(self):
+        self.connect_ring()
+        for i in range(3):
+            self.client.emit(logging.makeLogRecord({'msg': 'rec %d' % i}))
+        # Only the first record found the ring empty
+        self.assertEqual(self.ours.recv(10, socket.MSG_PEEK), b'\x00')
+        self.c.handle_read()
+        emitted = [c[0][0].msg for c in self.c.handler.emit.call_args_list]
+        self.assertEqual(emitted, ['rec 0', 'rec 1', 'rec 2'])
+
+    def test_drained_on_hangup(self):
+        self.connect_ring()
+        handler = self.c.handler
+        self.client.emit(logging.makeLogRecord({'msg': 'last words'}))
+        self.client.close()
+        self.c.handle_read()  # the wakeup
+        self.c.handle_read()  # the hangup
+        self.assertFalse(self.c.connected)
+        self.assertEqual(handler.emit.call_args[0][0].msg, 'last words')
+        handler.close.assert_called_once_with()
+        self.assertNotIn(self.c, server.RingChannel.active)
+
+    def test_full_ring_times_out(self):
+        self.client.ring_size = 64
+        self.client.timeout = 0.01
+        self.connect_ring()
+        data = pickle.dumps({'msg': 'x' * 20})
+        frame = struct.pack('>L', len(data)) + data
+        self.client.send(frame)
+        self.assertRaises(socket.timeout, self.client.send, frame)
+
+    def test_wakeups_never_block(self):
+        self.connect_ring()
+        self.assertEqual(self.client.sock.gettimeout(), 0.0)
+        # Far more wakeups than the socket buffer holds
+        for i in range(100000):
+            self.client.wake()
+        self.assertIsNotNone(self.client.ring)
+
+    def test_full_ring_woken_once(self):
+        self.client.ring_size = 64
+        self.client.timeout = 0.05
+        self.connect_ring()
+        data = pickle.dumps({'msg': 'x' * 20})
+        frame = struct.pack('>L', len(data)) + data
+        self.client.send(frame)
+        with mock.patch.object(self.client, 'wake') as wake:
+            self.assertRaises(socket.timeout, self.client.send, frame)
+        wake.assert_called_once_with()
+
+    def test_server_gone_while_ring_full(self):
+        self.client.ring_size = 64
+        self.connect_ring()
+        data = pickle.dumps({'msg': 'x' * 20})
+        frame = struct.pack('>L', len(data)) + data
+        self.client.send(frame)
+        self.ours.close()
+        self.assertRaises(ConnectionError, self.client.send, frame)
+        self.assertIsNone(self.client.ring)
+
+    def emitted(self):
+        return [c[0][0].msg for c in self.c.handler.emit.call_args_list]
+
+    def test_more_than_a_batch(self):
+        self.c.batch_size = 4
+        self.connect_ring()
+        for i in range(10):
+            self.client.emit(logging.makeLogRecord({'msg': i}))
+        self.c.handle_read()  # the one wakeup
+        # A step reads a record's header or its body
+        self.assertEqual(self.emitted(), ['0', '1'])
+        asyncore.loop(map=self.map, timeout=0, count=5)
+        self.assertEqual(self.emitted(), [str(i) for i in range(10)])
+
+    def test_drained_once_resumed(self):
+        self.connect_ring()
+        self.c.blocked_on = mock.MagicMock(backlogged=True)
+        for i in range(3):
+            self.client.emit(logging.makeLogRecord({'msg': i}))
+        self.c.handle_read()
+        self.assertEqual(self.emitted(), [])
+        # As `WriterPool.resume` does once the writer has caught up
+        self.c.blocked_on = None
+        self.c.interest_changed()
+        asyncore.loop(map=self.map, timeout=0, count=2)
+        self.assertEqual(self.emitted(), ['0', '1', '2'])
+
+    def test_stranded_records_read_before_reaping(self):
+        self.connect_ring()
+        self.c.timers = timers.TimerWheel(clock=lambda: 0.0)
+        self.c.idle_timeout = 60
+        self.c.last_active = 0.0
+        self.c.blocked_on = mock.MagicMock(backlogged=True)
+        self.client.emit(logging.makeLogRecord({'msg': 'stranded'}))
+        self.c.handle_read()
+        self.c.blocked_on = None
+        self.c.timers.advance(100)
+        self.c.check_timeout()
+        self.assertEqual(self.emitted(), ['stranded'])
+        self.assertTrue(self.c.connected)
+        self.c.timers.advance(200)
+        self.assertFalse(self.c.connected)
+
+
+if __name__ == "__main__":
+    unittest.main()
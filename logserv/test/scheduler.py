@@ -0,0 +1,119 @@
+import logging
+import time
+import unittest
+from unittest import mock
+
+from .. import eventloop, scheduler, server
+from . import utils
+
+
+class TestFairScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.s = scheduler.FairScheduler(quantum=100)
+        self.chatty = mock.MagicMock()
+        self.quiet = mock.MagicMock()
+
+    def test_within_budget(self):
+        self.s.charge(self.chatty, 99)
+        self.assertTrue(self.s.may_read(self.chatty))
+        self.assertFalse(self.chatty.interest_changed.called)
+
+    def test_throttle_and_resume(self):
+        self.s.charge(self.chatty, 100)
+        self.assertFalse(self.s.may_read(self.chatty))
+        self.chatty.interest_changed.assert_called_once_with()
+        self.s.new_round()
+        self.assertTrue(self.s.may_read(self.chatty))
+        self.assertEqual(self.chatty.interest_changed.call_count, 2)
+
+    def test_overdraft_costs_several_rounds(self):
+        self.s.charge(self.chatty, 350)
+        for _ in range(3):
+            self.assertFalse(self.s.may_read(self.chatty))
+            self.s.new_round()
+        self.assertTrue(self.s.may_read(self.chatty))
+
+    def test_unused_budget_does_not_accumulate(self):
+        self.s.charge(self.quiet, 10)
+        for _ in range(5):
+            self.s.new_round()
+        self.s.charge(self.quiet, 100)
+        self.assertFalse(self.s.may_read(self.quiet))
+
+    def test_record_quantum(self):
+        self.s = scheduler.FairScheduler(quantum=10 ** 6, record_quantum=2)
+        self.s.charge(self.chatty, 10, 1)
+        self.assertTrue(self.s.may_read(self.chatty))
+        self.s.charge(self.chatty, 10, 1)
+        self.assertFalse(self.s.may_read(self.chatty))
+
+    def test_lag_and_shedding(self):
+        self.s.shed_lag = 5
+        record = logging.makeLogRecord({'created': time.time() - 1})
+        self.assertTrue(self.s.observe(self.chatty, record))
+        self.assertGreaterEqual(self.s.stats(self.chatty).lag, 1)
+        self.assertFalse(self.chatty.close.called)
+        record = logging.makeLogRecord({'created': time.time() - 10})
+        self.assertFalse(self.s.observe(self.chatty, record))
+        self.chatty.close.assert_called_once_with()
+        self.assertEqual(self.s.shed_count, 1)
+        self.assertGreaterEqual(self.s.stats(self.chatty).max_lag, 10)
+
+    def test_report(self):
+        self.s.charge(self.chatty, 150, 3)
+        self.s.charge(self.quiet, 10, 1)
+        report = {r['client']: r for r in self.s.report()}
+        self.assertEqual(report[self.chatty.addr]['bytes'], 150)
+        self.assertEqual(report[self.chatty.addr]['records'], 3)
+        self.assertTrue(report[self.chatty.addr]['throttled'])
+        self.assertFalse(report[self.quiet.addr]['throttled'])
+
+    def test_forget(self):
+        self.s.charge(self.chatty, 150)
+        self.s.forget(self.chatty)
+        self.assertEqual(self.s.report(), [])
+        self.assertTrue(self.s.may_read(self.chatty))
+
+    def test_loop_runs_rounds(self):
+        m = mock.MagicMock()
+        m.__len__.return_value = 1
+        self.s.charge(self.chatty, 100)
+        eventloop.loop(m, timeout=30, count=1, scheduler=self.s)
+        m.poll.assert_called_once_with(0)
+        self.assertTrue(self.s.may_read(self.chatty))
+
+
+class TestChannelScheduling(utils.Patches, unittest.TestCase):
+
+    TO_PATCH = {'socket': 'socket.socket'}
+
+    def setUp(self):
+        super().setUp()
+        self.c = server.LoggingChannel(mock.MagicMock(), {})
+        self.c.scheduler = scheduler.FairScheduler(quantum=8)
+        self.c.recv = mock.MagicMock()
+
+    def test_charged_for_reads(self):
+        self.c.recv.return_value = b'HELLO 1.0\n'
+        self.c.handle_read()
+        self.assertEqual(self.c.bytes_in, 10)
+        self.assertFalse(self.c.readable())
+        self.c.scheduler.new_round()
+        self.assertTrue(self.c.readable())
+
+    def test_shed_record_not_written(self):
+        self.c.scheduler.shed_lag = 5
+        handler = self.c.handler = mock.MagicMock()
+        self.c.emit(logging.makeLogRecord({'created': time.time() - 10}))
+        self.assertFalse(self.c.connected)
+        handler.emit.assert_not_called()
+
+    def test_forgotten_on_close(self):
+        self.c.scheduler.charge(self.c, 1)
+        self.c.close()
+        self.assertEqual(self.c.scheduler.report(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+import errno
+import logging
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from .. import segments
+
+
+def record(msg):
+    return logging.LogRecord('app', logging.INFO, __file__, 1, msg, None,
+                             None)
+
+
+class TestPreallocatedHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'test.log')
+        self.handler = self.make_handler()
+
+    def tearDown(self):
+        self.handler.close()
+        self.tmpdir.cleanup()
+
+    def make_handler(self, **kwargs):
+        kwargs.setdefault('maxBytes', 1000)
+        kwargs.setdefault('backupCount', 2)
+        kwargs.setdefault('bufferSize', 100)
+        return segments.PreallocatedFileHandler(self.path, encoding='utf-8',
+                                                **kwargs)
+
+    def read(self, path=None):
+        with open(path or self.path, 'rb') as f:
+            return f.read()
+
+    def test_preallocated_then_truncated(self):
+        self.assertEqual(os.path.getsize(self.path), 1000)
+        self.handler.emit(record('héllo'))
+        self.handler.close()
+        self.assertEqual(self.read(), 'héllo\n'.encode('utf-8'))
+        self.assertFalse(os.path.exists(self.path + '.end'))
+
+    def test_buffered_until_full(self):
+        self.handler.emit(record('a' * 50))
+        self.assertEqual(self.read().rstrip(b'\x00'), b'')
+        self.handler.emit(record('b' * 50))
+        self.assertEqual(self.read().rstrip(b'\x00'),
+                         b'a' * 50 + b'\n' + b'b' * 50 + b'\n')
+
+    def test_flusher_writes_quiet_buffers(self):
+        self.handler.flusher = segments.Flusher(0.01)
+        self.handler.emit(record('quiet'))
+        deadline = time.time() + 5
+        while (self.read().rstrip(b'\x00') != b'quiet\n'
+               and time.time() < deadline):
+            time.sleep(0.01)
+        self.assertEqual(self.read().rstrip(b'\x00'), b'quiet\n')
+
+    def test_rollover_by_bytes(self):
+        # 29 characters plus the newline, 3 bytes more once encoded
+        for i in range(40):
+            self.handler.emit(record('%05d' % i + 'é' * 3 + 'x' * 21))
+        rotated = self.read(self.path + '.1')
+        self.assertEqual(len(rotated), 30 * 33)
+        self.handler.close()
+        lines = (rotated + self.read()).decode('utf-8').splitlines()
+        self.assertEqual([line[:5] for line in lines],
+                         ['%05d' % i for i in range(40)])
+
+    def test_large_record_alone(self):
+        self.handler.emit(record('x' * 3000))
+        self.handler.emit(record('next'))
+        self.handler.close()
+        self.assertEqual(self.read(self.path + '.1'), b'x' * 3000 + b'\n')
+        self.assertEqual(self.read(), b'next\n')
+
+    def crash(self):
+        # Leave the segment preallocated, as a crash would
+        stream = self.handler.stream
+        stream.flush()
+        os.close(stream.fd)
+        os.close(stream.end_fd)
+        stream.fd = stream.end_fd = None
+        self.handler.stream = None
+
+    def test_reopen_after_crash(self):
+        self.handler.emit(record('a' * 120))
+        self.crash()
+        self.assertTrue(os.path.exists(self.path + '.end'))
+        self.handler = self.make_handler()
+        self.handler.emit(record('after'))
+        self.handler.close()
+        self.assertEqual(self.read(), b'a' * 120 + b'\nafter\n')
+        self.assertFalse(os.path.exists(self.path + '.end'))
+
+    def test_data_ending_in_nul_kept(self):
+        self.handler.terminator = '\0'
+        self.handler.emit(record('a' * 120))
+        self.crash()
+        self.handler = self.make_handler()
+        self.handler.emit(record('after'))
+        self.handler.close()
+        self.assertEqual(self.read(), b'a' * 120 + b'\0after\n')
+
+    def test_unrotated_grows_by_step(self):
+        self.handler.close()
+        os.unlink(self.path)
+        with mock.patch.object(segments.PreallocatedFileHandler,
+                               'preallocate_step', 256):
+            self.handler = self.make_handler(maxBytes=0, bufferSize=10)
+            self.assertEqual(os.path.getsize(self.path), 0)
+            self.handler.emit(record('x' * 99))
+            self.assertEqual(os.path.getsize(self.path), 256)
+            for _ in range(3):
+                self.handler.emit(record('x' * 99))
+            self.assertEqual(os.path.getsize(self.path), 512)
+        self.handler.close()
+        self.assertEqual(os.path.getsize(self.path), 400)
+
+    def test_no_preallocation_support(self):
+        self.handler.close()
+        os.unlink(self.path)
+        with mock.patch('os.posix_fallocate',
+                        side_effect=OSError(errno.EOPNOTSUPP, 'nope')):
+            self.handler = self.make_handler()
+            self.assertEqual(os.path.getsize(self.path), 0)
+            self.handler.emit(record('plain'))
+        self.handler.close()
+        self.assertEqual(self.read(), b'plain\n')
+
+    def test_device(self):
+        handler = segments.PreallocatedFileHandler(os.devnull, maxBytes=10)
+        try:
+            self.assertFalse(handler.stream.regular)
+            for _ in range(5):
+                handler.emit(record('discarded'))
+        finally:
+            handler.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,10 +1,18 @@
+import collections
+import json
 import logging
+import os
 import pickle
+import socket
 import struct
+import sys
+import tempfile
+import threading
 import unittest
 from unittest import mock
 
-from .. import server, ProtocolError
+from .. import (buffers, client, filecache, formatters, server, sinks,
+                timers, writer, ProtocolError)
 from . import utils
 
 
@@ -17,7 +25,7 @@ class TestServer(utils.Patches, unittest.TestCase):
         self.assertEqual('path', s.addr)
         self.assertTrue(s.accepting)
         s.socket.bind.assert_called_once_with('path')
-        s.socket.listen.assert_called_once_with(5)
+        s.socket.listen.assert_called_once_with(socket.SOMAXCONN)
 
     def test_accepted(self):
         s = server.LogServer('path')
@@ -27,6 +35,20 @@ class TestServer(utils.Patches, unittest.TestCase):
         self.assertEqual(server.LogServer.channel_class,
                          server.LoggingChannel)
 
+    def test_accept_batch(self):
+        s = server.LogServer('path')
+        s.accept_batch = 3
+        s.accept = mock.MagicMock(side_effect=[('a', 1), ('b', 2), ('c', 3),
+                                               ('d', 4)])
+        s.handle_accepted = mock.MagicMock()
+        s.handle_accept()
+        self.assertEqual(s.handle_accepted.call_args_list,
+                         [mock.call('a', 1), mock.call('b', 2),
+                          mock.call('c', 3)])
+        s.accept = mock.MagicMock(side_effect=[('d', 4), None])
+        s.handle_accept()
+        self.assertEqual(s.handle_accepted.call_count, 4)
+
 
 class TestChannel(utils.Patches, unittest.TestCase):
 
@@ -43,16 +65,103 @@ class TestChannelBasic(TestChannel):
     def test_create(self):
         self.assertEqual(self.c.status, 'WELCOMING')
         self.assertEqual(self.c.handler, None)
-        self.assertEqual(self.c.read_buf, [])
+        self.assertEqual(self.c.pending, b'')
         self.assertEqual(self.c.write_buf, b'')
         self.assertEqual(self.c.remaining, 0)
 
+    def test_compact_state(self):
+        self.assertEqual(self.c.state, server.LoggingChannel.WELCOMING)
+        self.c.status = 'LOGGING'
+        self.assertEqual(self.c.state, server.LoggingChannel.LOGGING)
+        self.assertNotIn('state', vars(self.c))
+        self.assertNotIn('handler', vars(self.c))
+
+    def test_buffer_returned_to_pool(self):
+        self.c.buffers = buffers.BufferPool()
+        self.c.buffer(b'partial')
+        buf = self.c.read_buf
+        self.assertEqual(self.c.take(b' message'), b'partial message')
+        self.assertIsNone(self.c.read_buf)
+        self.assertIs(self.c.buffers.acquire(10), buf)
+
+    def test_buffer_grows(self):
+        self.c.buffer(b'x' * 1000)
+        self.c.buffer(b'y' * 1000)
+        self.assertEqual(self.c.pending, b'x' * 1000 + b'y' * 1000)
+        self.assertEqual(len(self.c.read_buf), 2048)
+
     def test_read_write_state(self):
         self.assertTrue(self.c.readable())
         self.assertFalse(self.c.writable())
         self.c.write_buf = b'Test message\n'
         self.assertTrue(self.c.writable())
+        # Pending replies no longer stop the channel from reading
+        self.assertTrue(self.c.readable())
+
+    def test_replies_queue_up(self):
+        self.c.reply('OK\n')
+        self.c.reply('OK\n')
+        self.assertEqual(self.c.write_buf, b'OK\nOK\n')
+
+    def test_replies_grow_in_place(self):
+        self.c.reply('OK\n')
+        buf = self.c.write_buf
+        self.c.reply('OK\n')
+        self.assertIs(self.c.write_buf, buf)
+
+    def test_unread_replies_stop_reading(self):
+        self.c.max_pending_replies = 6
+        self.c.interest_changed = mock.MagicMock()
+        self.c.reply('OK\n')
+        self.assertTrue(self.c.readable())
+        self.c.reply('OK\n')
         self.assertFalse(self.c.readable())
+        self.assertEqual(self.c.interest_changed.call_count, 2)
+        self.c.socket.send = mock.MagicMock(return_value=3)
+        self.c.handle_write()
+        self.assertTrue(self.c.readable())
+        self.assertEqual(self.c.write_buf, b'OK\n')
+        self.assertEqual(self.c.interest_changed.call_count, 3)
+
+    def test_own_handler_closed(self):
+        handler = self.c.handler = mock.MagicMock()
+        self.c.close()
+        handler.close.assert_called_once_with()
+        self.assertIsNone(self.c.handler)
+
+    def test_own_handler_closed_after_queued_records(self):
+        pool = self.c.writers = writer.WriterPool(self.map)
+        self.addCleanup(pool.close, 5)
+        handler = self.c.handler = mock.MagicMock()
+        gate = threading.Event()
+        handler.emit.side_effect = lambda record: gate.wait(5)
+        self.c.emit(logging.LogRecord('app', logging.INFO, __file__, 1,
+                                      'last', None, None))
+        self.c.close()
+        handler.close.assert_not_called()
+        gate.set()
+        pool.close(5)
+        self.assertEqual([name for name, _, _ in handler.method_calls],
+                         ['emit', 'close'])
+
+    def test_cached_file_forgotten_on_close(self):
+        cache = filecache.FileCache()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            handler_class = type('Handler',
+                                 (filecache.CachedRotatingFileHandler,),
+                                 {'file_cache': cache})
+            handler = self.c.handler = handler_class(
+                os.path.join(tmpdir, 'app.log'))
+            self.assertIn(handler, cache)
+            self.c.close()
+            self.assertNotIn(handler, cache)
+            self.assertIsNone(handler.stream)
+
+    def test_alert_error_terminated(self):
+        self.c.alert_error(ProtocolError("'LOG\n'", 'GARBAGE\n'))
+        self.assertTrue(self.c.write_buf.startswith(b'ERROR '))
+        self.assertTrue(self.c.write_buf.endswith(b'\n'))
+        self.assertEqual(self.c.write_buf.count(b'\n'), 1)
 
 
 class TestReading(TestChannel):
@@ -69,7 +178,7 @@ class TestReadline(TestReading):
         line = self.c.find_term()
         self.assertEqual(line, 'Test line\n')
         self.c.recv.assert_called_once_with(1024)
-        self.assertEqual(self.c.read_buf, [])
+        self.assertEqual(self.c.pending, b'')
 
     def test_multiple_reads(self):
         self.c.recv.side_effect = ['Tes'.encode('UTF-8'),
@@ -77,16 +186,15 @@ class TestReadline(TestReading):
                                     'ine\n'.encode('UTF-8')]
         resp = self.c.find_term()
         self.assertEqual(resp, None)
-        self.assertEqual(self.c.read_buf, ['Tes'.encode('UTF-8')])
+        self.assertEqual(self.c.pending, 'Tes'.encode('UTF-8'))
 
         resp = self.c.find_term()
         self.assertEqual(resp, None)
-        self.assertEqual(self.c.read_buf, ['Tes'.encode('UTF-8'),
-                                           't l'.encode('UTF-8')])
+        self.assertEqual(self.c.pending, 'Test l'.encode('UTF-8'))
 
         resp = self.c.find_term()
         self.assertEqual(resp, 'Test line\n')
-        self.assertEqual(self.c.read_buf, [])
+        self.assertEqual(self.c.pending, b'')
 
     def test_malformed_data(self):
         self.c.recv.return_value = ('two lines\n'
@@ -114,7 +222,7 @@ class TestReadByLen(TestReading):
         self.c.recv.return_value = '1234567890'.encode('UTF-8')
         ret = self.c.receive_by_len()
         self.assertEqual(ret, '1234567890'.encode('UTF-8'))
-        self.assertEqual(self.c.read_buf, [])
+        self.assertEqual(self.c.pending, b'')
         self.assertEqual(self.c.remaining, 0)
 
     def test_multiple_reads(self):
@@ -123,16 +231,15 @@ class TestReadByLen(TestReading):
                                  '7890'.encode('UTF-8')]
         ret = self.c.receive_by_len()
         self.assertEqual(ret, None)
-        self.assertEqual(self.c.read_buf, ['123'.encode('UTF-8')])
+        self.assertEqual(self.c.pending, '123'.encode('UTF-8'))
         self.assertEqual(self.c.remaining, 7)
         ret = self.c.receive_by_len()
         self.assertEqual(ret, None)
-        self.assertEqual(self.c.read_buf, ['123'.encode('UTF-8'),
-                                           '456'.encode('UTF-8')])
+        self.assertEqual(self.c.pending, '123456'.encode('UTF-8'))
         self.assertEqual(self.c.remaining, 4)
         ret = self.c.receive_by_len()
         self.assertEqual(ret, '1234567890'.encode('UTF-8'))
-        self.assertEqual(self.c.read_buf, [])
+        self.assertEqual(self.c.pending, b'')
         self.assertEqual(self.c.remaining, 0)
 
 
@@ -202,7 +309,7 @@ class TestNormalTransitions(TestStateTransitions):
         self.c.handle_read()
         self.c.welcome.assert_called_once_with()
         self.assertEqual(self.c.status, 'IDENTIFYING')
-        self.assertEqual(self.c.write_buf, 'HELLO 1.0\n')
+        self.assertEqual(self.c.write_buf, b'HELLO 1.0\n')
 
     def test_identify(self):
         self.c.status = 'IDENTIFYING'
@@ -214,7 +321,7 @@ class TestNormalTransitions(TestStateTransitions):
         self.c.handler_class.assert_called_once_with(filename="test.log",
                                                      maxBytes=10240)
         self.assertEqual(self.c.status, 'WAITING')
-        self.assertEqual(self.c.write_buf, 'OK\n')
+        self.assertEqual(self.c.write_buf, b'OK\n')
 
     def test_waiting(self):
         self.c.status = 'WAITING'
@@ -222,7 +329,7 @@ class TestNormalTransitions(TestStateTransitions):
         self.c.handle_read()
         self.c.confirm_log.assert_called_once_with()
         self.assertEqual(self.c.status, 'LOG-HEADER')
-        self.assertEqual(self.c.write_buf, 'OK\n')
+        self.assertEqual(self.c.write_buf, b'OK\n')
 
     def test_log_header_to_log(self):
         self.c.status = 'LOG-HEADER'
@@ -261,7 +368,37 @@ class TestNormalTransitions(TestStateTransitions):
         self.c.handle_read()
         self.c.receive_msg.assert_called_once_with()
         self.c.format.assert_called_once_with(fmt='%(message)s')
-        self.assertEqual(self.c.write_buf, 'OK\n')
+        self.assertEqual(self.c.write_buf, b'OK\n')
+
+    def test_receive_json_format_msg(self):
+        self.c.status = 'MESSAGING'
+        self.c.handler = logging.Handler()
+        self.eret = 'FORMAT {"style": "json", "fields": ["message"]}\n'
+        self.c.handle_read()
+        self.assertIsInstance(self.c.handler.formatter,
+                              formatters.JSONFormatter)
+        self.assertEqual(self.c.handler.formatter.fields, ('message',))
+        self.assertEqual(self.c.status, 'LOG-HEADER')
+        self.assertEqual(self.c.remaining, 4)
+
+    def test_identify_with_format(self):
+        self.c.status = 'IDENTIFYING'
+        self.eret = ('IDENTIFY {"--level": 0, "--format": {"style": "json"},'
+                     ' "filename": "test.log"}\n')
+        self.c.handler_class = mock.MagicMock()
+        self.c.handle_read()
+        self.c.handler_class.assert_called_once_with(filename="test.log")
+        formatter = self.c.handler.setFormatter.call_args[0][0]
+        self.assertIsInstance(formatter, formatters.JSONFormatter)
+
+    def test_identify_default_formatter(self):
+        self.c.status = 'IDENTIFYING'
+        self.eret = 'IDENTIFY {"--level": 0, "filename": "test.log"}\n'
+        self.c.handler_class = mock.MagicMock()
+        self.c.default_formatter = formatters.JSONFormatter()
+        self.c.handle_read()
+        self.c.handler.setFormatter.assert_called_once_with(
+            self.c.default_formatter)
 
     def test_receive_quit_msg(self):
         self.c.status = 'MESSAGING'
@@ -351,11 +488,518 @@ class TestProtocolErrors(TestStateTransitions):
         self.eret = 'FORMAT {"not_an_arg": 3}\n'
         self.force()
 
+    def test_bad_format_style(self):
+        self.c.status = 'MESSAGING'
+        self.eret = 'FORMAT {"style": "?"}\n'
+        self.force()
+
+    def test_identify_bad_format(self):
+        self.c.status = 'IDENTIFYING'
+        self.eret = 'IDENTIFY {"--level": 0, "--format": {"style": "?"}}\n'
+        self.force()
+
     def test_format_params_not_json_dict(self):
         self.c.status = 'MESSAGING'
         self.eret = 'FORMAT [3, 4]\n'
         self.force()
 
 
+class TestSinks(TestChannel):
+
+    SINKS = ('IDENTIFY {"--level": 0, "--sinks": ['
+             '{"--level": 0, "filename": "app.log"}, '
+             '{"--level": 40, "filename": "errors.log", '
+             '"--format": {"style": "json"}}]}\n')
+
+    def setUp(self):
+        super().setUp()
+        self.registry = sinks.SinkRegistry()
+        self.handler_class = mock.MagicMock(
+            side_effect=lambda **kw: mock.MagicMock(name=kw['filename']))
+        self.c = self.make_channel()
+
+    def make_channel(self):
+        c = server.LoggingChannel(mock.MagicMock(), self.map)
+        c.shared_sinks = self.registry
+        c.handler_class = self.handler_class
+        c.recv = mock.MagicMock()
+        c.status = 'IDENTIFYING'
+        c.recv.return_value = self.SINKS.encode('UTF-8')
+        c.handle_read()
+        return c
+
+    def test_identify(self):
+        self.assertIsNone(self.c.handler)
+        self.assertEqual([level for level, _ in self.c.sinks], [0, 40])
+        self.assertEqual(self.c.status, 'WAITING')
+        app, errors = [h for _, h in self.c.sinks]
+        errors.setFormatter.assert_called_once_with(mock.ANY)
+        self.assertIsInstance(errors.setFormatter.call_args[0][0],
+                              formatters.JSONFormatter)
+
+    def test_fan_out_by_level(self):
+        app, errors = [h for _, h in self.c.sinks]
+        info = logging.LogRecord('app', logging.INFO, __file__, 1, 'info',
+                                 None, None)
+        error = logging.LogRecord('app', logging.ERROR, __file__, 1, 'error',
+                                  None, None)
+        self.c.emit(info)
+        self.c.emit(error)
+        self.assertEqual(app.emit.call_args_list,
+                         [mock.call(info), mock.call(error)])
+        errors.emit.assert_called_once_with(error)
+
+    def test_shared_between_channels(self):
+        other = self.make_channel()
+        self.assertEqual([h for _, h in self.c.sinks],
+                         [h for _, h in other.sinks])
+        self.assertEqual(self.handler_class.call_count, 2)
+        self.c.close()
+        self.assertEqual(len(self.registry), 2)
+        other.close()
+        self.assertEqual(len(self.registry), 0)
+
+    def test_sinks_closed_when_unused(self):
+        app, errors = [h for _, h in self.c.sinks]
+        self.c.close()
+        app.close.assert_called_once_with()
+        errors.close.assert_called_once_with()
+
+    def test_sinks_closed_after_queued_records(self):
+        pool = self.c.writers = writer.WriterPool(self.map)
+        self.addCleanup(pool.close, 5)
+        app, errors = [h for _, h in self.c.sinks]
+        gate = threading.Event()
+        app.emit.side_effect = lambda record: gate.wait(5)
+        self.c.emit(logging.LogRecord('app', logging.INFO, __file__, 1,
+                                      'last', None, None))
+        self.c.close()
+        app.close.assert_not_called()
+        gate.set()
+        pool.close(5)
+        self.assertEqual([name for name, _, _ in app.mock_calls[-2:]],
+                         ['emit', 'close'])
+        errors.close.assert_called_once_with()
+
+    def test_own_handler_and_sinks(self):
+        c = server.LoggingChannel(mock.MagicMock(), self.map)
+        c.shared_sinks = self.registry
+        c.handler_class = self.handler_class
+        c.recv = mock.MagicMock(return_value=(
+            'IDENTIFY {"--level": 0, "filename": "own.log", "--sinks": '
+            '[{"--level": 0, "filename": "app.log"}]}\n').encode('UTF-8'))
+        c.status = 'IDENTIFYING'
+        c.handle_read()
+        self.assertIsNotNone(c.handler)
+        self.assertEqual(len(c.sinks), 1)
+
+    def test_format_message_rejected(self):
+        self.c.status = 'MESSAGING'
+        self.c.recv.return_value = b'FORMAT {"fmt": "%(message)s"}\n'
+        self.assertRaises(ProtocolError, self.c.dispatch_read)
+
+    def test_bad_handler_releases_sinks(self):
+        c = server.LoggingChannel(mock.MagicMock(), self.map)
+        c.shared_sinks = self.registry
+        c.handler_class = lambda filename, **kw: (
+            self.handler_class(filename=filename, **kw))
+        c.recv = mock.MagicMock(return_value=(
+            'IDENTIFY {"--level": 0, "bad": 1, "--sinks": [{"--level": 0, '
+            '"filename": "new.log"}]}\n').encode('UTF-8'))
+        c.status = 'IDENTIFYING'
+        self.assertRaises(ProtocolError, c.dispatch_read)
+        self.assertEqual(len(self.registry), 2)  # only self.c's sinks
+        self.assertIsNone(c.sinks)
+        self.assertIsNone(c.handler)
+
+    def test_bad_sink_releases_others(self):
+        c = server.LoggingChannel(mock.MagicMock(), self.map)
+        c.shared_sinks = self.registry
+        c.handler_class = self.handler_class
+        c.recv = mock.MagicMock(return_value=(
+            'IDENTIFY {"--level": 0, "--sinks": [{"--level": 0, '
+            '"filename": "new.log"}, {"filename": "x"}]}\n').encode('UTF-8'))
+        c.status = 'IDENTIFYING'
+        self.assertRaises(ProtocolError, c.dispatch_read)
+        self.assertEqual(len(self.registry), 2)  # only self.c's sinks
+        self.assertIsNone(c.sinks)
+
+
+class TestSeqPacket(unittest.TestCase):
+
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair(socket.AF_UNIX,
+                                                   socket.SOCK_SEQPACKET)
+        self.c = server.SeqPacketChannel(self.ours, {})
+        self.c.handler_class = mock.MagicMock()
+
+    def tearDown(self):
+        self.c.close()
+        self.theirs.close()
+
+    def send(self, *packets):
+        for packet in packets:
+            if isinstance(packet, str):
+                packet = packet.encode('UTF-8')
+            self.theirs.send(packet)
+
+    def frame(self, log_dict):
+        data = pickle.dumps(log_dict)
+        return struct.pack(">L", len(data)) + data
+
+    def test_handshake_and_records_batched(self):
+        self.send('HELLO 1.0\n',
+                  'IDENTIFY {"--level": 0, "filename": "test.log"}\n',
+                  'LOG\n',
+                  self.frame({'msg': 'one'}),
+                  self.frame({'msg': 'two'}))
+        self.c.handle_read()
+        self.assertEqual(self.c.status, 'LOG-HEADER')
+        self.assertEqual(self.c.write_buf, b'HELLO 1.0\nOK\nOK\n')
+        emitted = [c[0][0].msg for c in self.c.handler.emit.call_args_list]
+        self.assertEqual(emitted, ['one', 'two'])
+
+    def test_split_header_and_message(self):
+        self.c.status = 'LOG-HEADER'
+        self.c.handler = logging.Handler()
+        self.send(b'\x00\x00\x00\x00', 'QUIT\n')
+        self.c.handle_read()
+        self.assertFalse(self.c.connected)
+
+    def test_receive_buffer_reused(self):
+        self.c.buffers = buffers.BufferPool()
+        self.send('HELLO 1.0\n', 'IDENTIFY {"--level": 0}\n')
+        with mock.patch.object(self.c.buffers, 'acquire',
+                               wraps=self.c.buffers.acquire) as acquire:
+            self.c.handle_read()
+        self.assertEqual(self.c.status, 'WAITING')
+        self.assertEqual(acquire.call_count, 3)  # the last finds none
+        # One buffer served every packet
+        self.assertEqual(len(self.c.buffers.free[self.c.max_packet]), 1)
+
+    def test_truncated_packet(self):
+        self.c.max_packet = 8
+        self.send('HELLO 1.0 and then some\n')
+        self.c.handle_read()
+        self.assertTrue(self.c.write_buf.startswith(b'ERROR'))
+
+    def test_client_hangup(self):
+        self.theirs.close()
+        self.c.handle_read()
+        self.assertFalse(self.c.connected)
+
+    def test_server_socket_type(self):
+        self.assertEqual(server.SeqPacketServer.socket_type,
+                         socket.SOCK_SEQPACKET)
+        self.assertEqual(server.SeqPacketServer.channel_class,
+                         server.SeqPacketChannel)
+
+
+class TestMultiplexed(unittest.TestCase):
+
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair()
+        self.c = server.LoggingChannel(self.ours, {})
+        self.c.shared_sinks = sinks.SinkRegistry()
+        self.c.handler_class = mock.MagicMock(
+            side_effect=lambda **kw: mock.MagicMock(name=kw['filename']))
+        self.c.status = 'IDENTIFYING'
+        self.say(b'IDENTIFY {"--level": 0, "--multiplex": {}}\n')
+        self.say(b'LOG\n')
+
+    def tearDown(self):
+        self.c.close()
+        self.theirs.close()
+
+    def say(self, *chunks):
+        for chunk in chunks:
+            self.theirs.sendall(chunk)
+            self.c.handle_read()
+
+    def declare(self, stream, spec):
+        self.say(b'\x00\x00\x00\x00', b'ROUTE %d %s\n' % (stream, spec))
+
+    def frame(self, bits, level=logging.INFO, msg='hi'):
+        data = pickle.dumps(logging.LogRecord('app', level, __file__, 1, msg,
+                                              None, None).__dict__)
+        return struct.pack('>LQ', len(data) + 8, bits) + data
+
+    def test_record_sent_once_to_several_streams(self):
+        self.declare(0, b'{"--level": 0, "filename": "a.log"}')
+        self.declare(5, b'{"--level": 40, "filename": "b.log"}')
+        self.assertEqual(self.c.write_buf, b'OK\n' * 4)
+        a, b = self.c.routes[0][1], self.c.routes[5][1]
+        for frame in (self.frame(0b100001, logging.ERROR),
+                      self.frame(0b100001)):
+            self.say(frame[:4], frame[4:])
+        self.assertEqual(a.emit.call_count, 2)
+        b.emit.assert_called_once_with(mock.ANY)
+        self.assertEqual(self.c.records_in, 2)
+
+    def test_undeclared_stream(self):
+        self.declare(0, b'{"--level": 0, "filename": "a.log"}')
+        frame = self.frame(0b10)
+        self.say(frame[:4], frame[4:])
+        self.assertTrue(self.c.write_buf.endswith(b'\n'))
+        self.assertIn(b'ERROR ', self.c.write_buf)
+
+    def test_stream_id_range(self):
+        self.declare(64, b'{"--level": 0, "filename": "a.log"}')
+        self.assertIn(b'ERROR ', self.c.write_buf)
+        self.assertEqual(self.c.routes, {})
+
+
+
+class TestExcCache(unittest.TestCase):
+
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair()
+        self.c = server.LoggingChannel(self.ours, {})
+        self.c.handler_class = mock.MagicMock()
+        self.c.status = 'IDENTIFYING'
+        self.say(b'IDENTIFY {"--level": 0, "--exc-cache": 2}\n')
+        self.say(b'LOG\n')
+        self.handler = self.c.handler
+        self.f = client.SocketForwarder('localhost', 9876)
+        self.f.exc_cache_size = 2
+        self.f.exc_cache = collections.OrderedDict()
+        self.f.sock = mock.MagicMock()
+
+    def tearDown(self):
+        self.c.close()
+        self.theirs.close()
+
+    def say(self, *chunks):
+        for chunk in chunks:
+            self.theirs.sendall(chunk)
+            self.c.handle_read()
+
+    def send(self, msg):
+        try:
+            raise ValueError(msg)
+        except ValueError:
+            record = logging.LogRecord('app', logging.ERROR, __file__, 1,
+                                       msg, None, sys.exc_info())
+        frame = self.f.makePickle(record)
+        self.say(frame[:4], frame[4:])
+        return self.handler.emit.call_args[0][0]
+
+    def test_references_resolved(self):
+        texts = [self.send(msg).exc_text for msg in 'abacab']
+        self.assertEqual(self.c.write_buf, b'OK\nOK\n')
+        for msg, text in zip('abacab', texts):
+            self.assertIn('ValueError: %s' % msg, text)
+        self.assertEqual(len(self.c.exc_cache), 2)
+        self.assertFalse(hasattr(self.handler.emit.call_args[0][0],
+                                 'exc_ref'))
+
+    def test_unknown_reference(self):
+        frame = pickle.dumps({'msg': 'x', 'exc_text': None,
+                              'exc_ref': b'0' * 16})
+        self.say(struct.pack('>L', len(frame)), frame)
+        self.assertIn(b'a known traceback reference', self.c.write_buf)
+
+    def test_bad_size(self):
+        c = server.LoggingChannel(mock.MagicMock(), {})
+        for size in (b'0', b'true', b'"2"', b'100000'):
+            with self.assertRaises(ProtocolError):
+                c.configure(json.loads(b'{"--level": 0, "--exc-cache": %s}'
+                                       % size))
+
+    def test_handoff(self):
+        self.send('a')
+        state = json.loads(json.dumps(self.c.handoff_state()))
+        sock = socket.socket(fileno=os.dup(self.ours.fileno()))
+
+        class Channel(server.LoggingChannel):
+            handler_class = mock.MagicMock()
+        restored = Channel.restore(sock, {}, state)
+        try:
+            self.assertEqual(restored.exc_cache, self.c.exc_cache)
+            self.assertEqual(restored.exc_cache_bytes,
+                             self.c.exc_cache_bytes)
+        finally:
+            restored.close()
+
+    def test_total_size_bounded(self):
+        size = len(self.send('a').exc_text)
+        # Room for one traceback only: both ends evict by size alike
+        with mock.patch.object(server, 'EXC_CACHE_BYTES', size + 10), \
+                mock.patch.object(client, 'EXC_CACHE_BYTES', size + 10):
+            texts = [self.send(msg).exc_text for msg in 'bab']
+            self.assertEqual(len(self.c.exc_cache), 1)
+            self.assertEqual(self.c.exc_cache_bytes, size)
+        self.assertEqual(self.c.write_buf, b'OK\nOK\n')
+        for msg, text in zip('bab', texts):
+            self.assertIn('ValueError: %s' % msg, text)
+
+    def test_oversized_sent_in_full(self):
+        with mock.patch.object(server, 'EXC_CACHE_BYTES', 10), \
+                mock.patch.object(client, 'EXC_CACHE_BYTES', 10):
+            for _ in range(2):
+                self.assertIn('ValueError: a', self.send('a').exc_text)
+        self.assertEqual(len(self.c.exc_cache), 0)
+        self.assertEqual(self.c.write_buf, b'OK\nOK\n')
+
+    def test_oversized_reference_rejected(self):
+        with mock.patch.object(server, 'EXC_CACHE_BYTES', 10):
+            with self.assertRaises(ProtocolError):
+                self.c.remember_exc(b'0' * 16, 'x' * 11)
+
+
+class TestFieldDictionary(unittest.TestCase):
+
+    def setUp(self):
+        self.c = server.LoggingChannel(mock.MagicMock(), {})
+        self.c.configure_field_ids(4)
+        self.f = client.SocketForwarder('localhost', 9876)
+        self.f.field_dictionary_size = 4
+        self.f.field_ids = {}
+        self.f.sock = mock.MagicMock()
+
+    def roundtrip(self, name, func):
+        record = logging.LogRecord(name, logging.INFO, '/src/app.py', 1,
+                                   'hi', None, None, func)
+        decoded = self.c.decode_record(self.f.makePickle(record)[4:])
+        self.c.resolve_fields(decoded)
+        return decoded
+
+    def test_fields_restored_and_shared(self):
+        one = self.roundtrip('app', 'handle')
+        two = self.roundtrip('app', 'other')
+        for record, func in ((one, 'handle'), (two, 'other')):
+            self.assertEqual((record.name, record.pathname, record.filename,
+                              record.module, record.funcName),
+                             ('app', '/src/app.py', 'app.py', 'app', func))
+        self.assertIs(one.pathname, two.pathname)
+        self.assertIs(one.name, sys.intern('app'))
+        self.assertEqual(len(self.c.field_ids), 4)
+
+    def test_bad_numbers(self):
+        self.roundtrip('app', 'handle')
+        for value in (17, -1, (0, 'again'), (4, 3), (4, 'x', 'y')):
+            record = logging.makeLogRecord({'name': value})
+            with self.assertRaises(ProtocolError):
+                self.c.resolve_fields(record)
+
+    def test_bad_size(self):
+        for size in (0, True, '2', 100000):
+            with self.assertRaises(ProtocolError):
+                self.c.configure_field_ids(size)
+
+
+class TestTimeouts(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = mock.MagicMock(return_value=0.0)
+        self.wheel = timers.TimerWheel(tick=1.0, clock=self.clock)
+        self.ours, self.theirs = socket.socketpair()
+        self.theirs.setblocking(False)
+        self.c = self.make_channel(handshake_timeout=10, idle_timeout=60)
+
+    def tearDown(self):
+        self.c.close()
+        self.theirs.close()
+
+    def make_channel(self, **attrs):
+        attrs.setdefault('timers', self.wheel)
+        attrs.setdefault('handler_class', mock.MagicMock())
+        cls = type('Channel', (server.LoggingChannel,), attrs)
+        return cls(self.ours, {})
+
+    def advance(self, now):
+        self.clock.return_value = now
+        self.wheel.advance()
+
+    def say(self, data):
+        self.theirs.sendall(data)
+        self.c.handle_read()
+
+    def handshake(self):
+        self.say(b'HELLO 1.0\n')
+        self.say(b'IDENTIFY {"--level": 0}\n')
+        self.say(b'LOG\n')
+
+    def test_handshake_timeout(self):
+        self.say(b'HELLO 1.0\n')
+        self.advance(9.5)
+        self.assertTrue(self.c.connected)
+        self.advance(10.5)
+        self.assertFalse(self.c.connected)
+        self.assertEqual(self.c.status, 'CLOSED')
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_idle_timeout(self):
+        self.handshake()
+        self.advance(50)
+        data = pickle.dumps(logging.makeLogRecord({'msg': 'hi'}).__dict__)
+        self.say(struct.pack('>L', len(data)) + data)
+        # Reads push the deadline back without touching the wheel
+        self.advance(70)
+        self.assertTrue(self.c.connected)
+        self.advance(109)
+        self.assertTrue(self.c.connected)
+        self.advance(111)
+        self.assertFalse(self.c.connected)
+
+    def test_no_idle_timeout(self):
+        self.c.close()
+        self.theirs.close()
+        self.ours, self.theirs = socket.socketpair()
+        self.c = self.make_channel(handshake_timeout=10, idle_timeout=None)
+        self.handshake()
+        self.advance(11)
+        self.assertTrue(self.c.connected)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_log_ends_handshake(self):
+        self.c.close()
+        self.theirs.close()
+        self.ours, self.theirs = socket.socketpair()
+        self.c = self.make_channel(handshake_timeout=10, idle_timeout=None)
+        # Identified, so with a handler, but never asking to LOG
+        self.say(b'HELLO 1.0\n')
+        self.say(b'IDENTIFY {"--level": 0}\n')
+        self.assertIsNotNone(self.c.handler)
+        self.advance(11)
+        self.assertFalse(self.c.connected)
+
+    def test_held_back_channel_not_idle(self):
+        self.handshake()
+        self.c.blocked_on = mock.MagicMock(backlogged=True)
+        self.advance(61)
+        self.assertTrue(self.c.connected)
+        self.c.blocked_on = None
+        self.advance(122)
+        self.assertFalse(self.c.connected)
+
+    def test_subscriber_not_idle(self):
+        self.say(b'HELLO 1.0\n')
+        self.say(b'SUBSCRIBE {}\n')
+        self.advance(1000)
+        self.assertTrue(self.c.connected)
+
+    def test_close_cancels_timer(self):
+        self.c.close()
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_restored_channel(self):
+        state = self.c.handoff_state()
+        state['status'] = 'LOG-HEADER'
+        state['remaining'] = 4
+        state['params'] = {'--level': 0}
+        self.c.close()
+        self.ours, other = socket.socketpair()
+        other.close()
+        cls = type('Channel', (server.LoggingChannel,), {
+            'timers': self.wheel, 'handler_class': mock.MagicMock(),
+            'handshake_timeout': 10, 'idle_timeout': 60})
+        self.c = cls.restore(self.ours, {}, state)
+        self.advance(30)
+        self.assertTrue(self.c.connected)
+        self.advance(61)
+        self.assertFalse(self.c.connected)
+
+
 if __name__ == "__main__":
     unittest.main()
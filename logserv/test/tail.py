@@ -0,0 +1,223 @@
+import asyncore
+import json
+import logging
+import os
+import pickle
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from .. import ProtocolError, client, server, sinks, tail
+
+
+def record(level=logging.INFO, msg='hi', name='app'):
+    return logging.LogRecord(name, level, __file__, 1, msg, None, None)
+
+
+def handler(filename):
+    return mock.MagicMock(baseFilename=os.path.abspath(filename))
+
+
+class TestSubscription(unittest.TestCase):
+
+    def subscription(self, max_queued=1 << 20, **spec):
+        return tail.Subscription(mock.MagicMock(), spec, max_queued)
+
+    def test_filters(self):
+        h = handler('app.log')
+        cases = [
+            ({'level': 'ERROR'}, record(logging.ERROR), True),
+            ({'level': 'ERROR'}, record(logging.INFO), False),
+            ({'logger': 'app'}, record(name='app.db'), True),
+            ({'logger': 'app'}, record(name='apple'), False),
+            ({'file': 'app.log'}, record(), True),
+            ({'file': 'other.log'}, record(), False),
+            ({'contains': 'time'}, record(msg='timeout'), True),
+            ({'contains': 'time'}, record(msg='hi'), False),
+            ({}, record(), True),
+        ]
+        for spec, rec, expected in cases:
+            self.assertEqual(self.subscription(**spec).matches(rec, h),
+                             expected, spec)
+
+    def test_bad_filters(self):
+        for spec in ({'level': 'LOUD'}, {'logger': 3}, {'colour': 'red'}):
+            with self.assertRaises(ProtocolError):
+                self.subscription(**spec)
+        with self.assertRaises(ProtocolError):
+            tail.Subscription(mock.MagicMock(), [], 100)
+
+    def test_drops_when_full(self):
+        s = self.subscription(max_queued=10)
+        s.push(b'x' * 6)
+        s.channel.interest_changed.assert_called_once_with()
+        s.push(b'y' * 6)
+        s.push(b'z' * 6)
+        self.assertEqual(s.dropped, 2)
+        self.assertEqual(s.take(100), b'x' * 6)
+        self.assertEqual(s.queued, 0)
+        s.push(b'w')
+        self.assertEqual(s.take(100),
+                         b'\x00\x00\x00\x00DROPPED 2\nw')
+
+
+class TestHub(unittest.TestCase):
+
+    def setUp(self):
+        self.hub = tail.SubscriptionHub()
+        self.everything = self.hub.subscribe(mock.MagicMock(), {})
+        self.app = self.hub.subscribe(mock.MagicMock(), {'file': 'app.log'})
+
+    def frames(self, subscription):
+        data = subscription.take(1 << 20)
+        frames = []
+        while data:
+            size = struct.unpack('>L', data[:4])[0]
+            frames.append(pickle.loads(data[4:4 + size]))
+            data = data[4 + size:]
+        return frames
+
+    def test_publish_once_per_record(self):
+        rec = record(msg='both')
+        self.hub.publish(rec, handler('app.log'))
+        self.hub.publish(rec, handler('errors.log'))
+        self.hub.publish(record(msg='errors'), handler('errors.log'))
+        self.assertEqual([d['msg'] for d in self.frames(self.everything)],
+                         ['both', 'errors'])
+        self.assertEqual([d['msg'] for d in self.frames(self.app)],
+                         ['both'])
+
+    def test_unsubscribe(self):
+        self.hub.unsubscribe(self.app)
+        self.hub.unsubscribe(self.app)
+        self.assertEqual(self.hub.subscriptions, [self.everything])
+
+
+class TestSubscribedChannel(unittest.TestCase):
+
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair()
+        self.theirs.settimeout(5)
+        self.hub = tail.SubscriptionHub()
+        self.c = server.LoggingChannel(self.ours, {})
+        self.c.subscriptions = self.hub
+
+    def tearDown(self):
+        self.c.close()
+        self.theirs.close()
+
+    def say(self, data):
+        self.theirs.sendall(data)
+        time.sleep(0.01)
+        self.c.handle_read()
+
+    def flush(self):
+        while self.c.writable():
+            self.c.handle_write()
+
+    def test_subscribe(self):
+        self.say(b'HELLO 1.0\n')
+        self.say(b'SUBSCRIBE {"level": "WARNING"}\n')
+        self.assertEqual(self.c.status, 'SUBSCRIBED')
+        self.assertEqual(len(self.hub.subscriptions), 1)
+        self.hub.publish(record(logging.ERROR, 'bad'), handler('app.log'))
+        self.hub.publish(record(logging.INFO, 'fine'), handler('app.log'))
+        self.flush()
+        data = self.theirs.recv(4096)
+        self.assertTrue(data.startswith(b'HELLO 1.0\nOK\n'))
+        frame = data[len(b'HELLO 1.0\nOK\n'):]
+        self.assertEqual(struct.unpack('>L', frame[:4])[0], len(frame) - 4)
+        self.assertEqual(pickle.loads(frame[4:])['msg'], 'bad')
+
+    def test_bad_filter(self):
+        self.say(b'HELLO 1.0\n')
+        self.say(b'SUBSCRIBE {"level": "LOUD"}\n')
+        self.assertEqual(self.c.status, 'IDENTIFYING')
+        self.assertTrue(self.c.write_buf.endswith(b'\n'))
+        self.assertIn(b'ERROR ', self.c.write_buf)
+
+    def test_quit(self):
+        self.say(b'HELLO 1.0\n')
+        self.say(b'SUBSCRIBE {}\n')
+        self.say(b'QUIT\n')
+        self.assertEqual(self.c.status, 'CLOSED')
+        self.assertEqual(self.hub.subscriptions, [])
+
+    def test_handoff_counts_queued_as_dropped(self):
+        self.say(b'HELLO 1.0\n')
+        self.say(b'SUBSCRIBE {"logger": "app"}\n')
+        self.hub.publish(record(), handler('app.log'))
+        state = json.loads(json.dumps(self.c.handoff_state()))
+        self.assertEqual(state['subscription'],
+                         {'filter': {'logger': 'app'}, 'dropped': 1})
+        sock = socket.socket(fileno=os.dup(self.ours.fileno()))
+        restored = server.LoggingChannel.restore(sock, {}, state)
+        try:
+            self.assertEqual(restored.status, 'SUBSCRIBED')
+            self.assertEqual(restored.subscription.logger, 'app')
+            self.assertEqual(restored.subscription.unreported, 1)
+        finally:
+            restored.close()
+
+
+class TestTailEndToEnd(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        hub = tail.SubscriptionHub()
+
+        class Channel(server.LoggingChannel):
+            subscriptions = hub
+            shared_sinks = sinks.SinkRegistry()
+
+        class Server(server.LogServer):
+            channel_class = Channel
+            socket_family = socket.AF_UNIX
+
+        self.hub = hub
+        self.map = {}
+        self.path = os.path.join(self.tmp, 'logserv.sock')
+        Server(self.path, self.map)
+        self.stop = threading.Event()
+        self.loop = threading.Thread(target=self.run_loop, daemon=True)
+        self.loop.start()
+
+    def run_loop(self):
+        while not self.stop.is_set():
+            asyncore.poll(0.005, self.map)
+
+    def tearDown(self):
+        self.stop.set()
+        self.loop.join(5)
+        for obj in list(self.map.values()):
+            if getattr(obj, 'handler', None) is not None:
+                obj.handler.close()
+        asyncore.close_all(self.map)
+        shutil.rmtree(self.tmp)
+
+    def test_tail(self):
+        log = os.path.join(self.tmp, 'app.log')
+        subscriber = tail.Subscriber(self.path, socket.AF_UNIX, timeout=5,
+                                     file=log, contains='tick')
+        subscriber.connect()
+        handler = client.UnixClient(self.path, filename=log)
+        try:
+            for i in range(5):
+                handler.emit(record(msg='tick %d' % i))
+                handler.emit(record(msg='tock %d' % i))
+            received = [subscriber.next_record().getMessage()
+                        for _ in range(5)]
+        finally:
+            handler.close()
+            subscriber.close()
+        self.assertEqual(received, ['tick %d' % i for i in range(5)])
+        self.assertEqual(subscriber.dropped, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
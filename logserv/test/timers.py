@@ -0,0 +1,91 @@
+import unittest
+from unittest import mock
+
+from .. import timers
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = mock.MagicMock(return_value=100.0)
+        self.wheel = timers.TimerWheel(tick=1.0, slots=8, clock=self.clock)
+        self.fired = []
+
+    def advance(self, now):
+        self.clock.return_value = now
+        self.wheel.advance()
+
+    def schedule(self, delay, name):
+        return self.wheel.schedule(delay, self.fired.append, name)
+
+    def test_never_early(self):
+        self.advance(100.5)
+        self.schedule(2, 'a')
+        self.advance(102.4)
+        self.assertEqual(self.fired, [])
+        self.advance(103.0)
+        self.assertEqual(self.fired, ['a'])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_later_rounds_wait(self):
+        # 3 and 11 ticks away share a bucket
+        self.schedule(3, 'near')
+        self.schedule(11, 'far')
+        self.advance(103)
+        self.assertEqual(self.fired, ['near'])
+        self.advance(110)
+        self.assertEqual(self.fired, ['near'])
+        self.advance(111)
+        self.assertEqual(self.fired, ['near', 'far'])
+
+    def test_jump_past_several_turns(self):
+        for delay in (1, 5, 9, 30):
+            self.schedule(delay, delay)
+        self.schedule(100, 'later')
+        self.advance(140)
+        self.assertEqual(sorted(self.fired), [1, 5, 9, 30])
+        self.advance(200)
+        self.assertEqual(self.fired[-1], 'later')
+
+    def test_cancel(self):
+        timer = self.schedule(1, 'a')
+        self.assertTrue(timer.active)
+        timer.cancel()
+        timer.cancel()
+        self.assertFalse(timer.active)
+        self.assertEqual(len(self.wheel), 0)
+        self.advance(105)
+        self.assertEqual(self.fired, [])
+
+    def test_cancelled_by_earlier_callback(self):
+        scheduled = {}
+
+        def fire(name, other):
+            self.fired.append(name)
+            scheduled[other].cancel()
+        scheduled['a'] = self.wheel.schedule(1, fire, 'a', 'b')
+        scheduled['b'] = self.wheel.schedule(1, fire, 'b', 'a')
+        self.advance(101)
+        # Whichever ran first cancelled the other
+        self.assertEqual(len(self.fired), 1)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_rescheduled_from_callback(self):
+        def again():
+            self.fired.append(self.wheel.now)
+            if len(self.fired) < 3:
+                self.wheel.schedule(2, again)
+        self.wheel.schedule(2, again)
+        for now in range(101, 110):
+            self.advance(now)
+        self.assertEqual(self.fired, [102, 104, 106])
+
+    def test_next_timeout(self):
+        self.assertIsNone(self.wheel.next_timeout())
+        self.schedule(5, 'a')
+        self.advance(100.25)
+        self.assertEqual(self.wheel.next_timeout(), 0.75)
+
+
+if __name__ == "__main__":
+    unittest.main()
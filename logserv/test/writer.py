@@ -0,0 +1,242 @@
+import asyncore
+import logging
+import threading
+import time
+import unittest
+from unittest import mock
+
+from .. import server, writer
+from . import utils
+
+
+class SlowHandler(logging.Handler):
+
+    """A handler whose disk only accepts writes while `gate` is set."""
+
+    def __init__(self):
+        super().__init__()
+        self.gate = threading.Event()
+        self.records = []
+
+    def emit(self, record):
+        self.gate.wait(5)
+        self.records.append(record)
+
+
+class FailingHandler(SlowHandler):
+
+    """A slow handler whose first write fails."""
+
+    def __init__(self):
+        super().__init__()
+        self.errors = []
+
+    def emit(self, record):
+        if not self.errors and not self.records:
+            self.gate.wait(5)
+            raise OSError("disk full")
+        super().emit(record)
+
+    def handleError(self, record):
+        self.errors.append(record)
+
+
+class TestFlowControl(utils.Patches, unittest.TestCase):
+
+    TO_PATCH = {'socket': 'socket.socket'}
+
+    def setUp(self):
+        super().setUp()
+        self.map = {}
+        self.pool = writer.WriterPool(self.map, high_water=4, low_water=1)
+        # The channels' sockets are mocks, so keep them out of the polled map
+        self.c = server.LoggingChannel(mock.MagicMock(), {})
+        self.c.writers = self.pool
+        self.c.handler = SlowHandler()
+
+    def tearDown(self):
+        self.c.handler.gate.set()
+        self.pool.close(5)
+        super().tearDown()
+
+    def emit(self, n):
+        for i in range(n):
+            self.c.emit(logging.makeLogRecord({'msg': str(i)}))
+
+    def wait_for(self, predicate, timeout=5):
+        deadline = time.time() + timeout
+        while not predicate():
+            if time.time() > deadline:  # pragma: no cover
+                self.fail("timed out")
+            asyncore.poll(0.01, self.map)
+
+    def test_reads_continue_below_high_water(self):
+        self.emit(3)
+        self.assertTrue(self.c.readable())
+
+    def test_slow_disk_pauses_reading(self):
+        self.emit(5)
+        self.assertFalse(self.c.readable())
+        self.c.handler.gate.set()
+        self.wait_for(self.c.readable)
+        self.wait_for(lambda: len(self.c.handler.records) == 5)
+
+    def test_failing_handler_keeps_writer(self):
+        self.c.handler = FailingHandler()
+        self.emit(5)
+        self.assertFalse(self.c.readable())
+        self.c.handler.gate.set()
+        self.wait_for(lambda: len(self.c.handler.records) == 4)
+        self.assertEqual([r.msg for r in self.c.handler.errors], ['0'])
+        self.assertTrue(self.pool.writer_for(self.c.handler).thread.is_alive())
+        self.wait_for(self.c.readable)
+
+    def test_handler_closed_after_its_records(self):
+        self.emit(2)
+        self.c.handler.close = mock.MagicMock()
+        self.pool.close_handler(self.c.handler)
+        self.assertFalse(self.c.handler.close.called)
+        self.c.handler.gate.set()
+        self.wait_for(lambda: self.c.handler.close.called)
+        self.assertEqual(len(self.c.handler.records), 2)
+
+    def test_handler_without_writer_closed_at_once(self):
+        handler = mock.MagicMock()
+        self.pool.close_handler(handler)
+        handler.close.assert_called_once_with()
+
+    def test_pause_is_per_file(self):
+        self.emit(5)
+        other = server.LoggingChannel(mock.MagicMock(), {})
+        other.writers = self.pool
+        other.handler = SlowHandler()
+        other.handler.gate.set()
+        other.emit(logging.makeLogRecord({'msg': 'elsewhere'}))
+        self.assertFalse(self.c.readable())
+        self.assertTrue(other.readable())
+        self.wait_for(lambda: other.handler.records)
+
+    def test_resume_notifies_channel(self):
+        self.emit(5)
+        self.c.interest_changed = mock.MagicMock()
+        self.c.handler.gate.set()
+        self.wait_for(lambda: self.c.interest_changed.called)
+
+    def test_shared_writer_per_file(self):
+        h1 = logging.FileHandler('/tmp/logserv-test.log', delay=True)
+        h2 = logging.FileHandler('/tmp/logserv-test.log', delay=True)
+        self.assertIs(self.pool.writer_for(h1), self.pool.writer_for(h2))
+        self.assertIsNot(self.pool.writer_for(h1),
+                         self.pool.writer_for(self.c.handler))
+
+    def test_bad_watermarks(self):
+        self.assertRaises(ValueError, writer.WriterPool, {}, 10, 10)
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestReordering(unittest.TestCase):
+
+    def setUp(self):
+        self.map = {}
+        self.pool = writer.WriterPool(self.map, reorder_window=0.05)
+        self.handler = ListHandler()
+        self.writer = self.pool.writer_for(self.handler)
+
+    def tearDown(self):
+        self.pool.close(5)
+
+    def put(self, *offsets):
+        now = time.time()
+        for offset in offsets:
+            record = logging.makeLogRecord({'msg': str(offset)})
+            record.created = now + offset
+            self.writer.put(self.handler, record)
+
+    def written(self):
+        return [float(r.msg) for r in self.handler.records]
+
+    def wait_for(self, predicate, timeout=5):
+        deadline = time.time() + timeout
+        while not predicate():
+            if time.time() > deadline:  # pragma: no cover
+                self.fail("timed out")
+            time.sleep(0.005)
+
+    def test_writer_class(self):
+        self.assertIsInstance(self.writer, writer.ReorderingWriter)
+        plain = writer.WriterPool({})
+        self.assertIs(plain.writer_class, writer.QueuedWriter)
+        plain.close()
+
+    def test_written_in_time_order(self):
+        self.put(-0.01, -0.03, -0.02)
+        self.put(-0.025)
+        self.wait_for(lambda: len(self.handler.records) == 4)
+        self.assertEqual(self.written(), [-0.03, -0.025, -0.02, -0.01])
+        self.assertEqual(self.pool.late, 0)
+
+    def test_held_for_the_window(self):
+        self.put(0)
+        time.sleep(0.01)
+        self.assertEqual(self.handler.records, [])
+        self.wait_for(lambda: self.handler.records)
+
+    def test_late_records_counted(self):
+        self.put(-1)
+        self.wait_for(lambda: self.handler.records)
+        self.put(-2)
+        self.wait_for(lambda: len(self.handler.records) == 2)
+        self.assertEqual(self.written(), [-1, -2])
+        self.assertEqual(self.pool.late, 1)
+
+    def test_cap(self):
+        self.pool.reorder_cap = 2
+        self.put(10, 20, 30)
+        self.wait_for(lambda: self.handler.records)
+        self.assertEqual(len(self.writer.heap), 2)
+
+    def test_close_flushes(self):
+        self.pool.close(5)
+        self.pool = writer.WriterPool(self.map, reorder_window=60)
+        self.writer = self.pool.writer_for(self.handler)
+        self.put(-0.01, -0.02)
+        self.pool.close(5)
+        self.assertEqual(self.written(), [-0.02, -0.01])
+
+    def test_future_records_keyed_on_arrival(self):
+        self.put(3600, -0.01)
+        self.wait_for(lambda: len(self.handler.records) == 2)
+        self.assertEqual(self.written(), [-0.01, 3600])
+
+    def test_handler_closed_after_its_records(self):
+        closed_after = []
+        self.handler.close = lambda: closed_after.append(self.written())
+        self.put(-0.01, -0.02)
+        self.writer.close_handler(self.handler)
+        self.wait_for(lambda: closed_after)
+        self.assertEqual(closed_after, [[-0.02, -0.01]])
+
+    def test_failing_handler_keeps_writer(self):
+        self.handler.emit = mock.MagicMock(side_effect=[OSError, None])
+        self.handler.handleError = mock.MagicMock()
+        self.put(-0.02, -0.01)
+        self.wait_for(lambda: self.handler.emit.call_count == 2)
+        self.assertEqual(self.handler.handleError.call_count, 1)
+        self.assertTrue(self.writer.thread.is_alive())
+
+    def test_bad_window(self):
+        self.assertRaises(ValueError, writer.WriterPool, {},
+                          reorder_window=-1)
+
+
+if __name__ == "__main__":
+    unittest.main()
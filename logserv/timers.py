@@ -0,0 +1,130 @@
+"""
+A hashed timer wheel for the server's connection timeouts.
+
+Timers are kept in a ring of `slots` buckets, each `tick` seconds wide, so
+scheduling and cancelling a timer cost O(1) whatever the number of
+connections, and advancing the wheel only looks at the buckets of the
+ticks that went by. Timers are never fired early, and at most one `tick`
+late:
+
+    from logserv import eventloop, server, timers
+    wheel = server.LoggingChannel.timers = timers.TimerWheel()
+    server.LoggingChannel.idle_timeout = 300
+    s = server.LogServer(("localhost", 9876))
+    eventloop.loop(server.LogServer.logging_map, timers=wheel)
+
+The wheel is advanced by whoever runs the loop; channels read its `now`,
+the time of the last advance, instead of asking the clock on every read.
+
+"""
+
+import math
+import time
+
+# The bucket of timers that have come due but not yet run
+_DUE = frozenset()
+
+
+class Timer:
+
+    """
+    A callback scheduled on a `TimerWheel`.
+    """
+
+    __slots__ = ('wheel', 'due', 'callback', 'args', 'bucket')
+
+    def __init__(self, wheel, due, callback, args):
+        self.wheel = wheel
+        self.due = due
+        self.callback = callback
+        self.args = args
+        self.bucket = None
+
+    def cancel(self):
+        self.wheel.cancel(self)
+
+    @property
+    def active(self):
+        return self.bucket is not None
+
+
+class TimerWheel:
+
+    """
+    Runs callbacks at least `delay` seconds after they are scheduled, in
+    `advance`.
+    """
+
+    def __init__(self, tick=1.0, slots=512, clock=time.monotonic):
+        if tick <= 0 or slots < 1:
+            raise ValueError("tick and slots must be positive")
+        self.tick = tick
+        self.clock = clock
+        self.slots = [set() for _ in range(slots)]
+        self.start = self.now = clock()
+        # Ticks from `start` to the last advance
+        self.ticks = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, delay, callback, *args):
+        """
+        Call `callback(*args)` once `delay` seconds have passed, and return
+        the `Timer` that can cancel it.
+        """
+        due = max(self.ticks + 1,
+                  math.ceil((self.now - self.start + delay) / self.tick))
+        timer = Timer(self, due, callback, args)
+        timer.bucket = self.slots[due % len(self.slots)]
+        timer.bucket.add(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        if timer.bucket is _DUE:
+            # Cancelled by the callback of a timer due at the same time
+            timer.bucket = None
+        elif timer.bucket is not None:
+            timer.bucket.discard(timer)
+            timer.bucket = None
+            self.count -= 1
+
+    def next_timeout(self):
+        """
+        Return how long until the next tick, or None if there are no timers.
+        """
+        if not self.count:
+            return None
+        return max(0.0, self.start + (self.ticks + 1) * self.tick - self.now)
+
+    def advance(self, now=None):
+        """
+        Move the wheel to `now` (by default the clock's time), running the
+        callbacks that have come due.
+        """
+        if now is None:
+            now = self.clock()
+        self.now = now
+        target = int((now - self.start) / self.tick)
+        if target <= self.ticks:
+            return
+        expired = []
+        if self.count:
+            # A full turn visits every bucket
+            for tick in range(self.ticks + 1,
+                              min(target, self.ticks + len(self.slots)) + 1):
+                bucket = self.slots[tick % len(self.slots)]
+                due = [timer for timer in bucket if timer.due <= target]
+                for timer in due:
+                    bucket.discard(timer)
+                    timer.bucket = _DUE
+                expired.extend(due)
+            self.count -= len(expired)
+        # Timers scheduled by the callbacks start from here
+        self.ticks = target
+        for timer in expired:
+            if timer.bucket is _DUE:
+                timer.bucket = None
+                timer.callback(*timer.args)
@@ -0,0 +1,282 @@
+"""
+Background writers that keep slow disks off the event loop.
+
+Without a writer pool, `LoggingChannel` emits each record to its handler as
+soon as it is decoded, so a slow disk stalls every connection served by the
+loop. A `WriterPool` instead hands records to one `QueuedWriter` thread per
+target file. Each writer has a high and a low watermark: once its queue
+reaches the high watermark the channels feeding it stop reading from their
+sockets, and they resume when the queue has drained down to the low
+watermark. Channels writing to other files are unaffected.
+
+    from logserv import server, writer
+    server.LoggingChannel.writers = writer.WriterPool(
+        server.LogServer.logging_map, high_water=1000, low_water=100)
+
+With a `reorder_window` (in seconds), each file's writer is a
+`ReorderingWriter`, which holds records back for that long and writes them
+in order of creation time.
+
+"""
+
+import collections
+import heapq
+import itertools
+import threading
+import time
+
+from . import eventloop
+
+
+def target_key(handler):
+    """
+    Return the key identifying the file `handler` writes to.
+
+    Handlers without a `baseFilename` get a writer of their own.
+
+    """
+    return getattr(handler, 'baseFilename', None) or id(handler)
+
+
+class QueuedWriter:
+
+    """
+    Emits the records queued for one target file on a background thread.
+    """
+
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.backlogged = False
+        self.waiting = set()
+        self.closing = False
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name='logserv-writer:%s' % (key,))
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def put(self, handler, record):
+        """
+        Queue `record` for `handler` and return whether the writer is
+        backlogged.
+        """
+        with self.cond:
+            self.queue.append((handler, record))
+            if len(self.queue) >= self.pool.high_water:
+                self.backlogged = True
+            self.cond.notify()
+            return self.backlogged
+
+    def wait(self, channel):
+        """
+        Have `channel` re-check its interest once the backlog clears.
+        """
+        with self.cond:
+            if self.backlogged:
+                self.waiting.add(channel)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closing:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                handler, record = self.queue.popleft()
+                if self.backlogged and len(self.queue) <= self.pool.low_water:
+                    self.backlogged = False
+                    waiting, self.waiting = self.waiting, set()
+                    self.pool.resume(waiting)
+            self.write(handler, record)
+
+    def close_handler(self, handler):
+        """
+        Close `handler` once the records queued for it have been written.
+        """
+        self.put(handler, None)
+
+    def write(self, handler, record):
+        """
+        Emit `record`, or close `handler` for a record of None, leaving a
+        failing handler to report its own error so that the thread carries
+        on with the rest of the queue.
+        """
+        try:
+            if record is None:
+                handler.close()
+            else:
+                handler.emit(record)
+        except Exception:
+            handler.handleError(record)
+
+    def close(self, timeout=None):
+        """
+        Stop the thread once everything queued has been written.
+        """
+        with self.cond:
+            self.closing = True
+            self.cond.notify()
+        self.thread.join(timeout)
+
+
+class ReorderingWriter(QueuedWriter):
+
+    """
+    A writer that sorts its records by creation time within a window.
+
+    Records are kept in a heap keyed on `created` until the server's clock
+    is `reorder_window` seconds past it, so records from different clients
+    arriving out of order by less than the window are written in order. A
+    record whose `created` lies in the future (a client clock running
+    ahead) is keyed on its arrival time instead.
+
+    At most `reorder_cap` records are held; beyond that the earliest ones
+    are written early. Records arriving after a later one has been written
+    are written at once and counted in `late`.
+
+    """
+
+    def __init__(self, pool, key):
+        self.heap = []
+        self.released = float('-inf')
+        self.late = 0
+        super().__init__(pool, key)
+
+    def __len__(self):
+        return len(self.queue) + len(self.heap)
+
+    def run(self):
+        window = self.pool.reorder_window
+        sequence = itertools.count()
+        while True:
+            with self.cond:
+                while not self.queue and not self.closing:
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    timeout = self.heap[0][0] + window - time.time()
+                    if timeout <= 0:
+                        break
+                    self.cond.wait(timeout)
+                items = list(self.queue)
+                self.queue.clear()
+                closing = self.closing
+                if self.backlogged:
+                    self.backlogged = False
+                    waiting, self.waiting = self.waiting, set()
+                    self.pool.resume(waiting)
+            now = time.time()
+            for handler, record in items:
+                if record is None:
+                    # Closed after everything already held for the handler
+                    key = now
+                else:
+                    key = min(record.created, now)
+                if key < self.released:
+                    self.late += 1
+                    self.write(handler, record)
+                else:
+                    heapq.heappush(self.heap,
+                                   (key, next(sequence), handler, record))
+            horizon = now - window
+            heap = self.heap
+            while heap and (closing or heap[0][0] <= horizon
+                            or len(heap) > self.pool.reorder_cap):
+                key, _, handler, record = heapq.heappop(heap)
+                self.released = key
+                self.write(handler, record)
+            if closing and not heap:
+                return
+
+
+class WriterPool:
+
+    """
+    Hands out one `QueuedWriter` per target file.
+
+    `map` is the socket map of the loop serving the channels; the pool adds
+    an `eventloop.Waker` to it so that paused channels are resumed on the
+    loop thread.
+
+    """
+
+    high_water = 1000
+    low_water = 100
+    writer_class = QueuedWriter
+    # Seconds to hold records back for reordering, or None not to reorder
+    reorder_window = None
+    reorder_cap = 10000
+
+    def __init__(self, map, high_water=None, low_water=None,
+                 reorder_window=None, reorder_cap=None):
+        if high_water is not None:
+            self.high_water = high_water
+        if low_water is not None:
+            self.low_water = low_water
+        if not 0 <= self.low_water < self.high_water:
+            raise ValueError("need 0 <= low_water < high_water")
+        if reorder_window is not None:
+            self.reorder_window = reorder_window
+        if reorder_cap is not None:
+            self.reorder_cap = reorder_cap
+        if self.reorder_window is not None:
+            if self.reorder_window < 0 or self.reorder_cap < 1:
+                raise ValueError("need reorder_window >= 0 and "
+                                 "reorder_cap >= 1")
+            self.writer_class = ReorderingWriter
+        self.waker = eventloop.Waker(map)
+        self.writers = {}
+        self.lock = threading.Lock()
+
+    def writer_for(self, handler):
+        key = target_key(handler)
+        writer = self.writers.get(key)
+        if writer is None:
+            with self.lock:
+                writer = self.writers.get(key)
+                if writer is None:
+                    writer = self.writers[key] = self.writer_class(self, key)
+        return writer
+
+    def close_handler(self, handler):
+        """
+        Close `handler` on its writer's thread, after the records queued for
+        it, or right away if it has no writer.
+        """
+        writer = self.writers.get(target_key(handler))
+        if writer is None:
+            handler.close()
+        else:
+            writer.close_handler(handler)
+
+    @property
+    def late(self):
+        """The number of records written out of order."""
+        return sum(getattr(writer, 'late', 0)
+                   for writer in list(self.writers.values()))
+
+    def resume(self, channels):
+        """
+        Schedule `channels` to re-check their interest on the loop thread.
+        """
+        if channels:
+            self.waker.call(self._resume, channels)
+
+    @staticmethod
+    def _resume(channels):
+        for channel in channels:
+            channel.interest_changed()
+
+    def close(self, timeout=None):
+        """
+        Drain and stop every writer, then remove the waker from its map.
+        """
+        with self.lock:
+            writers, self.writers = list(self.writers.values()), {}
+        for writer in writers:
+            writer.close(timeout)
+        self.waker.close()